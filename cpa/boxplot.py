@@ -178,20 +178,16 @@ class DataSourcePanel(wx.Panel):
         if fltr is not None:
             q.add_filter(fltr)
 
-        res = db.execute(str(q))
-        res = np.array(res, dtype=object)
-        # replaces Nones with NaNs
-        for row in res:
-            if row[0] is None:
-                row[0] = np.nan
+        # NULL values are returned as NaNs
+        columns = db.execute_columns(str(q), dtypes=['f8'] + ['O'] * (len(select) - 1))
+        values = columns[0]
         
         points_dict = {}
         if self.group_choice.Value != NO_GROUP:
-            for row in res:
-                groupkey = tuple(row[1:])
-                points_dict[groupkey] = points_dict.get(groupkey, []) + [row[0]]
+            for groupkey, val in zip(zip(*columns[1:]), values):
+                points_dict.setdefault(groupkey, []).append(val)
         else:
-            points_dict = {col : [r[0] for r in res]}
+            points_dict = {col : values.tolist()}
         return points_dict
 
     def save_settings(self):
@@ -26,6 +26,7 @@ import sortbin
 import logging
 import numpy as np
 import os
+from multiprocessing import cpu_count
 import sys
 import wx
 import re
@@ -131,6 +132,8 @@ class Classifier(wx.Frame):
 
         # find rules interface
         self.nRulesTxt = wx.TextCtrl(self.find_rules_panel, -1, value='5', size=(30,-1))
+        self.nWorkersSpin = wx.SpinCtrl(self.find_rules_panel, -1, size=(45,-1), min=1, max=cpu_count(), initial=cpu_count())
+        self.keepRulesCheck = wx.CheckBox(self.find_rules_panel, -1, 'add to rules')
         self.trainClassifierBtn = wx.Button(self.find_rules_panel, -1, 'Train Classifier')
         self.scoreAllBtn = wx.Button(self.find_rules_panel, -1, 'Score All')
         self.scoreImageBtn = wx.Button(self.find_rules_panel, -1, 'Score Image')
@@ -178,6 +181,12 @@ class Classifier(wx.Frame):
         self.find_rules_sizer.Add((5,20))
         self.find_rules_sizer.Add(self.nRulesTxt)
         self.find_rules_sizer.Add((5,20))
+        self.find_rules_sizer.Add(wx.StaticText(self.find_rules_panel, -1, 'cores'), flag=wx.ALIGN_CENTER_VERTICAL)
+        self.find_rules_sizer.Add((5,20))
+        self.find_rules_sizer.Add(self.nWorkersSpin)
+        self.find_rules_sizer.Add((5,20))
+        self.find_rules_sizer.Add(self.keepRulesCheck, flag=wx.ALIGN_CENTER_VERTICAL)
+        self.find_rules_sizer.Add((5,20))
         self.find_rules_sizer.Add(self.trainClassifierBtn)
         self.checkProgressBtn = wx.Button(self.find_rules_panel, -1, 'Check Progress')
         self.checkProgressBtn.Disable()
@@ -333,6 +342,8 @@ class Classifier(wx.Frame):
         self.fetchBtn.SetToolTip(wx.ToolTip('Fetches images of %s to be sorted.'%(p.object_name[1])))
         self.rules_text.SetToolTip(wx.ToolTip('Rules are displayed in this text box.'))
         self.nRulesTxt.SetToolTip(wx.ToolTip('The maximum number of rules classifier should use to define your phenotypes.'))
+        self.nWorkersSpin.SetToolTip(wx.ToolTip('The number of processor cores to use while training.'))
+        self.keepRulesCheck.SetToolTip(wx.ToolTip('When %s have only been added since the last training, keep the rules found then (refitting their weights) and add the number of rules above as new rules after them, rather than starting over. The rules are not retrained, so each training with this on makes the model longer.'%(p.object_name[1])))
         self.trainClassifierBtn.SetToolTip(wx.ToolTip('Tell Classifier to train itself for classification of your phenotypes as you have sorted them.'))
         self.scoreAllBtn.SetToolTip(wx.ToolTip('Compute %s counts and per-group enrichments across your experiment. (This may take a while)'%(p.object_name[0])))
         self.scoreImageBtn.SetToolTip(wx.ToolTip('Highlight %s of a particular phenotype in an image.'%(p.object_name[1])))
@@ -687,18 +698,19 @@ class Classifier(wx.Frame):
         # unclassified:
         if obClass == 0:
             if fltr_sel == 'experiment':
-                obKeys = dm.GetRandomObjects(nObjects)
+                obKeys = dm.GetRandomObjects(nObjects, with_replacement=False)
                 statusMsg += ' from whole experiment'
             elif fltr_sel == 'image':
                 imKey = self.GetGroupKeyFromGroupSizer()
-                obKeys = dm.GetRandomObjects(nObjects, [imKey])
+                obKeys = dm.GetRandomObjects(nObjects, [imKey], with_replacement=False)
                 statusMsg += ' from image %s'%(imKey,)
             elif fltr_sel in p._filters_ordered:
                 filteredImKeys = db.GetFilteredImages(fltr_sel)
                 if filteredImKeys == []:
                     self.PostMessage('No images were found in filter "%s"'%(fltr_sel))
                     return
-                obKeys = dm.GetRandomObjects(nObjects, filteredImKeys)
+                obKeys = dm.GetRandomObjects(nObjects, filteredImKeys, with_replacement=False,
+                                             cache_key=('filter', fltr_sel, str(p._filters[fltr_sel])))
                 statusMsg += ' from filter "%s"'%(fltr_sel)
             elif fltr_sel in p._groups_ordered:
                 # if the filter name is a group then it's actually a group
@@ -710,7 +722,8 @@ class Classifier(wx.Frame):
                     self.PostMessage('No images were found in group %s: %s'%(groupName, 
                                         ', '.join(['%s=%s'%(n,v) for n, v in zip(colNames,groupKey)])))
                     return
-                obKeys = dm.GetRandomObjects(nObjects, filteredImKeys)
+                obKeys = dm.GetRandomObjects(nObjects, filteredImKeys, with_replacement=False,
+                                             cache_key=('group', groupName, tuple(groupKey)))
                 if not obKeys:
                     self.PostMessage('No cells were found in this group. Group %s: %s'%(groupName, 
                                         ', '.join(['%s=%s'%(n,v) for n, v in zip(colNames,groupKey)])))
@@ -721,12 +734,14 @@ class Classifier(wx.Frame):
         # classified
         else:
             hits = 0
+            sample_key = None
             # Get images within any selected filter or group
             if fltr_sel != 'experiment':
                 if fltr_sel == 'image':
                     imKey = self.GetGroupKeyFromGroupSizer()
                     filteredImKeys = [imKey]
                 elif fltr_sel in p._filters_ordered:
+                    sample_key = ('filter', fltr_sel, str(p._filters[fltr_sel]))
                     filteredImKeys = db.GetFilteredImages(fltr_sel)
                     if filteredImKeys == []:
                         self.PostMessage('No images were found in filter "%s"'%(fltr_sel))
@@ -735,12 +750,33 @@ class Classifier(wx.Frame):
                     group_name = fltr_sel
                     groupKey = self.GetGroupKeyFromGroupSizer(group_name)
                     colNames = dm.GetGroupColumnNames(group_name)
+                    sample_key = ('group', group_name, tuple(groupKey))
                     filteredImKeys = dm.GetImagesInGroupWithWildcards(group_name, groupKey)
                     if filteredImKeys == []:
                         self.PostMessage('No images were found in group %s: %s'%(group_name,
                                             ', '.join(['%s=%s'%(n,v) for n, v in zip(colNames,groupKey)])))
                         return
                     
+            if hasattr(self.algorithm, 'FetchObjectsFromClassN'):
+                # The algorithm keeps the objects it has classified, so no
+                # need to sift through batches of random objects.
+                self.PostMessage('Classifying %s.'%(p.object_name[1]))
+                if fltr_sel == 'experiment':
+                    obKeys = self.algorithm.FetchObjectsFromClassN(obClass, nObjects)
+                    statusMsg += ' from whole experiment'
+                else:
+                    obKeys = self.algorithm.FetchObjectsFromClassN(obClass, nObjects, filteredImKeys)
+                    if fltr_sel == 'image':
+                        statusMsg += ' from image %s'%(imKey,)
+                    elif fltr_sel in p._filters_ordered:
+                        statusMsg += ' from filter %s'%(fltr_sel)
+                    elif fltr_sel in p._groups_ordered:
+                        statusMsg += ' from group %s: %s'%(fltr_sel,
+                                            ', '.join(['%s=%s'%(n,v) for n, v in zip(colNames,groupKey)]))
+                self.unclassifiedBin.AddObjects(obKeys[:nObjects], self.chMap, pos='last')
+                self.PostMessage(statusMsg)
+                return
+
             total_attempts = attempts = 0
             # Now check which objects fall within the classification
             while len(obKeys) < nObjects:
@@ -753,7 +789,7 @@ class Classifier(wx.Frame):
                         #       100 randomly distributed obkeys to try.
                         obKeysToTry = 'ABS(RANDOM()) %% %s < 100' % (dm.get_total_object_count())
                     else:
-                        obKeysToTry = dm.GetRandomObjects(100)
+                        obKeysToTry = dm.GetRandomObjects(100, with_replacement=False)
                     loopMsg = ' from whole experiment'
                 elif fltr_sel == 'image':
                     # All objects are tried in first pass
@@ -763,7 +799,8 @@ class Classifier(wx.Frame):
                     obKeysToTry = [imKey]
                     loopMsg = ' from image %s'%(imKey,)
                 else:
-                    obKeysToTry = dm.GetRandomObjects(100, filteredImKeys)
+                    obKeysToTry = dm.GetRandomObjects(100, filteredImKeys, with_replacement=False,
+                                                      cache_key=sample_key)
                     obKeysToTry.sort()
                     if fltr_sel in p._filters_ordered:
                         loopMsg = ' from filter %s'%(fltr_sel)
@@ -972,10 +1009,16 @@ class Classifier(wx.Frame):
                         raise StopCalculating()
 
                 dlg = wx.ProgressDialog('Fetching cell data for training set...', '0% Complete', 100, self, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
-                self.trainingSet = TrainingSet(p)
-                self.trainingSet.Create(labels = [bin.label for bin in self.classBins],
-                                        keyLists = [bin.GetObjectKeys() for bin in self.classBins],
-                                        callback=cb)
+                if self.trainingSet is None:
+                    self.trainingSet = TrainingSet(p)
+                    self.trainingSet.Create(labels = [bin.label for bin in self.classBins],
+                                            keyLists = [bin.GetObjectKeys() for bin in self.classBins],
+                                            callback=cb)
+                else:
+                    # only fetch the cells that are new since the last update
+                    self.trainingSet.Update(labels = [bin.label for bin in self.classBins],
+                                            keyLists = [bin.GetObjectKeys() for bin in self.classBins],
+                                            callback=cb)
                 self.PostMessage('Training set updated.')
                 dlg.Destroy()
                 return True
@@ -1018,13 +1061,22 @@ class Classifier(wx.Frame):
                 dlg = wx.ProgressDialog('Training classifier...', '0% Complete', 100, self, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
                 # JK - Start Modification
                 # Train the desired algorithm
+                kwargs = {}
+                if isinstance(self.algorithm, FastGentleBoosting):
+                    kwargs['presorted'] = self.trainingSet.get_presorted()
+                    if self.keepRulesCheck.IsChecked() and self.CanKeepRules():
+                        kwargs['warm_start'] = self.algorithm.model
+                        logging.info('Keeping %d rules and adding %d new ones.'%(len(self.algorithm.model), nRules))
                 self.algorithm.Train(
                     self.trainingSet.colnames, nRules, self.trainingSet.label_matrix,
-                    self.trainingSet.values, output, callback=cb
+                    self.trainingSet.values, output, callback=cb,
+                    n_workers=self.nWorkersSpin.GetValue(), **kwargs
                 )
                 # JK - End Modification
 
                 self.PostMessage('Classifier trained in %.1fs.' % (time()-t1))
+                # count the changes to the training set from here on
+                self.trainingSet.changes = (0, 0)
                 dlg.Destroy()
                 self.rules_text.Value = self.algorithm.ShowModel()
                 self.scoreAllBtn.Enable()
@@ -1041,6 +1093,16 @@ class Classifier(wx.Frame):
         self.UpdateClassChoices()
         
         
+    def CanKeepRules(self):
+        ''' Returns whether the current rules can be trained further: since
+        they were trained, examples have only been added to the training set,
+        and the rules are for the same classes and measurements. '''
+        model = self.algorithm.model
+        if not model or self.trainingSet.changes is None or self.trainingSet.changes[1] > 0:
+            return False
+        return (len(model[0][2]) == len(self.trainingSet.labels) and
+                all([wl[0] in self.trainingSet.colnames for wl in model]))
+
     def OnScoreImage(self, evt):
         # Get the image key
         # Start with the table_id if there is one
@@ -1168,7 +1230,14 @@ class Classifier(wx.Frame):
 
             if p.class_table and overwrite_class_table:
                 self.PostMessage('Saving %s classes to database...'%(p.object_name[0]))
-                self.algorithm.CreatePerObjectClassTable([bin.label for bin in self.classBins])
+                dlg = wx.ProgressDialog('Saving %s classes to table "%s"...'%(p.object_name[0], p.class_table), '0% Complete', 100, self, wx.PD_ELAPSED_TIME | wx.PD_ESTIMATED_TIME | wx.PD_REMAINING_TIME | wx.PD_CAN_ABORT)
+                try:
+                    self.algorithm.CreatePerObjectClassTable([bin.label for bin in self.classBins], cb=update)
+                except StopCalculating:
+                    dlg.Destroy()
+                    self.PostMessage('Saving classes canceled, scoring again will resume where it stopped.')
+                    return
+                dlg.Destroy()
                 self.PostMessage('%s classes saved to table "%s"'%(p.object_name[0].capitalize(), p.class_table))
 
         t2 = time()
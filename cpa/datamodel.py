@@ -1,4 +1,6 @@
 import logging
+import cPickle
+import hashlib
 from random import randint
 import numpy as np
 from dbconnect import *
@@ -8,167 +10,433 @@ from properties import Properties
 p = Properties.getInstance()
 db = DBConnect.getInstance()
 
+# Increment this when the snapshot format changes so old snapshots are rebuilt
+SNAPSHOT_VERSION = 2
+
+def _rename(src, dst):
+    '''os.rename that replaces dst on Windows too.'''
+    if os.name == 'nt' and os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+def _sample_indices(n, N, with_replacement=True):
+    '''Returns N random integers in [0, n), or min(N, n) distinct ones if
+    with_replacement is False.'''
+    if with_replacement:
+        return np.random.randint(0, n, N)
+    if N >= n // 4:
+        return np.random.permutation(n)[:N]
+    # Few draws from many: draw with replacement until there are N distinct
+    # values rather than permuting all n.
+    draws = np.unique(np.random.randint(0, n, N))
+    while len(draws) < N:
+        draws = np.unique(np.hstack((draws, np.random.randint(0, n, N - len(draws)))))
+    np.random.shuffle(draws)
+    return draws[:N]
+
+def pack_image_keys(imKeys):
+    '''
+    Packs image keys into int64s that sort like the key tuples do:
+    ImageNumber, or TableNumber<<32 | ImageNumber when there is a table_id.
+    imKeys -- a sequence of image key tuples or an (n x nkeycols) int array
+    '''
+    keys = np.asarray(imKeys, dtype='i8')
+    if keys.ndim == 1:
+        keys = keys.reshape((len(keys), 1))
+    if keys.shape[1] == 1:
+        return keys[:,0].copy()
+    assert keys.shape[1] == 2, 'Image keys must have 1 or 2 columns.'
+    if len(keys) > 0 and (keys[:,1].min() < 0 or keys[:,1].max() >= 2**32):
+        raise ValueError, 'Image numbers must be in [0, 2^32) to be packed.'
+    return (keys[:,0] << 32) | keys[:,1]
+
 class DataModel(Singleton):
     '''
-    DataModel is a dictionary of perImageObjectCounts indexed by (TableNumber,ImageNumber)
+    DataModel holds the perImageObjectCounts of each image key (TableNumber,ImageNumber)
+    and the groups each image belongs to, as arrays aligned with the sorted image keys.
     '''
-    
+
     def __init__(self):
-        self.data = {}           # {imKey:obCount, ... }
-        self.groupMaps = {}      # { groupName:{imKey:groupKey, }, ... }
-                                 # eg: groupMaps['Wells'][(0,4)]  ==>  (3,'A01')
-        self.revGroupMaps = {}   # { groupName:{groupKey:imKey, }, ... }
-                                 # eg: groupMaps['Wells'][(3,'A01')]  ==>  [(0,1),(0,2),(0,3),(0,4)]
+        self.imKeys = np.zeros((0,1), dtype='i8')  # sorted image keys, one per row
+        self.packedKeys = np.zeros(0, dtype='i8')  # pack_image_keys(imKeys), for lookups
+        self.counts = np.zeros(0, dtype='i8')      # object count of each image
         self.groupColNames = {}  # {groupName:[col_names,...], ...}
                                  # eg: {'Plate+Well': ['plate','well'], ...}
         self.groupColTypes = {}  # {groupName:[col_types,...], ...}
-        self.cumSums = []        # cumSum[i]: sum of objects in images 1..i (inclusive) 
+        self.groupKeys = {}      # {groupName:[groupKey, ...], ...}
+                                 # eg: groupKeys['Wells']  ==>  [(3,'A01'), (3,'A02'), ...]
+        self.groupKeyIndex = {}  # {groupName:{groupKey:index in groupKeys, }, ...}
+        self.groupIndex = {}     # {groupName:array of the groupKeys index of each image, ...}
+                                 # (-1 for images that aren't in the group)
+        self.groupOrder = {}     # {groupName:(image indices sorted by group, group offsets), ...}
+                                 # the images of groupKeys[j] are order[offsets[j]:offsets[j+1]]
+        self.cumSums = []        # cumSum[i]: sum of objects in images 1..i (inclusive)
         self.obCount = 0
-        self.keylist = []
+        self.obIds = np.zeros(0, dtype='int32')  # object ids of each image in imKeys order
+        self.obOffsets = np.zeros(1, dtype='int') # obIds[obOffsets[i]:obOffsets[i+1]] are the
+                                 # sorted object ids of image imKeys[i]
+        self.sampleCache = {}    # {cache_key:(image indices, cumulative counts), ...}
         self.filterkeys = {}     # sets of image keys keyed by filter name
         self.plate_map = {}      # maps well names to (x,y) plate locations
         self.rev_plate_map = {}  # maps (x,y) plate locations to well names
-        
+
     def __str__(self):
         return str(self.obCount)+" objects in "+ \
-               str(len(self.data))+" images"
-               
+               str(len(self.imKeys))+" images"
+
     def PopulateModel(self, delete_model=False):
         if delete_model:
             self.DeleteModel()
         elif not self.IsEmpty():
             # No op if already populated
             return
-        
+
         if db is None:
             logging.error("Error: No database connection!")
             return
-        
+
         if p.check_tables == 'yes':
             db.CheckTables()
-        
+
+        if self._load_snapshot():
+            return
+
         # Initialize per-image object counts to zero
+        nkeycols = len(image_key_columns())
         imKeys = db.GetAllImageKeys()
-        for key in imKeys:
-            key = tuple([int(k) for k in key])    # convert keys to to int tuples
-            self.data[key] = 0
-                    
+        self._set_image_keys(np.array(imKeys, dtype='i8').reshape((len(imKeys), nkeycols)))
+
         # Compute per-image object counts
         res = db.GetPerImageObjectCounts()
-        for r in res:
-            key = tuple([int(k) for k in r[:-1]])
-            self.data[key] = r[-1]
-            self.obCount += r[-1]
-            
-        self.keylist = list(self.data.keys())
+        counts = np.zeros(len(self.imKeys), dtype='i8')
+        if len(res) > 0:
+            counts[self._image_indices([r[:-1] for r in res])] = [r[-1] for r in res]
+        self._set_counts(counts)
 
+        if p.object_table and p.object_id:
+            self._build_object_index()
+        else:
+            self.obOffsets = np.zeros(len(self.imKeys)+1, dtype='int')
+
+        # the group index arrays are built from the reverse maps rather
+        # than running every group query a second time
+        revGroupMaps, groupColNames = db.GetGroupMaps(reverse=True)
+        for group, revMap in revGroupMaps.items():
+            groupKeys = revMap.keys()
+            groupIndex = -np.ones(len(self.imKeys), dtype='i4')
+            for j, groupKey in enumerate(groupKeys):
+                indices = self._image_indices(revMap[groupKey], missing_ok=True)
+                groupIndex[indices[indices >= 0]] = j
+            self._set_group(group, groupColNames[group], groupKeys, groupIndex)
+
+        self._save_snapshot()
+
+    def _set_image_keys(self, imKeys):
+        '''Sets the image keys from an (n x nkeycols) int array, sorting them.'''
+        packed = pack_image_keys(imKeys)
+        order = np.argsort(packed, kind='mergesort')
+        self.imKeys = np.asarray(imKeys)[order]
+        self.packedKeys = packed[order]
+
+    def _set_counts(self, counts):
+        '''Sets the object count of each image (in imKeys order).'''
+        self.counts = np.asarray(counts, dtype='i8')
+        self.obCount = int(self.counts.sum())
         # Build a cumulative sum array to use for generating random objects quickly
-        self.cumSums = np.zeros(len(self.data)+1, dtype='int')
-        for i, imKey in enumerate(self.keylist):
-            self.cumSums[i+1] = self.cumSums[i]+self.data[imKey]
+        self.cumSums = np.zeros(len(self.counts)+1, dtype='int')
+        np.cumsum(self.counts, out=self.cumSums[1:])
 
-        self.groupMaps, self.groupColNames = db.GetGroupMaps()
-        self.revGroupMaps, _ = db.GetGroupMaps(reverse=True)
-        for group in self.groupMaps:
-            self.groupColTypes[group] = [type(col) for col in self.groupMaps[group].items()[0][1]]
+    def _set_group(self, group, colNames, groupKeys, groupIndex):
+        '''
+        Sets a group from its list of group keys and the groupKeys index of
+        each image (-1 for images that aren't in the group).
+        '''
+        self.groupColNames[group] = colNames
+        self.groupKeys[group] = list(groupKeys)
+        self.groupKeyIndex[group] = dict((groupKey, j) for j, groupKey in enumerate(groupKeys))
+        self.groupIndex[group] = groupIndex
+        order = np.argsort(groupIndex, kind='mergesort')
+        offsets = np.searchsorted(groupIndex[order], np.arange(len(groupKeys)+1))
+        self.groupOrder[group] = (order, offsets)
+        if len(groupKeys) > 0:
+            self.groupColTypes[group] = [type(col) for col in groupKeys[0]]
+        else:
+            self.groupColTypes[group] = []
+
+    def _image_indices(self, imKeys, missing_ok=False):
+        '''
+        Returns the positions of the given image keys in imKeys as an array.
+        Unknown keys raise a KeyError, or get -1 if missing_ok is True.
+        '''
+        packed = pack_image_keys(imKeys)
+        if len(self.packedKeys) == 0:
+            indices = np.zeros(len(packed), dtype='int')
+            found = np.zeros(len(packed), dtype=bool)
+        else:
+            indices = np.searchsorted(self.packedKeys, packed)
+            indices[indices == len(self.packedKeys)] = 0
+            found = self.packedKeys[indices] == packed
+        if not found.all():
+            if not missing_ok:
+                raise KeyError, tuple(np.asarray(imKeys)[np.flatnonzero(~found)[0]].tolist())
+            indices[~found] = -1
+        return indices
+
+    def _image_keys(self, indices=None):
+        '''Returns the image keys at the given positions as tuples (all if None).'''
+        if indices is None:
+            return [tuple(imKey) for imKey in self.imKeys.tolist()]
+        return [tuple(imKey) for imKey in self.imKeys[indices].tolist()]
+
+    def _get_snapshot_dir(self):
+        '''
+        Returns the directory of the snapshot for the current properties
+        file, or None if there is no properties file to identify it by.
+        '''
+        filename = p.__dict__.get('_filename')
+        if not filename or not os.path.isfile(filename):
+            return None
+        with open(filename, 'rb') as f:
+            digest = hashlib.md5(f.read()).hexdigest()
+        return os.path.join(get_cpa_data_dir(), 'datamodel_%s'%(digest))
+
+    def _save_snapshot(self):
+        '''
+        Saves the model to disk so the next start can skip the object
+        table scans. Arrays are saved as .npy files so they can be memory
+        mapped; groups are stored as their group keys and index arrays.
+        '''
+        snapdir = self._get_snapshot_dir()
+        modify_date = db.get_objects_modify_date()
+        if snapdir is None or modify_date is None:
+            return
+        groups = {}
+        for group in self.groupKeys:
+            groups[group] = (self.groupColNames[group], self.groupKeys[group],
+                             np.asarray(self.groupIndex[group]))
+        arrays = {'keys'      : np.asarray(self.imKeys),
+                  'counts'    : np.asarray(self.counts),
+                  'obIds'     : np.asarray(self.obIds),
+                  'obOffsets' : np.asarray(self.obOffsets),}
+        meta = {'version'     : SNAPSHOT_VERSION,
+                'modify_date' : modify_date,
+                'groups'      : groups,}
+        try:
+            if not os.path.exists(snapdir):
+                os.mkdir(snapdir)
+            # Write to temporary files and rename so that processes which
+            # have the old snapshot mapped keep a consistent copy. The meta
+            # file goes last since it marks the snapshot as complete.
+            for name, a in arrays.items():
+                filename = os.path.join(snapdir, name + '.npy')
+                with open(filename + '.tmp', 'wb') as f:
+                    np.save(f, a)
+                _rename(filename + '.tmp', filename)
+            filename = os.path.join(snapdir, 'meta.pickle')
+            with open(filename + '.tmp', 'wb') as f:
+                cPickle.dump(meta, f, cPickle.HIGHEST_PROTOCOL)
+            _rename(filename + '.tmp', filename)
+            logging.info('Saved data model snapshot to %s'%(snapdir))
+        except (IOError, OSError), e:
+            logging.warn('Could not save data model snapshot to %s: %s'%(snapdir, e))
+
+    def _load_snapshot(self):
+        '''
+        Loads the model from the snapshot saved for the current properties
+        if the object table hasn't changed since. Returns True on success.
+        '''
+        snapdir = self._get_snapshot_dir()
+        if snapdir is None or not os.path.exists(os.path.join(snapdir, 'meta.pickle')):
+            return False
+        try:
+            with open(os.path.join(snapdir, 'meta.pickle'), 'rb') as f:
+                meta = cPickle.load(f)
+            modify_date = db.get_objects_modify_date()
+            if (meta['version'] != SNAPSHOT_VERSION or modify_date is None or
+                meta['modify_date'] != modify_date):
+                logging.info('Data model snapshot in %s is out of date.'%(snapdir))
+                return False
+            arrays = dict((name, np.load(os.path.join(snapdir, name + '.npy'), mmap_mode='r'))
+                          for name in ['keys', 'counts', 'obIds', 'obOffsets'])
+        except Exception, e:
+            logging.warn('Could not load data model snapshot from %s: %s'%(snapdir, e))
+            return False
+
+        # keys were saved sorted, so the other arrays stay aligned
+        self._set_image_keys(np.array(arrays['keys']))
+        self._set_counts(np.array(arrays['counts']))
+        self.obIds = arrays['obIds']
+        self.obOffsets = np.array(arrays['obOffsets'])
+        if len(self.obIds) > 0:
+            self.cumSums = self.obOffsets
+        self.sampleCache = {}
+        for group, (colnames, groupKeys, groupIndex) in meta['groups'].items():
+            self._set_group(group, colnames, groupKeys, groupIndex)
+        logging.info('Loaded data model snapshot from %s'%(snapdir))
+        return True
+
+    def _build_object_index(self):
+        '''
+        Fetches every object key once and stores the object ids of each
+        image, sorted, in one contiguous array (obIds) with per-image
+        offsets (obOffsets) in imKeys order.  Sampling and listing objects
+        then needs no further queries.
+        '''
+        nkeycols = len(image_key_columns())
+        columns = db.execute_columns('SELECT %s, %s FROM %s WHERE %s IS NOT NULL'%(
+                                        UniqueImageClause(), p.object_id,
+                                        p.object_table, p.object_id),
+                                     dtypes=['i8'] * (nkeycols + 1))
+        imcols, obids = columns[:-1], columns[-1]
+        # map each row to the position of its image in imKeys; objects in
+        # images that aren't in the image table get -1 and are dropped
+        positions = self._image_indices(np.column_stack(imcols), missing_ok=True)
+        obids = obids[positions >= 0]
+        positions = positions[positions >= 0]
+        obids = obids[np.lexsort((obids, positions))]
+        if len(obids) > 0 and obids.max() <= np.iinfo('int32').max:
+            obids = obids.astype('int32')
+        self.obIds = obids
+        self.obOffsets = np.zeros(len(self.imKeys)+1, dtype='int')
+        np.cumsum(np.bincount(positions, minlength=len(self.imKeys)),
+                  out=self.obOffsets[1:])
+        self.cumSums = self.obOffsets
+        self.sampleCache = {}
+
+    def _object_keys(self, imIndices, obIndices):
+        '''Returns object keys given imKeys indices and obIds indices.'''
+        if len(imIndices) == 0:
+            return []
+        keys = np.column_stack((self.imKeys[imIndices], self.obIds[obIndices]))
+        return [tuple(obKey) for obKey in keys.tolist()]
 
     def DeleteModel(self):
-        self.data = {}
-        self.groupMaps = {}
+        self.imKeys = np.zeros((0,1), dtype='i8')
+        self.packedKeys = np.zeros(0, dtype='i8')
+        self.counts = np.zeros(0, dtype='i8')
+        self.groupKeys = {}
+        self.groupKeyIndex = {}
+        self.groupIndex = {}
+        self.groupOrder = {}
         self.cumSums = []
         self.obCount = 0
-        
+        self.obIds = np.zeros(0, dtype='int32')
+        self.obOffsets = np.zeros(1, dtype='int')
+        self.sampleCache = {}
+
     def _if_empty_populate(self):
         if self.IsEmpty:
             self.PopulateModel()
-            
+
     def get_total_object_count(self):
         self._if_empty_populate()
         return self.obCount
-        
+
     def GetRandomObject(self):
         '''
-        Returns a random object key
-        We expect self.data.keys() to return the keys in the SAME ORDER
-        every time since we build cumSums from that same ordering.  This
-        need not necessarily be in sorted order.
+        Returns a random object key, or None if there are no objects.
         '''
         self._if_empty_populate()
-        obIdx = randint(1, self.obCount)
-        imIdx = np.searchsorted(self.cumSums, obIdx, 'left')
+        if len(self.obIds) == 0:
+            return None
+        obIdx = randint(0, len(self.obIds)-1)
         # SUBTLETY: images which have zero objects will appear as repeated
-        #    sums in the cumulative array, so we must pick the first index
-        #    of any repeated sum, otherwise we are picking an image with no
-        #    objects
-        while self.cumSums[imIdx] == self.cumSums[imIdx-1]:
-            imIdx -= 1
-        imKey = self.data.keys()[imIdx-1]
-        obIdx = obIdx-self.cumSums[imIdx-1]  # object number relative to this image
-                    
-        obKey = db.GetObjectIDAtIndex(imKey, obIdx)
-        return obKey
-
-    def GetRandomObjects(self, N, imKeys=None):
+        #    offsets, so we must pick the last index of any repeated offset,
+        #    otherwise we are picking an image with no objects
+        imIdx = np.searchsorted(self.obOffsets, obIdx, 'right') - 1
+        return self._object_keys([imIdx], [obIdx])[0]
+
+    def GetRandomObjects(self, N, imKeys=None, with_replacement=True, cache_key=None):
         '''
         Returns N random objects.
-        If a list of imKeys is specified, GetRandomObjects will return 
+        If a list of imKeys is specified, GetRandomObjects will return
         objects from only these images.
+        If with_replacement is False, no object is returned twice, and
+        fewer than N objects are returned if there aren't N to choose from.
+        cache_key: a name for imKeys, like the filter or group they come
+        from.  Sampling again with the same cache_key reuses the object
+        counts summed for those images (see _get_sample_sums).
         '''
         self._if_empty_populate()
         if imKeys == None:
-            return [self.GetRandomObject() for i in xrange(N)]
+            if len(self.obIds) == 0:
+                return []
+            obIndices = _sample_indices(len(self.obIds), N, with_replacement)
+            # SUBTLETY: images with zero objects appear as repeated offsets,
+            #    searching right picks the last (non-empty) one.
+            imIndices = np.searchsorted(self.obOffsets, obIndices, 'right') - 1
         elif imKeys == []:
             return []
         else:
-            sums = np.cumsum([self.data[imKey] for imKey in imKeys])
-            if sums[-1] < 1:
+            selected, sums = self._get_sample_sums(imKeys, cache_key)
+            if len(sums) == 0:
                 return []
-            obs = []
-            for i in xrange(N):
-                obIdx = randint(1, sums[-1])
-                index = np.searchsorted(sums, obIdx, 'left')
-                if index != 0:
-                    while sums[index] == sums[index-1]:
-                        index -= 1
-                    obIdx = obIdx-sums[index-1]
-                obKey = db.GetObjectIDAtIndex(imKeys[index], obIdx)
-                obs.append(obKey)
-            return obs
-            
+            # draw from the objects of the selected images, then find which
+            # image each one falls in and its index within that image
+            draws = _sample_indices(sums[-1], N, with_replacement)
+            which = np.searchsorted(sums, draws, 'right')
+            imIndices = selected[which]
+            starts = np.hstack(([0], sums[:-1]))
+            obIndices = self.obOffsets[imIndices] + draws - starts[which]
+        return self._object_keys(imIndices, obIndices)
+
+    def _get_sample_sums(self, imKeys, cache_key=None):
+        '''
+        Returns the imKeys indices of the given images that have objects
+        and the cumulative sum of their object counts.  If a cache_key is
+        given, these are cached under it, since callers like the Classifier
+        sample repeatedly from the same filter or group.  (Keying on the
+        image keys themselves would cost as much as the sums.)
+        '''
+        if cache_key is not None and cache_key in self.sampleCache:
+            return self.sampleCache[cache_key]
+        selected = self._image_indices(list(imKeys))
+        counts = self.obOffsets[selected+1] - self.obOffsets[selected]
+        # mask out empty images so every cumulative sum is distinct
+        result = (selected[counts > 0], np.cumsum(counts[counts > 0]))
+        if cache_key is not None:
+            if len(self.sampleCache) >= 16:
+                self.sampleCache.clear()
+            self.sampleCache[cache_key] = result
+        return result
+
     def GetObjectsFromImage(self, imKey):
+        ''' Returns the keys of all objects in the specified image. '''
         self._if_empty_populate()
-        obKeys=[]
-        for i in xrange(1,self.GetObjectCountFromImage(imKey)+1):
-            obKeys.append(db.GetObjectIDAtIndex(imKey, i))
-        return obKeys
-        # JK - The above code was previously removed in favor of the code below.
-        # However the new code is sensitive to objects not having consecutive IDs 
-        # in an image, whereas the above code is not making it more robust
-#        return [tuple(list(imKey) + [i]) 
-#                for i in xrange(1, self.GetObjectCountFromImage(imKey) + 1)]
-    
+        i = self._image_indices([imKey])[0]
+        start, end = self.obOffsets[i], self.obOffsets[i+1]
+        return self._object_keys([i] * (end - start), np.arange(start, end))
+
     def GetAllImageKeys(self, filter_name=None):
         ''' Returns all object keys. If a filter is passed in, only the image
         keys that fall within the filter will be returned.'''
         self._if_empty_populate()
         if filter_name is None:
-            return list(self.data.keys())
+            return self._image_keys()
         else:
             return list(db.GetFilteredImages(filter_name))
 
     def GetObjectCountFromImage(self, imKey):
         ''' Returns the number of objects in the specified image. '''
         self._if_empty_populate()
-        return self.data[imKey]
-    
+        return int(self.counts[self._image_indices([imKey])[0]])
+
+    def GetObjectCounts(self, imKeys):
+        ''' Returns an array of the number of objects in each of the specified images. '''
+        self._if_empty_populate()
+        if len(imKeys) == 0:
+            return np.zeros(0, dtype='i8')
+        return self.counts[self._image_indices(imKeys)]
+
     def GetImageKeysAndObjectCounts(self, filter_name=None):
         ''' Returns pairs of imageKeys and object counts. '''
         self._if_empty_populate()
         if filter_name is None:
-            return self.data.items()
+            return zip(self._image_keys(), self.counts.tolist())
         else:
-            return [(imKey, self.data[imKey]) for imKey in db.GetFilteredImages(filter_name)]
-    
+            imKeys = list(db.GetFilteredImages(filter_name))
+            return zip(imKeys, self.GetObjectCounts(imKeys).tolist())
+
     def GetGroupColumnNames(self, group, include_table_name=False):
         ''' Returns the key column names associated with the specified group. '''
         self._if_empty_populate()
@@ -191,21 +459,21 @@ class DataModel(Singleton):
            groupdata = { groupKey : np.array(values), ... }
         '''
         self._if_empty_populate()
-        groupData = {}
-        nvals = len(imdata.values()[0])
-        for imKey in imdata.keys():
-            # initialize each entry to [0,0,...]
-            groupData[self.groupMaps[group][imKey]] = np.zeros(nvals)
-            
-        for imKey, vals in imdata.items():
-            # add values to running sum of this group
-            groupData[self.groupMaps[group][imKey]] += vals
-        
-        return groupData
-    
+        if len(imdata) == 0:
+            return {}
+        imKeys = imdata.keys()
+        groupIdx = self.groupIndex[group][self._image_indices(imKeys)]
+        if (groupIdx < 0).any():
+            raise KeyError, imKeys[np.flatnonzero(groupIdx < 0)[0]]
+        values = np.array([imdata[imKey] for imKey in imKeys], dtype='f8')
+        values = values.reshape((len(imKeys), -1))
+        sums = np.zeros((len(self.groupKeys[group]), values.shape[1]))
+        np.add.at(sums, groupIdx, values)
+        return dict((self.groupKeys[group][j], sums[j]) for j in np.unique(groupIdx))
+
     def GetImagesInGroupWithWildcards(self, group, groupKey, filter_name=None):
         '''
-        Returns all imKeys in a particular group. 
+        Returns all imKeys in a particular group.
         '__ANY__' in the groupKey matches anything.
         '''
         self._if_empty_populate()
@@ -215,38 +483,41 @@ class DataModel(Singleton):
             def matches(key1, key2):
                 return all([(a==b or b=='__ANY__') for a,b in zip(key1,key2)])
             imkeys = []
-            for gkey, ikeys in self.revGroupMaps[group].items():
+            for gkey in self.groupKeys[group]:
                 if matches(gkey,groupKey):
-                    imkeys += ikeys
+                    imkeys += self.GetImagesInGroup(group, gkey)
             return imkeys
         else:
             # if there are no wildcards simply lookup the imkeys
             return self.GetImagesInGroup(group, groupKey, filter_name)
-    
+
     def GetImagesInGroup(self, group, groupKey, filter_name=None):
         ''' Returns all imKeys in a particular group. '''
         self._if_empty_populate()
         try:
-            imkeys = self.revGroupMaps[group][groupKey]
+            j = self.groupKeyIndex[group][groupKey]
         except KeyError:
             return []
-            
+        order, offsets = self.groupOrder[group]
+        imkeys = self._image_keys(order[offsets[j]:offsets[j+1]])
+
         # apply filter if supplied
         if filter_name is not None:
             if filter_name not in self.filterkeys.keys():
                 self.filterkeys[filter_name] = db.GetFilteredImages(filter_name)
-            imkeys = set(imkeys).intersection(self.filterkeys[filter_name])    
-        
+            imkeys = set(imkeys).intersection(self.filterkeys[filter_name])
+
         return imkeys
-    
+
     def GetGroupKeysInGroup(self, group):
         ''' Returns all groupKeys in specified group '''
         self._if_empty_populate()
-        return list(set(self.groupMaps[group].values()))
-        
+        order, offsets = self.groupOrder[group]
+        return [self.groupKeys[group][j] for j in np.flatnonzero(np.diff(offsets) > 0)]
+
     def IsEmpty(self):
-        return self.data == {}
-    
+        return len(self.imKeys) == 0
+
     def populate_plate_maps(self):
         '''Computes plate_maps which maps well names to their corresponding
         plate positions, and rev_plate_maps which does the reverse.
@@ -15,10 +15,15 @@ import re
 import os.path
 import logging
 import copy
+import time
+from collections import OrderedDict
 # This module should be usable on systems without wx.
 
 verbose = True
 
+# number of images whose object coordinates DBConnect keeps
+COORDS_CACHE_SIZE = 100
+
 p = Properties.getInstance()
 
 class DBException(Exception):
@@ -57,14 +62,15 @@ class DBDisconnectedException(Exception):
     def with_mysql_retry(cls, f):
         """
         Decorator that tries calling its function a second time if a
-        DBDisconnectedException occurs the first time.
+        DBDisconnectedException occurs the first time. The dead connection
+        is discarded from the pool and replaced by a health-checked one.
         """
         def fn(db, *args, **kwargs):
             try:
                 return f(db, *args, **kwargs)
             except DBDisconnectedException:
                 logging.info('Lost connection to the MySQL database; reconnecting.')
-                db.connect()
+                db.reconnect()
                 return f(db, *args, **kwargs)
         return fn
     with_mysql_retry = classmethod(with_mysql_retry)
@@ -178,6 +184,33 @@ def GetWhereClauseForObjects(obkeys, table_name=None):
 
     return split(obkeys,table_name)
 
+def GetWhereClauseForObjectsByImage(obkeys, table_name=None):
+    '''
+    Return a SQL WHERE clause that matches any of the given object keys,
+    grouping the object ids of each image into a single IN list.
+    Example: GetWhereClauseForObjectsByImage([(1, 3), (1, 4), (2, 4)]) =>
+             "((ImageNumber=1 AND ObjectNumber IN (3,4)) OR 
+               (ImageNumber=2 AND ObjectNumber IN (4)))"
+    '''
+    cols = object_key_columns(table_name)
+    by_image = {}
+    for obkey in obkeys:
+        by_image.setdefault(tuple(obkey[:-1]), []).append(obkey[-1])
+    terms = ['(' + ' AND '.join([col + '=' + str(value) 
+                                 for col, value in zip(cols[:-1], imkey)] + 
+                                ['%s IN (%s)'%(cols[-1], ','.join([str(v) for v in obids]))]) + ')'
+             for imkey, obids in sorted(by_image.items())]
+    # Split into a binary tree like GetWhereClauseForObjects to avoid
+    # SQLITE_MAX_LIMIT_EXPR_DEPTH
+    def split(terms):
+        if len(terms) <= 3:
+            return '(' + ' OR '.join(terms) + ')'
+        else:
+            halflen = len(terms) // 2
+            return '(' + split(terms[:halflen]) + ' OR ' + split(terms[halflen:]) + ')'
+
+    return split(terms)
+
 def GetWhereClauseForImages(imkeys):
     '''
     Return a SQL WHERE clause that matches any of the given image keys.
@@ -239,6 +272,20 @@ def UniqueWellClause(table_name=None):
     '''
     return ','.join(well_key_columns(table_name))
 
+def get_cpa_data_dir():
+    '''
+    Returns the directory where CPA keeps the files it generates (SQLite
+    databases, snapshots), creating it if necessary.
+    '''
+    dbpath = os.getenv('USERPROFILE') or os.getenv('HOMEPATH') or \
+        os.path.expanduser('~')
+    dbpath = os.path.join(dbpath,'CPA')
+    try:
+        os.listdir(dbpath)
+    except OSError:
+        os.mkdir(dbpath)
+    return dbpath
+
 def get_csv_filenames_from_sql_file():
     '''
     Get the image and object CSVs specified in the .SQL file
@@ -275,6 +322,158 @@ class SqliteClassifier():
         return int(class_num)
 
 
+class ConnectionPool(object):
+    '''
+    A bounded, thread-safe pool of database connections.
+
+    factory  -- function that opens and returns a new connection
+    ping     -- function that raises an exception if a connection is dead
+    max_size -- maximum number of connections open at the same time
+    max_idle -- idle connections older than this (in seconds) are closed
+    timeout  -- seconds to wait for a free connection before raising a
+                DBException that names the threads holding them, or None
+                to wait until one is returned
+
+    Connections that have been idle in the pool are health checked with ping
+    before they are handed out again, so callers never get a connection that
+    the server has already dropped.
+    '''
+    def __init__(self, factory, ping, max_size=10, max_idle=300, timeout=60):
+        self.factory = factory
+        self.ping = ping
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self.idle = []           # [(connection, time checked in), ...]
+        self.busy = set()        # connections currently checked out
+        self.owners = {}         # busy connection -> name of the thread that checked it out
+        self.cv = threading.Condition()
+        self.counters = {'created'       : 0,
+                         'reused'        : 0,
+                         'evicted'       : 0,
+                         'failed_checks' : 0,
+                         'discarded'     : 0,
+                         'waits'         : 0,}
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _evict_idle(self):
+        '''closes connections that have been idle for too long. Call with cv held.'''
+        now = time.time()
+        keep = []
+        for conn, t in self.idle:
+            if now - t > self.max_idle:
+                self._close(conn)
+                self.counters['evicted'] += 1
+            else:
+                keep.append((conn, t))
+        self.idle = keep
+
+    def checkout(self):
+        '''Returns a healthy connection, opening a new one if none are idle.
+        Blocks while max_size connections are checked out.
+        '''
+        if self.timeout is not None:
+            deadline = time.time() + self.timeout
+        while True:
+            conn = None
+            with self.cv:
+                self._evict_idle()
+                while not self.idle and len(self.busy) >= self.max_size:
+                    if self.timeout is None:
+                        remaining = None
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            owners = sorted(set(self.owners.values()))
+                            raise DBException('Timed out waiting for a free database '
+                                              'connection (%d in use by threads: %s). Threads '
+                                              'other than the main thread should release their '
+                                              'connections after each unit of work.'
+                                              %(len(self.busy), ', '.join(owners) or 'none'))
+                    self.counters['waits'] += 1
+                    self.cv.wait(remaining)
+                    self._evict_idle()
+                if self.idle:
+                    conn = self.idle.pop()[0]
+                # reserve a slot before leaving the lock
+                placeholder = object()
+                self.busy.add(placeholder)
+            try:
+                if conn is None:
+                    conn = self.factory()
+                    created = True
+                else:
+                    created = False
+                    try:
+                        self.ping(conn)
+                    except Exception, e:
+                        logging.info('Discarding dead database connection: %s'%(e))
+                        self._close(conn)
+                        with self.cv:
+                            self.counters['failed_checks'] += 1
+                            self.busy.discard(placeholder)
+                        continue
+            except:
+                with self.cv:
+                    self.busy.discard(placeholder)
+                    self.cv.notify()
+                raise
+            with self.cv:
+                self.busy.discard(placeholder)
+                self.busy.add(conn)
+                self.owners[conn] = threading.currentThread().getName()
+                self.counters['created' if created else 'reused'] += 1
+            return conn
+
+    def checkin(self, conn):
+        '''Returns a connection to the pool so it can be reused.'''
+        with self.cv:
+            if conn not in self.busy:
+                return
+            self.busy.discard(conn)
+            self.owners.pop(conn, None)
+            self.idle.append((conn, time.time()))
+            self._evict_idle()
+            self.cv.notify()
+
+    def discard(self, conn):
+        '''Closes a checked-out connection instead of returning it.'''
+        with self.cv:
+            self.busy.discard(conn)
+            self.owners.pop(conn, None)
+            self.counters['discarded'] += 1
+            self.cv.notify()
+        self._close(conn)
+
+    def available(self):
+        '''Returns how many connections can be checked out without waiting.'''
+        with self.cv:
+            return max(0, self.max_size - len(self.busy))
+
+    def close_all(self):
+        '''Closes all idle connections. Busy connections are closed when
+        they are discarded.'''
+        with self.cv:
+            for conn, t in self.idle:
+                self._close(conn)
+            self.idle = []
+            self.cv.notify_all()
+
+    def stats(self):
+        '''Returns a dict of pool counters and current sizes.'''
+        with self.cv:
+            stats = dict(self.counters)
+            stats['in_use'] = len(self.busy)
+            stats['idle'] = len(self.idle)
+            stats['max_size'] = self.max_size
+        return stats
+
+
 def _check_colname_user(properties, table, colname):
     if table in [properties.image_table, properties.object_table] and not colname.lower().startswith('user_'):
         raise ValueError('User-defined columns in the image and object tables must have names beginning with "User_".')
@@ -282,94 +481,93 @@ def _check_colname_user(properties, table, colname):
     
 class DBConnect(Singleton):
     '''
-    DBConnect abstracts calls to MySQLdb/SQLite. It's a singleton that maintains
-    unique connections for each thread that uses it.  These connections are 
-    automatically created on "execute", and results are automatically returned
-    as a list.
+    DBConnect abstracts calls to MySQLdb/SQLite. It's a singleton that hands
+    out a pooled connection to each thread that uses it.  Connections are
+    automatically checked out on "execute", returned to the pool when the
+    thread releases them or exits, and results are automatically returned
+    as a list.  Threads other than the main thread should call
+    release_connection after each unit of work, since the pool is bounded:
+    checking out a connection waits while all of them are in use, and
+    raises a DBException naming the threads that hold them if none is
+    returned within the pool's timeout.
     '''
     def __init__(self):
         self.classifierColNames = None
         self.connections = {}
         self.cursors = {}
         self.connectionInfo = {}
+        self.pool = None
+        self.lock = threading.RLock()
         #self.link_cols = {}  # link_cols['table'] = columns that link 'table' to the per-image table
         self.sqlite_classifier = SqliteClassifier()
         self.gui_parent = None
+        # image key -> {object id: (x, y)}, least recently used first
+        self.coords_cache = OrderedDict()
 
     def __str__(self):
         return string.join([ (key + " = " + str(val) + "\n")
                             for (key, val) in self.__dict__.items()])
-            
-    def connect(self, empty_sqlite_db=False):
-        '''
-        Attempts to create a new connection to the specified database using
-          the current thread name as a connection ID.
-        If properties.db_type is 'sqlite', it will create a sqlite db in a
-          temporary directory from the csv files specified by
-          properties.image_csv_file and properties.object_csv_file
-        '''
-        connID = threading.currentThread().getName()
-        
-        logging.info('[%s] Connecting to the database...'%(connID))
-        # If this connection ID already exists print a warning
-        if connID in self.connections.keys():
-            if self.connectionInfo[connID] == (p.db_host, p.db_user, 
-                                               (p.db_passwd or None), p.db_name):
-                logging.warn('A connection already exists for this thread. %s as %s@%s (connID = "%s").'%(p.db_name, p.db_user, p.db_host, connID))
+
+    def get_pool(self):
+        '''Returns the connection pool, creating it on first use.'''
+        with self.lock:
+            if self.pool is None:
+                self.pool = ConnectionPool(self._open_connection,
+                                           self._ping_connection,
+                                           max_size=int(p.db_pool_size or 10))
+            return self.pool
+
+    def get_pool_stats(self):
+        '''Returns a dict of connection pool metrics (see ConnectionPool.stats)'''
+        return self.get_pool().stats()
+
+    def _get_sqlite_file(self):
+        '''Returns the SQLite database path, computing a unique name for
+        databases created from CSV files.'''
+        if not p.db_sqlite_file:
+            # Compute a UNIQUE database name for these files
+            import md5
+            dbpath = get_cpa_data_dir()
+            if p.db_sql_file:
+                csv_dir = os.path.split(p.db_sql_file)[0] or '.'
+                imcsvs, obcsvs = get_csv_filenames_from_sql_file()
+                files = imcsvs + obcsvs + [os.path.split(p.db_sql_file)[1]]
+                hash = md5.new()
+                for fname in files:
+                    t = os.stat(csv_dir + os.path.sep + fname).st_mtime
+                    hash.update('%s%s'%(fname,t))
+                dbname = 'CPA_DB_%s.db'%(hash.hexdigest())
             else:
-                raise DBException, 'A connection already exists for this thread (%s). Close this connection first.'%(connID,)
+                imtime = os.stat(p.image_csv_file).st_mtime
+                obtime = os.stat(p.object_csv_file).st_mtime
+                l = '%s%s%s%s'%(p.image_csv_file,p.object_csv_file,imtime,obtime)
+                dbname = 'CPA_DB_%s.db'%(md5.md5(l).hexdigest())
+                
+            p.db_sqlite_file = os.path.join(dbpath, dbname)
+        return p.db_sqlite_file
 
+    def _open_connection(self):
+        '''
+        Opens a new raw connection to the database specified in properties.
+        Used by the connection pool, use connect() to get a connection.
+        '''
         # MySQL database: connect normally
         if p.db_type.lower() == 'mysql':
             import MySQLdb
-            from MySQLdb.cursors import SSCursor
             try:
-                conn = MySQLdb.connect(host=p.db_host, db=p.db_name, 
+                return MySQLdb.connect(host=p.db_host, db=p.db_name, 
                                        user=p.db_user, passwd=(p.db_passwd or None))
-                self.connections[connID] = conn
-                self.cursors[connID] = SSCursor(conn)
-                self.connectionInfo[connID] = (p.db_host, p.db_user, 
-                                               (p.db_passwd or None), p.db_name)
-                logging.debug('[%s] Connected to database: %s as %s@%s'%(connID, p.db_name, p.db_user, p.db_host))
             except DBError(), e:
-                raise DBException, 'Failed to connect to database: %s as %s@%s (connID = "%s").\n  %s'%(p.db_name, p.db_user, p.db_host, connID, e)
+                raise DBException, 'Failed to connect to database: %s as %s@%s.\n  %s'%(p.db_name, p.db_user, p.db_host, e)
             
-        # SQLite database: create database from CSVs
+        # SQLite database
         elif p.db_type.lower() == 'sqlite':
             import sqlite3 as sqlite
-            
-            if not p.db_sqlite_file:
-                # Compute a UNIQUE database name for these files
-                import md5
-                dbpath = os.getenv('USERPROFILE') or os.getenv('HOMEPATH') or \
-                    os.path.expanduser('~')
-                dbpath = os.path.join(dbpath,'CPA')
-                try:
-                    os.listdir(dbpath)
-                except OSError:
-                    os.mkdir(dbpath)
-                if p.db_sql_file:
-                    csv_dir = os.path.split(p.db_sql_file)[0] or '.'
-                    imcsvs, obcsvs = get_csv_filenames_from_sql_file()
-                    files = imcsvs + obcsvs + [os.path.split(p.db_sql_file)[1]]
-                    hash = md5.new()
-                    for fname in files:
-                        t = os.stat(csv_dir + os.path.sep + fname).st_mtime
-                        hash.update('%s%s'%(fname,t))
-                    dbname = 'CPA_DB_%s.db'%(hash.hexdigest())
-                else:
-                    imtime = os.stat(p.image_csv_file).st_mtime
-                    obtime = os.stat(p.object_csv_file).st_mtime
-                    l = '%s%s%s%s'%(p.image_csv_file,p.object_csv_file,imtime,obtime)
-                    dbname = 'CPA_DB_%s.db'%(md5.md5(l).hexdigest())
-                    
-                p.db_sqlite_file = os.path.join(dbpath, dbname)
-            logging.info('[%s] SQLite file: %s'%(connID, p.db_sqlite_file))
-            self.connections[connID] = sqlite.connect(p.db_sqlite_file)
-            self.connections[connID].text_factory = str
-            self.cursors[connID] = self.connections[connID].cursor()
-            self.connectionInfo[connID] = ('sqlite', 'cpa_user', '', 'CPA_DB')
-            self.connections[connID].create_function('greatest', -1, max)
+            # Pooled connections may be reused by a different thread than the
+            # one that opened them, but never by two threads at once.
+            conn = sqlite.connect(self._get_sqlite_file(), check_same_thread=False)
+            conn.text_factory = str
+            conn.create_function('greatest', -1, max)
             # Create MEDIAN function
             class median:
                 def __init__(self):
@@ -389,7 +587,7 @@ class DBConnect(Singleton):
                         return self.values[n//2]
                     else:
                         return (self.values[n//2-1] + self.values[n//2]) / 2
-            self.connections[connID].create_aggregate('median', 1, median)
+            conn.create_aggregate('median', 1, median)
             # Create STDDEV function
             class stddev:
                 def __init__(self):
@@ -407,14 +605,68 @@ class DBConnect(Singleton):
                     b = np.sum([(x-avg)**2 for x in self.values])
                     std = np.sqrt(b/len(self.values))
                     return std
-            self.connections[connID].create_aggregate('stddev', 1, stddev)
+            conn.create_aggregate('stddev', 1, stddev)
             # Create REGEXP function
             def regexp(expr, item):
                 reg = re.compile(expr)
                 return reg.match(item) is not None
-            self.connections[connID].create_function("REGEXP", 2, regexp)
+            conn.create_function("REGEXP", 2, regexp)
             # Create classifier function
-            self.connections[connID].create_function('classifier', -1, self.sqlite_classifier.classify)
+            conn.create_function('classifier', -1, self.sqlite_classifier.classify)
+            return conn
+        # Unknown database type (this should never happen)
+        else:
+            raise DBException, "Unknown db_type in properties: '%s'\n"%(p.db_type)
+
+    def _ping_connection(self, conn):
+        '''Raises an exception if the given connection is no longer usable.'''
+        if p.db_type.lower() == 'mysql':
+            conn.ping()
+        else:
+            conn.execute('SELECT 1').fetchall()
+            
+    def connect(self, empty_sqlite_db=False):
+        '''
+        Checks out a connection from the pool for the current thread, using
+        the thread name as a connection ID.
+        If properties.db_type is 'sqlite', it will create a sqlite db in a
+          temporary directory from the csv files specified by
+          properties.image_csv_file and properties.object_csv_file
+        '''
+        connID = threading.currentThread().getName()
+        
+        logging.info('[%s] Connecting to the database...'%(connID))
+        # If this connection ID already exists print a warning
+        if connID in self.connections.keys():
+            if self.connectionInfo[connID] == (p.db_host, p.db_user, 
+                                               (p.db_passwd or None), p.db_name):
+                logging.warn('A connection already exists for this thread. %s as %s@%s (connID = "%s").'%(p.db_name, p.db_user, p.db_host, connID))
+                return
+            else:
+                raise DBException, 'A connection already exists for this thread (%s). Close this connection first.'%(connID,)
+
+        # Give back connections held by threads that have exited
+        self.release_dead_thread_connections()
+
+        # MySQL database: connect normally
+        if p.db_type.lower() == 'mysql':
+            from MySQLdb.cursors import SSCursor
+            conn = self.get_pool().checkout()
+            with self.lock:
+                self.connections[connID] = conn
+                self.cursors[connID] = SSCursor(conn)
+                self.connectionInfo[connID] = (p.db_host, p.db_user, 
+                                               (p.db_passwd or None), p.db_name)
+            logging.debug('[%s] Connected to database: %s as %s@%s'%(connID, p.db_name, p.db_user, p.db_host))
+            
+        # SQLite database: create database from CSVs
+        elif p.db_type.lower() == 'sqlite':
+            logging.info('[%s] SQLite file: %s'%(connID, self._get_sqlite_file()))
+            conn = self.get_pool().checkout()
+            with self.lock:
+                self.connections[connID] = conn
+                self.cursors[connID] = conn.cursor()
+                self.connectionInfo[connID] = ('sqlite', 'cpa_user', '', 'CPA_DB')
             
             try:
                 # Try the connection
@@ -448,6 +700,13 @@ class DBConnect(Singleton):
         else:
             raise DBException, "Unknown db_type in properties: '%s'\n"%(p.db_type)
 
+    def reconnect(self):
+        '''Drops the current thread's connection and checks out a fresh one.'''
+        connID = threading.currentThread().getName()
+        if connID in self.connections.keys():
+            self.CloseConnection(connID)
+        self.connect()
+
     def setup_sqlite_classifier(self, thresh, a, b):
         self.sqlite_classifier.setup_classifier(thresh, a, b)
 
@@ -458,21 +717,79 @@ class DBConnect(Singleton):
         self.cursors = {}
         self.connectionInfo = {}
         self.classifierColNames = None
+        with self.lock:
+            self.coords_cache.clear()
+            if self.pool is not None:
+                logging.debug('Connection pool stats: %s'%(self.pool.stats()))
+                self.pool.close_all()
+                self.pool = None
     
+    def forget_connections(self):
+        '''
+        Drops the connections of this process without closing them.  Call
+        this first thing in a forked child process, whose inherited
+        connections still belong to the parent.
+        '''
+        self.lock = threading.RLock()
+        self.connections = {}
+        self.cursors = {}
+        self.connectionInfo = {}
+        self.pool = None
+
+    def _pop_connection(self, connID):
+        '''Removes connID's connection from this thread map, committing any
+        outstanding work. Returns the connection or None.'''
+        with self.lock:
+            if connID not in self.connections.keys():
+                return None
+            cursor = self.cursors.pop(connID)
+            conn = self.connections.pop(connID)
+            (db_host, db_user, db_passwd, db_name) = self.connectionInfo.pop(connID)
+        try:
+            # closing an SSCursor reads any pending rows so the connection
+            # is usable by the next thread
+            cursor.close()
+        except: pass
+        try:
+            conn.commit()
+        except: pass
+        return conn
+
     def CloseConnection(self, connID=None):
         if not connID:
             connID = threading.currentThread().getName()
-        if connID in self.connections.keys():
-            try:
-                self.connections[connID].commit()
-            except: pass
-            self.cursors.pop(connID)
-            self.connections.pop(connID).close()
-            (db_host, db_user, db_passwd, db_name) = self.connectionInfo.pop(connID)
+        db_info = self.connectionInfo.get(connID)
+        conn = self._pop_connection(connID)
+        if conn is not None:
+            if self.pool is not None:
+                self.pool.discard(conn)
+            else:
+                conn.close()
+            (db_host, db_user, db_passwd, db_name) = db_info
             logging.info('Closed connection: %s as %s@%s (connID="%s").' % (db_name, db_user, db_host, connID))
         else:
             logging.warn('No database connection ID "%s" found!' %(connID))
 
+    def release_connection(self, connID=None):
+        '''
+        Returns the connection held by connID (default: the current thread)
+        to the pool so that another thread can use it. The thread will
+        transparently check out a connection again on its next query.
+        '''
+        if not connID:
+            connID = threading.currentThread().getName()
+        conn = self._pop_connection(connID)
+        if conn is not None and self.pool is not None:
+            self.pool.checkin(conn)
+
+    def release_dead_thread_connections(self):
+        '''Returns connections held by threads that have exited to the pool.'''
+        alive = set([t.getName() for t in threading.enumerate()])
+        for connID in self.connections.keys():
+            if connID not in alive:
+                logging.debug('Releasing connection of finished thread "%s"'%(connID))
+                self.release_connection(connID)
+
     @DBDisconnectedException.with_mysql_retry
     def execute(self, query, args=None, silent=False, return_result=True):
         '''
@@ -518,7 +835,66 @@ class DBConnect(Singleton):
                                     '\nQuery was: "%s"'
                                     '\nFirst exception was: %s'
                                     '\nSecond exception was: %s'%(connID, query, e, e2))
-            
+
+    def execute_iter(self, query, args=None, batch_size=10000, silent=False):
+        '''
+        Executes the given query using the connection associated with
+        the current thread and returns an iterator over the results in
+        lists of at most batch_size rows.  Rows are read from the server
+        as they are consumed, so the full result is never held in memory.
+        NOTE: the iterator must be exhausted (or closed) before the
+          current thread issues another query.
+        '''
+        if p.db_type.lower() == 'sqlite':
+            if args:
+                raise TypeError('Can\'t pass args to sqlite execute!')
+
+        # Grab a new connection if this is a new thread
+        connID = threading.currentThread().getName()
+        if not connID in self.connections.keys():
+            self.connect()
+
+        try:
+            cursor = self.cursors[connID]
+        except KeyError, e:
+            raise DBException, 'No such connection: "%s".\n' %(connID)
+
+        try:
+            if verbose and not silent:
+                logging.debug('[%s] %s'%(connID, query))
+            if p.db_type.lower() == 'sqlite':
+                cursor.execute(query)
+            else:
+                cursor.execute(query, args=args)
+        except Exception, e:
+            raise DBException, ('Database query failed for connection "%s"'
+                                '\nQuery was: "%s"'
+                                '\nException was: %s'%(connID, query, e))
+        return self._iter_results(cursor, batch_size)
+
+    def _iter_results(self, cursor, batch_size):
+        '''
+        Yields the results of the last query on cursor in batches.
+        NOTE: this function automatically called by execute_iter.
+        '''
+        exhausted = False
+        try:
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if len(rows) == 0:
+                    exhausted = True
+                    break
+                yield list(rows)
+        finally:
+            if not exhausted:
+                # An unbuffered MySQL cursor can't run another query
+                # until the rest of the result has been read.
+                try:
+                    while len(cursor.fetchmany(batch_size)) > 0:
+                        pass
+                except Exception:
+                    pass
+
     def Commit(self):
         connID = threading.currentThread().getName()
         try:
@@ -550,14 +926,33 @@ class DBConnect(Singleton):
         connID = threading.currentThread().getName()
         return list(self.cursors[connID].fetchall())
 
-    def result_dtype(self):
+    def result_dtype(self, rows=None):
         """
         Return an appropriate descriptor for a numpy array in which the
         result can be stored.
+        rows -- SQLite cursors carry no type information, so column types
+          are inferred from the values in these rows (eg: the first batch
+          of the result).  Columns with no values default to float.  (When
+          reading the rest of the result, execute_columns widens integer
+          columns to float if it meets a float.)
         """
-        #XXX: This doesn't work for SQLite... no cursor.description_flags
         cursor = self.cursors[threading.currentThread().getName()]
         descr = []
+        if p.db_type.lower() == 'sqlite':
+            for i, col in enumerate(cursor.description):
+                fun2 = types.FloatType
+                for row in (rows or []):
+                    if row[i] is not None:
+                        fun2 = type(row[i])
+                        break
+                if fun2 in [types.FloatType]:
+                    dtype = 'f8'
+                elif fun2 in [types.IntType, types.LongType]:
+                    dtype = 'i8'
+                else:
+                    dtype = 'O'
+                descr.append((col[0], dtype))
+            return descr
         for (name, type_code, display_size, internal_size, precision, 
              scale, null_ok), flags in zip(cursor.description, 
                                            cursor.description_flags):
@@ -573,24 +968,92 @@ class DBConnect(Singleton):
             if fun2 in [decimal.Decimal, types.FloatType]:
                 dtype = 'f8'
             elif fun2 in [types.IntType, types.LongType]:
-                dtype = 'i4'
+                dtype = 'i8'
             elif fun2 in [types.StringType]:
                 dtype = '|S%d'%(internal_size,)
+            else:
+                dtype = 'O'
             descr.append((name, dtype))
         return descr
 
+    def execute_columns(self, query, dtypes=None, args=None, batch_size=10000, silent=False,
+                        callback=None):
+        '''
+        Executes the given query and returns the result as a list of 1-D
+        numpy arrays, one per selected column.  Rows are copied straight
+        into typed column arrays as they are read, so no list of row tuples
+        or object array is ever built.
+        dtypes -- optional list of numpy dtypes, one per column.  By default
+          they are taken from result_dtype.  Integer columns that turn out
+          to contain NULLs are promoted to float with NaN for NULL.
+        callback -- optional function called with the number of rows read
+          after each batch.  If it returns False, reading stops and the
+          rows read so far are returned.
+        '''
+        batches = self.execute_iter(query, args=args, batch_size=batch_size, silent=silent)
+        return self._fill_columns(batches, dtypes, batch_size, callback)
+
+    def _fill_columns(self, batches, dtypes, batch_size, callback=None):
+        '''
+        Copies batches of rows into typed column arrays.
+        NOTE: this function automatically called by execute_columns.
+        '''
+        columns = None
+        n = 0
+        # SQLite column types are only guessed from the first batch, so
+        # integer columns are widened if later values turn out to be floats
+        widen = dtypes is None and p.db_type.lower() == 'sqlite'
+        for rows in batches:
+            if columns is None:
+                if dtypes is None:
+                    dtypes = [dtype for name, dtype in self.result_dtype(rows)]
+                columns = [np.empty(max(batch_size, len(rows)), dtype=dtype) 
+                           for dtype in dtypes]
+            if n + len(rows) > len(columns[0]):
+                # grow geometrically to keep copying linear in the result size
+                size = max(2 * len(columns[0]), n + len(rows))
+                for j, col in enumerate(columns):
+                    columns[j] = np.empty(size, dtype=col.dtype)
+                    columns[j][:n] = col[:n]
+            for j, vals in enumerate(zip(*rows)):
+                col = columns[j]
+                if col.dtype.kind == 'S' and None in vals:
+                    col = columns[j] = col.astype('O')
+                elif widen and col.dtype.kind == 'i' and float in map(type, vals):
+                    col = columns[j] = col.astype('f8')
+                try:
+                    col[n:n+len(rows)] = vals
+                except (TypeError, ValueError):
+                    # NULLs or mixed values: fall back to float, then object
+                    for dtype in ['f8', 'O']:
+                        try:
+                            col = columns[j] = col.astype(dtype)
+                            col[n:n+len(rows)] = vals
+                            break
+                        except (TypeError, ValueError):
+                            pass
+            n += len(rows)
+            if callback is not None and callback(n) is False:
+                batches.close()
+                break
+        if columns is None:
+            if dtypes is None:
+                dtypes = [dtype for name, dtype in self.result_dtype()]
+            return [np.empty(0, dtype=dtype) for dtype in dtypes]
+        return [col[:n].copy() if len(col) > n else col for col in columns]
+
     def get_results_as_structured_array(self, n=None):
-        #XXX: this doesn't work for SQLite
+        '''
+        Returns the remaining results of the last query as a numpy record
+        array with one field per result column.
+        n -- number of rows to read from the cursor at a time
+        '''
         col_names = self.GetResultColumnNames()
-        connID = threading.currentThread().getName()
-        records = []
-        while True:
-            r = self.cursors[connID].fetchmany(n)
-            print len(r)
-            if len(r) == 0:
-                break
-            records.extend(list(r))
-        return np.array(records, dtype=self.result_dtype())
+        cursor = self.cursors[threading.currentThread().getName()]
+        batch_size = n or 10000
+        columns = self._fill_columns(self._iter_results(cursor, batch_size), 
+                                     None, batch_size)
+        return np.rec.fromarrays(columns, names=col_names)
     
     def GetObjectIDAtIndex(self, imKey, index):
         '''
@@ -650,10 +1113,60 @@ class DBConnect(Singleton):
         else:
             return res[0]
     
+    def GetObjectsCoords(self, obKeys, silent=False):
+        '''Returns a list of the x, y coordinates of each of the given objects,
+        or None for objects without coordinates.  Objects in images whose
+        coordinates are cached (see GetObjectCoordsByImage) are looked up
+        there, the rest in a single query.
+        '''
+        coords = {}
+        rest = []
+        with self.lock:
+            for obKey in obKeys:
+                image_coords = self.coords_cache.get(tuple(obKey[:-1]))
+                if image_coords is None:
+                    rest.append(obKey)
+                else:
+                    coords[tuple(obKey)] = image_coords.get(obKey[-1])
+        if rest:
+            res = self.execute('SELECT %s, %s, %s FROM %s WHERE %s'%(
+                            UniqueObjectClause(), p.cell_x_loc, p.cell_y_loc,
+                            p.object_table, GetWhereClauseForObjectsByImage(rest)),
+                               silent=silent)
+            for row in res:
+                coords[tuple(row[:-2])] = tuple(row[-2:])
+        result = []
+        for obKey in obKeys:
+            xy = coords.get(tuple(obKey))
+            if xy is None or None in xy:
+                result.append(None)
+            else:
+                result.append(xy)
+        return result
+
+    def GetObjectCoordsByImage(self, imKey):
+        '''Returns a dict mapping the object id of each object in the given
+        image to its x, y coordinates.  The coordinates of the most recently
+        used COORDS_CACHE_SIZE images are cached.
+        '''
+        imKey = tuple(imKey)
+        with self.lock:
+            if imKey in self.coords_cache:
+                image_coords = self.coords_cache.pop(imKey)
+                self.coords_cache[imKey] = image_coords
+                return image_coords
+        select = 'SELECT '+p.object_id+', '+p.cell_x_loc+', '+p.cell_y_loc+' FROM '+p.object_table+' WHERE '+GetWhereClauseForImages([imKey])
+        image_coords = dict((row[0], tuple(row[1:])) for row in self.execute(select))
+        with self.lock:
+            self.coords_cache[imKey] = image_coords
+            while len(self.coords_cache) > COORDS_CACHE_SIZE:
+                self.coords_cache.popitem(last=False)
+        return image_coords
+
     def GetAllObjectCoordsFromImage(self, imKey):
         ''' Returns a list of lists x, y coordinates for all objects in the given image. '''
-        select = 'SELECT '+p.cell_x_loc+', '+p.cell_y_loc+' FROM '+p.object_table+' WHERE '+GetWhereClauseForImages([imKey])+' ORDER BY '+p.object_id
-        return self.execute(select)
+        image_coords = self.GetObjectCoordsByImage(imKey)
+        return [image_coords[obId] for obId in sorted(image_coords)]
 
     def GetObjectNear(self, imkey, x, y, silent=False):
         ''' Returns obKey of the closest object to x, y in an image. '''
@@ -1135,6 +1648,68 @@ class DBConnect(Singleton):
         values = [x if type(x) in [int, long, float] else 0.0 for x in data[0]]
         return np.array(values)
 
+    def GetCellsData(self, obKeys, callback=None):
+        '''
+        Returns a len(obKeys) x ncolumns array of measurements for the given
+        objects in the order given.  As in GetCellData, non-numeric columns
+        and NULL measurements are returned as 0.  Rows of objects that are
+        not found are NaN.
+        callback -- function to update with the fraction complete
+        '''
+        colnames = self.GetColumnNames(p.object_table)
+        coltypes = self.GetColumnTypes(p.object_table)
+        select = ['`%s`'%(col) if coltype in [int, long, float] else '0' 
+                  for col, coltype in zip(colnames, coltypes)]
+        return self._get_objects_data(obKeys, select, callback)
+
+    def GetCellsDataForClassifier(self, obKeys, callback=None):
+        '''
+        Returns a len(obKeys) x ncolumns array of the classifier measurements
+        (see GetCellDataForClassifier) for the given objects in the order 
+        given.  NULL measurements are returned as 0, as in GetCellData, so
+        that they can't reach the classifiers as NaN.  Rows of objects that
+        are not found are NaN.
+        callback -- function to update with the fraction complete
+        '''
+        if (self.classifierColNames == None):
+            self.GetColnamesForClassifier()
+        select = ['`%s`'%(col) for col in self.classifierColNames]
+        return self._get_objects_data(obKeys, select, callback)
+
+    def _get_objects_data(self, obKeys, select, callback=None, chunk_size=1000):
+        '''
+        Fetches the select expressions for many objects using one query per
+        chunk_size objects rather than one per object.
+        Returns a float array with a row for each of obKeys in order, with 0
+        for NULL values and NaN rows for objects that are not found.
+        '''
+        positions = {}
+        for i, obKey in enumerate(obKeys):
+            positions.setdefault(tuple(obKey), []).append(i)
+        data = np.empty((len(obKeys), len(select)))
+        data.fill(np.nan)
+        nkeycols = len(object_key_columns())
+        unique_keys = sorted(positions.keys())
+        nfound = 0
+        for start in xrange(0, len(unique_keys), chunk_size):
+            chunk = unique_keys[start:start+chunk_size]
+            query = 'SELECT %s, %s FROM %s WHERE %s'%(
+                        UniqueObjectClause(), ', '.join(select), p.object_table, 
+                        GetWhereClauseForObjectsByImage(chunk))
+            columns = self.execute_columns(query, dtypes=['i8'] * nkeycols + ['f8'] * len(select), 
+                                           silent=True)
+            values = np.column_stack(columns[nkeycols:])
+            values[np.isnan(values)] = 0.0
+            for row, obKey in enumerate(zip(*[col.tolist() for col in columns[:nkeycols]])):
+                if obKey in positions:
+                    data[positions[obKey]] = values[row]
+                    nfound += 1
+            if callback is not None:
+                callback((start + len(chunk)) / float(len(unique_keys)))
+        if nfound < len(unique_keys):
+            logging.error('No data for %d of %d objects'%(len(unique_keys) - nfound, len(unique_keys)))
+        return data
+
     def GetPlateNames(self):
         '''
         Returns the names of each plate in the per-image table.
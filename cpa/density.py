@@ -225,7 +225,8 @@ class DataSourcePanel(wx.Panel):
         if self.filter != None:
             q.add_filter(self.filter)
             
-        return db.execute(str(q))
+        x, y = db.execute_columns(str(q), dtypes=['f8', 'f8'])
+        return np.column_stack((x, y))
         
     def save_settings(self):
         '''save_settings is called when saving a workspace to file.
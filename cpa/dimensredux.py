@@ -570,22 +570,9 @@ class PlotMain(wx.Frame):
          
         all_keys = map(db.GetObjectsFromImage, db.GetAllImageKeys())
 
-        obj_counts = db.GetPerImageObjectCounts()
-        total_obj_count = sum(k[1] for k in obj_counts) 
-
-        for key in all_keys:
-            if key:
-                measurements = len(db.GetCellDataForClassifier(key[0]))
-                break
-
-        data = np.zeros((total_obj_count, measurements))
-        data_dic = {}
         key_list = [key for image_keys in all_keys for key in image_keys]
-        nKeys = float(len(key_list))
-        for index, key in enumerate(key_list):
-            cb(index / nKeys)
-            data[index, :] = db.GetCellDataForClassifier(key)
-            data_dic[index] = key
+        data = db.GetCellsDataForClassifier(key_list, callback=cb)
+        data_dic = dict(enumerate(key_list))
 
         return data, data_dic
 
@@ -3,6 +3,9 @@ import dbconnect
 import logging
 import multiclasssql
 import numpy as np
+import itertools
+from fastgentleboostingworkermulticlass import fit_weak_learner, num_workers, presort_subset, presort_values, train_weak_learners, train_weak_learner
+from multiprocessing.pool import ThreadPool
 import matplotlib.pyplot as plt
 from sys import stdin, stdout, argv, exit
 from time import time
@@ -13,6 +16,8 @@ class FastGentleBoosting(object):
         self.model = None
         self.classBins = []
         self.classifier = classifier
+        self.samplers = {}
+        self.sampler_model = None
 
     def CheckProgress(self):
         import wx
@@ -58,7 +63,8 @@ class FastGentleBoosting(object):
                 # JK - Start Modification
                 xvalid_50 += self.XValidate(
                     self.classifier.trainingSet.colnames, nRules, self.classifier.trainingSet.label_matrix,
-                    self.classifier.trainingSet.values, 2, groups, progress_callback
+                    self.classifier.trainingSet.values, 2, groups, progress_callback,
+                    n_workers=self.classifier.nWorkersSpin.GetValue()
                 )
                 # JK - End Modification
 
@@ -71,7 +77,8 @@ class FastGentleBoosting(object):
             # JK - Start Modification
             xvalid_95 = self.XValidate(
                 self.classifier.trainingSet.colnames, nRules, self.classifier.trainingSet.label_matrix,
-                self.classifier.trainingSet.values, 20, groups, progress_callback
+                self.classifier.trainingSet.values, 20, groups, progress_callback,
+                n_workers=self.classifier.nWorkersSpin.GetValue()
             )
             # JK - End Modification
 
@@ -101,8 +108,22 @@ class FastGentleBoosting(object):
     def ComplexityTxt(self):
         return 'Max # of rules: '
 
-    def CreatePerObjectClassTable(self, labels):
-        multiclasssql.create_perobject_class_table(labels, self.model)
+    def CreatePerObjectClassTable(self, labels, cb=None):
+        multiclasssql.create_perobject_class_table(labels, self.model, cb=cb)
+
+    def FetchObjectsFromClassN(self, obClass, nObjects, imKeys=None):
+        '''
+        Returns up to nObjects random object keys of class obClass (1-based)
+        from the given images, or from the whole experiment if imKeys is
+        None.  The classified objects are kept until the model changes.
+        '''
+        if self.sampler_model is not self.model:
+            self.samplers = {}
+            self.sampler_model = self.model
+        scope = None if imKeys is None else tuple(sorted(imKeys))
+        if scope not in self.samplers:
+            self.samplers[scope] = multiclasssql.ClassSampler(self.model, imKeys)
+        return self.samplers[scope].fetch(obClass, nObjects)
 
     def FilterObjectsFromClassN(self, obClass, obKeysToTry):
         return multiclasssql.FilterObjectsFromClassN(obClass, self.model, obKeysToTry)
@@ -168,13 +189,19 @@ class FastGentleBoosting(object):
         else:
             return ''
 
-    def Train(self, colnames, num_learners, label_matrix, values, fout=None, do_prof=False, test_values=None, callback=None):
+    def Train(self, colnames, num_learners, label_matrix, values, fout=None, do_prof=False, test_values=None, callback=None, n_workers=1, presorted=None, warm_start=None):
         '''
         label_matrix is an n by k numpy array containing values of either +1 or -1
         values is the n by j numpy array of cell measurements
         n = #example cells, k = #classes, j = #measurements
         Return a list of learners.  Each learner is a tuple (column, thresh, a,
         b, average_margin), where column is an integer index into colnames
+        n_workers is the number of cores to search the features with (0 for all)
+        presorted is presort_values(values), if it is already known
+        warm_start is a list of learners from an earlier training on the same
+        columns.  They are kept as the first rules, with a and b refit to the
+        current examples, and num_learners new rounds of boosting follow them
+        on the examples as reweighted by the kept rules.
         '''
         if 0 in values.shape:
             # Nothing to train
@@ -196,15 +223,18 @@ class FastGentleBoosting(object):
             num_examples_class = sum(classmask)
             weights[np.tile(classmask, (1, num_classes))] /= num_examples_class
         balancing = weights.copy()
-
-        def GetOneWeakLearner(ctl=None, tlbi=None):
-            best_error = float(np.Infinity)
-            for feature_idx in range(values.shape[1]):
-                thresh, err, a, b = self.TrainWeakLearner(label_matrix, weights, values[:, feature_idx])
-                if err < best_error:
-                    best_error = err
-                    bestvals = (err, feature_idx, thresh, a, b)
-            err, column, thresh, a, b = bestvals
+        # sort each feature once, only the weights change between rounds
+        warm_start = list(warm_start or [])
+        total_learners = len(warm_start) + num_learners
+        if presorted is None and num_learners > 0:
+            presorted = presort_values(values)
+
+        def GetOneWeakLearner(ctl=None, tlbi=None, learner=None):
+            if learner is None:
+                column, thresh, err, a, b = train_weak_learners(label_matrix, weights, presorted, n_workers=n_workers)
+            else:
+                column, thresh = list(colnames).index(learner[0]), learner[1]
+                err, a, b = fit_weak_learner(label_matrix, weights, values[:, column], thresh)
             # recompute weights
             delta = np.reshape(values[:, column] > thresh, (num_examples, 1))
             feature_thresh_mask = np.tile(delta, (1, num_classes))
@@ -224,11 +254,12 @@ class FastGentleBoosting(object):
             return (err, colnames[int(column)], thresh, a, b, reweights, recomputed_labels, adjustment)
 
         self.model = []
-        for weak_count in range(num_learners):
+        for weak_count in range(total_learners):
+            learner = warm_start[weak_count] if weak_count < len(warm_start) else None
             if do_tests:
-                err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = GetOneWeakLearner(ctl=computed_test_labels, tlbi=test_labels_by_iteration)
+                err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = GetOneWeakLearner(ctl=computed_test_labels, tlbi=test_labels_by_iteration, learner=learner)
             else:
-                err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = GetOneWeakLearner()
+                err, colname, thresh, a, b, reweight, recomputed_labels, adjustment = GetOneWeakLearner(learner=learner)
 
             # compute margins
             step_correct_class = adjustment[label_matrix > 0].reshape((num_examples, 1))
@@ -242,7 +273,7 @@ class FastGentleBoosting(object):
             self.model += [(colname, thresh, a, b, expected_worst_margin)]
 
             if callback is not None:
-                callback(weak_count / float(num_learners))
+                callback(weak_count / float(total_learners))
 
             if fout:
                 colname, thresh, a, b, e_m = self.model[-1]
@@ -271,54 +302,7 @@ class FastGentleBoosting(object):
         values is Nx1
         '''
 
-        global order, s_values, s_labels, s_weights, s_weights_times_labels, num_a, den_a, a, b, sless0, sgrtr0, w_below_neg, w_below_pos, w_above_neg, w_above_pos, J
-
-        # Sort labels and weights by values (AKA possible thresholds).  By
-        # default, argsort is not stable, so the results will vary
-        # slightly with the number of workers.  Add kind="mergesort" to
-        # get a stable sort, which avoids this.
-        order = np.argsort(values)
-        s_values = values[order, :]
-        s_labels = labels[order, :]
-        s_weights = weights[order, :]
-
-        # useful subfunction
-        num_examples = labels.shape[0]
-        def tilesum(a):
-            return np.tile(np.sum(a, axis=0), (num_examples, 1))
-
-        # Equations 9 and 10 of Torralba et al.
-        s_weights_times_labels = s_weights * s_labels
-        num_a = (tilesum(s_weights_times_labels) - np.cumsum(s_weights_times_labels, axis=0))
-        den_a = (tilesum(s_weights) - np.cumsum(s_weights, axis=0))
-        den_a[den_a <= 0.0] = 1.0 # avoid div by zero
-        a = num_a / den_a
-        b = np.cumsum(s_weights_times_labels, axis=0) / np.cumsum(s_weights, axis=0)
-
-        # We need, at each index, the total weights below and above,
-        # separated by positive and negative label.  Below includes the
-        # current index
-        sless0 = (s_labels < 0)
-        sgrtr0 = (s_labels > 0)
-        w_below_neg = np.cumsum(s_weights * sless0, axis=0)
-        w_below_pos = np.cumsum(s_weights * sgrtr0, axis=0)
-        w_above_neg = tilesum(s_weights * sless0) - w_below_neg
-        w_above_pos = tilesum(s_weights * sgrtr0) - w_below_pos
-
-        # Now evaluate the error at each threshold.
-        # (see Equation 7, and note that we're assuming -1 and +1 for entries in the label matrix.
-        J = w_below_neg * ((-1 - b)**2) + w_below_pos * ((1 - b)**2) + w_above_neg * ((-1 - a)**2) + w_above_pos * ((1 - a)**2)
-        J = J.sum(axis=1)
-
-        # Find index of least error
-        idx = np.argmin(J)
-
-        # make sure we're at the top of this thresh
-        while (idx+1 < len(s_values)) and (s_values[idx] == s_values[idx + 1]):
-            idx += 1
-
-        # return the threshold at that index
-        return s_values[idx], J[idx], a[idx, :].copy(), b[idx, :].copy()
+        return train_weak_learner(labels, weights, values)
 
     def UpdateBins(self, classBins):
         self.classBins = classBins
@@ -340,7 +324,13 @@ class FastGentleBoosting(object):
         print "Note that if one learner is sufficient, only one will be written."
         exit(1)
 
-    def XValidate(self, colnames, num_learners, label_matrix, values, folds, group_labels, progress_callback):
+    def XValidate(self, colnames, num_learners, label_matrix, values, folds, group_labels, progress_callback, n_workers=1):
+        '''
+        Returns [the number of holdout misclassifications after each rule],
+        summed over the folds.  The folds are trained concurrently by
+        n_workers threads (0 for all cores), and share one presorting of
+        values.  progress_callback is called from this thread as folds finish.
+        '''
         # if everything's in the same group, ignore the labels
         if all([g == group_labels[0] for g in group_labels]):
             group_labels = range(len(group_labels))
@@ -354,6 +344,7 @@ class FastGentleBoosting(object):
         num_misclassifications = np.zeros(num_learners, int)
 
         # break into folds, randomly, but with all identical group_labels together
+        holdouts = []
         for f in range(folds):
             current_holdout = [False] * len(group_labels)
             while unique_labels and (sum(current_holdout) < fold_min_size):
@@ -363,23 +354,42 @@ class FastGentleBoosting(object):
             if sum(current_holdout) == 0:
                 print "no holdout"
                 break
+            holdouts.append(np.array(current_holdout))
+
+        presorted = presort_values(values)
 
+        def train_fold(current_holdout):
             holdout_idx = np.nonzero(current_holdout)[0]
-            current_holdin = ~ np.array(current_holdout)
-            holdin_idx = np.nonzero(current_holdin)[0]
-            holdin_labels = label_matrix[holdin_idx, :]
-            holdin_values = values[holdin_idx, :]
-            holdout_values = values[holdout_idx, :]
-            holdout_results = self.Train(colnames, num_learners, holdin_labels, holdin_values, test_values=holdout_values)
+            holdin_idx = np.nonzero(~ current_holdout)[0]
+            # a model per fold, so the folds don't share (or replace) self.model
+            holdout_results = FastGentleBoosting(self.classifier).Train(
+                colnames, num_learners, label_matrix[holdin_idx, :], values[holdin_idx, :],
+                test_values=values[holdout_idx, :], presorted=presort_subset(presorted, holdin_idx))
             if holdout_results is None:
                 return None
             # pad the end of the holdout set with the last element
             if len(holdout_results) < num_learners:
                 holdout_results += [holdout_results[-1]] * (num_learners - len(holdout_results))
             holdout_labels = label_matrix[holdout_idx, :].argmax(axis=1)
-            num_misclassifications += [sum(hr != holdout_labels) for hr in holdout_results]
-            if progress_callback:
-                progress_callback(f / float(folds))
+            return [sum(hr != holdout_labels) for hr in holdout_results]
+
+        n_workers = min(num_workers(n_workers), len(holdouts))
+        pool = ThreadPool(n_workers) if n_workers > 1 else None
+        try:
+            if pool is None:
+                results = itertools.imap(train_fold, holdouts)
+            else:
+                results = pool.imap_unordered(train_fold, holdouts)
+            for done, fold_misclassifications in enumerate(results):
+                if fold_misclassifications is None:
+                    return None
+                num_misclassifications += fold_misclassifications
+                if progress_callback:
+                    progress_callback((done + 1) / float(folds))
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
         return [num_misclassifications]
 
@@ -1,15 +1,17 @@
 from numpy import *
 import sys
-from fastgentleboostingworkermulticlass import train_weak_learner
+from fastgentleboostingworkermulticlass import presort_values, train_weak_learners
 
 
-def train(colnames, num_learners, label_matrix, values, fout=None, do_prof=False, test_values=None, callback=None):
+def train(colnames, num_learners, label_matrix, values, fout=None, do_prof=False, test_values=None, callback=None, n_workers=1, presorted=None):
     '''
     label_matrix is an n by k numpy array containing values of either +1 or -1
     values is the n by j numpy array of cell measurements
     n = #example cells, k = #classes, j = #measurements
     Return a list of learners.  Each learner is a tuple (column, thresh, a, b, average_margin),
     where column is an integer index into colnames
+    n_workers is the number of cores to search the features with (0 for all)
+    presorted is presort_values(values), if it is already known
     '''
     if 0 in values.shape:
         # Nothing to train
@@ -31,15 +33,12 @@ def train(colnames, num_learners, label_matrix, values, fout=None, do_prof=False
         num_examples_class = sum(classmask)
         weights[tile(classmask, (1, num_classes))] /= num_examples_class
     balancing = weights.copy()
+    # sort each feature once, only the weights change between rounds
+    if presorted is None:
+        presorted = presort_values(values)
     
     def get_one_weak_learner(ctl=None, tlbi=None):
-        best_error = float(Infinity)
-        for feature_idx in range(values.shape[1]):
-            thresh, err, a, b = train_weak_learner(label_matrix, weights, values[:, feature_idx])
-            if err < best_error:
-                best_error = err
-                bestvals = (err, feature_idx, thresh, a, b)
-        err, column, thresh, a, b = bestvals
+        column, thresh, err, a, b = train_weak_learners(label_matrix, weights, presorted, n_workers=n_workers)
         # recompute weights
         delta = reshape(values[:, column] > thresh, (num_examples, 1))
         feature_thresh_mask = tile(delta, (1, num_classes))
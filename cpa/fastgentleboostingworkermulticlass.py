@@ -3,73 +3,221 @@
 # Worker script called from FastGentleBoosting.py.
 
 from sys import stdin, stdout, stderr, argv, exit
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import threading
 from numpy import *
 
-def train_weak_learner(labels, weights, values):
-    ''' For a multiclass training set, with C classes and N examples,
-    finds the optimal weak learner in O(M * N logN) time.
-    Optimality is defined by Eq. 7 of Torralba et al., 'Sharing visual
-    features...', 2007, IEEE PAMI.
-    
-    We differ from Torralba et al. in two ways:
-    - we do not share a's and b's between classes
-    - we always solve for the complete set of examples, regardless of label
-    
-    Labels should be 1 and -1, only.  
-    label_matrix and weights are NxC.
-    values is Nx1
+_pools = {}
+_pools_lock = threading.Lock()
+
+def num_workers(n_workers=None):
+    ''' Returns n_workers, or the number of cores if it is None or 0. '''
+    if not n_workers:
+        return cpu_count()
+    return max(1, n_workers)
+
+def get_pool(n_workers):
+    ''' Returns a pool of n_workers threads, shared by all training runs,
+    or None for a single worker.  Threads see the training arrays without
+    copying them, and numpy releases the GIL in the sorting, cumulative
+    sums and arithmetic that make up the search.
     '''
+    n_workers = num_workers(n_workers)
+    if n_workers == 1:
+        return None
+    with _pools_lock:
+        if n_workers not in _pools:
+            _pools[n_workers] = ThreadPool(n_workers)
+        return _pools[n_workers]
 
-    global order, s_values, s_labels, s_weights, s_weights_times_labels, num_a, den_a, a, b, sless0, sgrtr0, w_below_neg, w_below_pos, w_above_neg, w_above_pos, J
+def presort_values(values):
+    ''' Sorts every column of values (NxM) once, so the weak learners of
+    all boosting rounds can be found without sorting again.  values may
+    also be a single column (Nx1 or N).
+    Returns (order, s_values, run_end): the stable sort order of each
+    column, the sorted values, and for each sorted position the last
+    position holding the same value.
+    '''
+    values = asarray(values)
+    if values.ndim == 1:
+        values = values.reshape((len(values), 1))
+    num_examples, num_columns = values.shape
+    # A stable sort keeps the results independent of how the columns are
+    # split up.
+    order = argsort(values, axis=0, kind='mergesort')
+    s_values = values[order, arange(num_columns)]
+    return order, s_values, _run_ends(s_values)
 
-    # Sort labels and weights by values (AKA possible thresholds).  By
-    # default, argsort is not stable, so the results will vary
-    # slightly with the number of workers.  Add kind="mergesort" to
-    # get a stable sort, which avoids this.
-    order = argsort(values)
-    s_values = values[order, :]
-    s_labels = labels[order, :]
-    s_weights = weights[order, :]
+def presort_subset(presorted, rows):
+    ''' Returns presort_values(values[rows]) given presorted, the result of
+    presort_values(values), without sorting again.  rows must be sorted
+    row indices without repeats (or a boolean mask).
+    '''
+    order, s_values, run_end = presorted
+    keep = zeros(order.shape[0], bool)
+    keep[rows] = True
+    # the new index of each kept row
+    new_index = cumsum(keep) - 1
+    # Dropping rows from a stable sort leaves a stable sort of the rest,
+    # take the kept positions column by column.
+    kept = keep[order].T
+    num_columns, num_kept = order.shape[1], keep.sum()
+    sub_order = ascontiguousarray(new_index[order.T[kept]].reshape((num_columns, num_kept)).T)
+    sub_values = ascontiguousarray(s_values.T[kept].reshape((num_columns, num_kept)).T)
+    return sub_order, sub_values, _run_ends(sub_values)
 
-    # useful subfunction
-    num_examples = labels.shape[0]
-    def tilesum(a):
-        return tile(sum(a, axis=0), (num_examples, 1))
+def presort_append(presorted, new_values):
+    ''' Returns presort_values(vstack((values, new_values))) given
+    presorted, the result of presort_values(values).  Only the new rows
+    are sorted, and then merged into each column.
+    '''
+    order, s_values, run_end = presorted
+    new_values = asarray(new_values)
+    if new_values.ndim == 1:
+        new_values = new_values.reshape((len(new_values), 1))
+    num_examples, num_columns = order.shape
+    new_order, new_sorted, ignore = presort_values(new_values)
+    merged_order = empty((num_examples + len(new_values), num_columns), order.dtype)
+    merged_values = empty(merged_order.shape, s_values.dtype)
+    for column in range(num_columns):
+        # After the old rows holding the same value, as in a stable sort
+        # of the appended rows.
+        pos = searchsorted(s_values[:, column], new_sorted[:, column], side='right')
+        merged_order[:, column] = insert(order[:, column], pos, new_order[:, column] + num_examples)
+        merged_values[:, column] = insert(s_values[:, column], pos, new_sorted[:, column])
+    return merged_order, merged_values, _run_ends(merged_values)
+
+def _run_ends(s_values):
+    ''' For each position of the sorted columns, the last position holding
+    the same value. '''
+    num_examples = s_values.shape[0]
+    is_end = ones(s_values.shape, bool)
+    is_end[:-1] = (s_values[1:] != s_values[:-1])
+    positions = arange(num_examples).reshape((num_examples, 1))
+    return minimum.accumulate(where(is_end, positions, num_examples)[::-1], axis=0)[::-1]
+
+def weak_learner_errors(labels, weights, order):
+    ''' Evaluates the error of every threshold of a block of B columns,
+    given their sort order (NxB).  Returns J (NxB), the error when
+    thresholding above each sorted position, and the matching a and b
+    (NxBxC).  See train_weak_learner.
+    '''
+    # Sort labels and weights by values (AKA possible thresholds)
+    s_labels = labels[order]
+    s_weights = weights[order]
 
     # Equations 9 and 10 of Torralba et al.
     s_weights_times_labels = s_weights * s_labels
-    num_a = (tilesum(s_weights_times_labels) - cumsum(s_weights_times_labels, axis=0))
-    den_a = (tilesum(s_weights) - cumsum(s_weights, axis=0))
+    cum_weights_times_labels = cumsum(s_weights_times_labels, axis=0)
+    cum_weights = cumsum(s_weights, axis=0)
+    num_a = (s_weights_times_labels.sum(axis=0) - cum_weights_times_labels)
+    den_a = (s_weights.sum(axis=0) - cum_weights)
     den_a[den_a <= 0.0] = 1.0 # avoid div by zero
     a = num_a / den_a
-    b = cumsum(s_weights_times_labels, axis=0) / cumsum(s_weights, axis=0)
+    b = cum_weights_times_labels / cum_weights
 
     # We need, at each index, the total weights below and above,
     # separated by positive and negative label.  Below includes the
     # current index
-    sless0 = (s_labels < 0)
-    sgrtr0 = (s_labels > 0)
-    w_below_neg = cumsum(s_weights * sless0, axis=0)
-    w_below_pos = cumsum(s_weights * sgrtr0, axis=0)
-    w_above_neg = tilesum(s_weights * sless0) - w_below_neg
-    w_above_pos = tilesum(s_weights * sgrtr0) - w_below_pos
+    s_weights_neg = s_weights * (s_labels < 0)
+    s_weights_pos = s_weights * (s_labels > 0)
+    w_below_neg = cumsum(s_weights_neg, axis=0)
+    w_below_pos = cumsum(s_weights_pos, axis=0)
+    w_above_neg = s_weights_neg.sum(axis=0) - w_below_neg
+    w_above_pos = s_weights_pos.sum(axis=0) - w_below_pos
 
     # Now evaluate the error at each threshold.
     # (see Equation 7, and note that we're assuming -1 and +1 for entries in the label matrix.
     J = w_below_neg * ((-1 - b)**2) + w_below_pos * ((1 - b)**2) + w_above_neg * ((-1 - a)**2) + w_above_pos * ((1 - a)**2)
-    J = J.sum(axis=1)
+    return J.sum(axis=2), a, b
+
+def fit_weak_learner(labels, weights, values, thresh):
+    ''' Returns (err, a, b) of the weak learner that thresholds values (a
+    single column) at thresh, with the a and b that are optimal for the
+    given weights.  Used to keep an earlier weak learner when the training
+    set changes.  See train_weak_learner.
+    '''
+    above = (asarray(values) > thresh).reshape((len(labels), 1))
+    w_above = weights * above
+    w_below = weights * (~ above)
+    den_a = w_above.sum(axis=0)
+    den_b = w_below.sum(axis=0)
+    den_a[den_a <= 0.0] = 1.0 # avoid div by zero
+    den_b[den_b <= 0.0] = 1.0
+    a = (w_above * labels).sum(axis=0) / den_a
+    b = (w_below * labels).sum(axis=0) / den_b
+    # Equation 7 of Torralba et al., with -1 and +1 labels
+    err = (w_below * (labels < 0) * (-1 - b)**2 + w_below * (labels > 0) * (1 - b)**2 +
+           w_above * (labels < 0) * (-1 - a)**2 + w_above * (labels > 0) * (1 - a)**2).sum()
+    return err, a, b
+
+def train_weak_learners(labels, weights, presorted, block_size=None, n_workers=1):
+    ''' Finds the optimal weak learner over all columns of values, which
+    have been sorted once by presort_values.  The columns are evaluated
+    a block at a time, keeping the temporaries to about block_size * N * C
+    elements per worker.  With n_workers > 1 (0 or None for all cores)
+    the blocks are spread over a thread pool; the result does not depend
+    on the number of workers.
+    Returns (column, thresh, err, a, b) for the column of least error, or
+    None if no threshold has a finite error.
+    '''
+    order, s_values, run_end = presorted
+    num_examples, num_columns = order.shape
+    num_classes = labels.shape[1]
+    pool = get_pool(n_workers)
+    if block_size is None:
+        # share the memory budget between the workers
+        block_size = max(1, 2**20 // (num_examples * num_classes * num_workers(n_workers)))
 
-    # Find index of least error
-    idx = argmin(J)
+    def best_in_block(start):
+        stop = min(start + block_size, num_columns)
+        J, a, b = weak_learner_errors(labels, weights, order[:, start:stop])
+        columns = arange(stop - start)
+        # Find index of least error, at the top of its thresh
+        idx = run_end[argmin(J, axis=0), columns + start]
+        errors = J[idx, columns]
+        errors[isnan(errors)] = Infinity
+        k = argmin(errors)
+        return (errors[k], start + k, s_values[idx[k], start + k],
+                a[idx[k], k, :].copy(), b[idx[k], k, :].copy())
 
-    # make sure we're at the top of this thresh
-    while (idx+1 < len(s_values)) and (s_values[idx] == s_values[idx + 1]):
-        idx += 1
+    starts = range(0, num_columns, block_size)
+    if pool is None:
+        results = map(best_in_block, starts)
+    else:
+        results = pool.map(best_in_block, starts)
 
-    # return the threshold at that index
-    return s_values[idx], J[idx], a[idx, :].copy(), b[idx, :].copy()
+    # blocks are compared in column order, so ties go to the first column
+    best_error = float(Infinity)
+    bestvals = None
+    for err, column, thresh, a, b in results:
+        if err < best_error:
+            best_error = err
+            bestvals = (column, thresh, err, a, b)
+    return bestvals
 
-def train_classifier(labels, values, iterations):
+def train_weak_learner(labels, weights, values):
+    ''' For a multiclass training set, with C classes and N examples,
+    finds the optimal weak learner in O(M * N logN) time.
+    Optimality is defined by Eq. 7 of Torralba et al., 'Sharing visual
+    features...', 2007, IEEE PAMI.
+    
+    We differ from Torralba et al. in two ways:
+    - we do not share a's and b's between classes
+    - we always solve for the complete set of examples, regardless of label
+    
+    Labels should be 1 and -1, only.  
+    label_matrix and weights are NxC.
+    values is Nx1
+
+    To search many columns, presort them with presort_values and use
+    train_weak_learners instead.
+    '''
+    column, thresh, err, a, b = train_weak_learners(labels, weights, presort_values(values))
+    return thresh, err, a, b
+
+def train_classifier(labels, values, iterations, n_workers=1):
     # make sure these are arrays (not matrices)
     labels = array(labels)
     values = array(values)
@@ -79,17 +227,9 @@ def train_classifier(labels, values, iterations):
     learners = []
     weights = ones(labels.shape)
     output = zeros(labels.shape)
+    presorted = presort_values(values)
     for n in range(iterations):
-        best_error = float(Infinity)
-        
-        for feature_idx in range(values.shape[1]):
-            val, err, a, b = train_weak_learner(labels, weights, values[:, feature_idx])
-            if err < best_error:
-                best_error = err
-                best_idx = feature_idx
-                best_val = val
-                best_a = a
-                best_b = b
+        best_idx, best_val, best_error, best_a, best_b = train_weak_learners(labels, weights, presorted, n_workers=n_workers)
         
         delta = values[:, best_idx] > best_val
         delta.shape = (len(delta), 1)
@@ -115,6 +255,7 @@ def doit():
     num_classes = myfromfile(stdin, int32, (1,))[0]
     values = myfromfile(stdin, float32, (n, ncols))
     label_matrix = myfromfile(stdin, int32, (n, num_classes))
+    presorted = presort_values(values)
 
     while True:
         # It would be cleaner to tell the worker we're done by just
@@ -125,16 +266,7 @@ def doit():
             return
         weights = myfromfile(stdin, float32, (n, num_classes))
 
-        best = float(Infinity)
-        for column in range(ncols):
-            colvals = values[:, column]
-            # print >>stderr, "WORK", column, label_matrix, weights, colvals
-            thresh, err, a, b = train_weak_learner(label_matrix, weights, colvals)
-            if err < best:
-                best = err
-                bestvals = (err, column, thresh, a, b)
-
-        err, column, thresh, a, b = bestvals
+        column, thresh, err, a, b = train_weak_learners(label_matrix, weights, presorted)
         array([err, column, thresh], float32).tofile(stdout)
         a.astype(float32).tofile(stdout)
         b.astype(float32).tofile(stdout)
@@ -0,0 +1,130 @@
+'''
+A thread-safe least-recently-used cache for the channel images read by
+imagetools.FetchImage.
+
+The cache is bounded both by the number of images and by the bytes they
+take up, since multi-channel 16-bit images vary a lot in size.  Threads that
+ask for an image that another thread is already reading wait for that read
+instead of starting their own.
+'''
+import threading
+from collections import OrderedDict
+
+def images_nbytes(imgs):
+    ''' Returns the bytes taken up by a list of channel arrays. '''
+    return sum([im.nbytes for im in imgs])
+
+class _Read(object):
+    ''' A read in progress that other threads can wait for. '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.failed = False
+
+class ImageCache(object):
+    '''
+    Maps image keys to lists of channel arrays.
+    max_items: the most images to keep (None for no limit)
+    max_bytes: the most bytes to keep (None for no limit)
+    sizeof: function returning the bytes taken up by a value
+    The most recently used image is always kept, even if it alone is over
+    max_bytes.
+    '''
+    def __init__(self, max_items=None, max_bytes=None, sizeof=images_nbytes):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.lock = threading.Lock()
+        # key -> (value, bytes), least recently used first
+        self.entries = OrderedDict()
+        # key -> _Read for the reads in progress
+        self.reads = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, load):
+        '''
+        Returns the value for key, calling load(key) to read it if it isn't
+        cached.  If another thread is already reading it, waits for that
+        read instead.  Errors from load are raised in the reading thread; the
+        waiting threads then try the read themselves.
+        '''
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.hits += 1
+                    entry = self.entries.pop(key)
+                    self.entries[key] = entry
+                    return entry[0]
+                read = self.reads.get(key)
+                if read is None:
+                    self.misses += 1
+                    read = self.reads[key] = _Read()
+                    break
+            read.done.wait()
+            if not read.failed:
+                with self.lock:
+                    self.hits += 1
+                return read.value
+
+        try:
+            value = load(key)
+        except:
+            with self.lock:
+                del self.reads[key]
+            read.failed = True
+            read.done.set()
+            raise
+        size = self.sizeof(value)
+        with self.lock:
+            del self.reads[key]
+            if key in self.entries:
+                self.nbytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.nbytes += size
+            self._evict()
+        read.value = value
+        read.done.set()
+        return value
+
+    def set_limits(self, max_items=None, max_bytes=None):
+        ''' Changes the limits, evicting images if they are now over. '''
+        with self.lock:
+            self.max_items = max_items
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        ''' Drops least recently used images until within the limits. '''
+        while len(self.entries) > 1 and \
+                ((self.max_items is not None and len(self.entries) > self.max_items) or
+                 (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            key, (value, size) = self.entries.popitem(last=False)
+            self.nbytes -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''
+        Returns a dict with the number of images and bytes cached and the
+        hit, miss and eviction counts.  A thread that waited for another
+        thread's read counts as a hit.
+        '''
+        with self.lock:
+            return {'images': len(self.entries),
+                    'bytes': self.nbytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
@@ -8,6 +8,7 @@ import logging
 import bioformats
 from .properties import Properties
 from .errors import ClearException
+from .tiffregion import TiffRegionReader, Unsupported
 
 p = Properties.getInstance()
 
@@ -23,6 +24,56 @@ class ImageReader(object):
         '''
         return self.read_images_via_bioformats(fds)
 
+    def ReadTiles(self, fds, size, positions):
+        '''fds -- list of image filenames
+        size -- (width, height) of the tiles
+        positions -- list of (x, y) tile centers
+        returns a list with a list of channel arrays for each position, like
+        imagetools.Crop on the channels from ReadImages, but reads only the
+        parts of the images around the positions (see tiffregion).
+        Raises tiffregion.Unsupported for images that must be read whole.
+        '''
+        if p.image_rescale or p.rescale_object_coords or p.image_url_prepend:
+            raise Unsupported('Rescaled or downloaded images are read whole')
+        for filename in fds:
+            if os.path.splitext(filename)[1].lower() not in ['.tif', '.tiff']:
+                raise Unsupported('%s is not a TIFF file'%(filename))
+        # the extremes found are kept next to the properties file
+        extremes_file = p.__dict__.get('_filename')
+        if extremes_file:
+            extremes_file += '.extremes'
+        readers = []
+        try:
+            for filename in fds:
+                readers.append(TiffRegionReader(filename))
+            if len(set([reader.shape for reader in readers])) > 1:
+                raise Unsupported('The channel images have different sizes')
+            tiles = [[] for pos in positions]
+            for i, reader in enumerate(readers):
+                # scale to [0, 1] the way Bio-Formats does
+                if reader.dtype.kind == 'u' and reader.dtype.itemsize <= 2:
+                    scale = np.float32(np.iinfo(reader.dtype).max)
+                elif reader.dtype.kind == 'f':
+                    scale = np.float32(1)
+                else:
+                    raise Unsupported('%s has %s samples'%(reader.filename, reader.dtype))
+                channels = int(p.channels_per_image[i])
+                if reader.samples < channels:
+                    raise Unsupported('%s has %d channels'%(reader.filename, reader.samples))
+                lo, hi = reader.extremes(extremes_file)
+                for tile, pos in zip(tiles, positions):
+                    crop = reader.read_crop(size, pos).astype('float32') / scale
+                    for j in range(channels):
+                        channel = np.array(crop[:, :, j])
+                        # XXX - hack to make scaling work per-image instead of per-tile
+                        channel[0, 0] = lo[j] / scale
+                        channel[-1, -1] = hi[j] / scale
+                        tile.append(channel)
+            return tiles
+        finally:
+            for reader in readers:
+                reader.close()
+
     def _read_image_via_bioformats(self, filename_or_url):
         # The opener's destructor deletes the temprary files, so the
         # opener must not be GC'ed until the image has been loaded.
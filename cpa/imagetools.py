@@ -7,6 +7,8 @@ import pilfix
 from properties import Properties
 import dbconnect
 from imagereader import ImageReader
+from imagecache import ImageCache
+import tiffregion
 import logging
 import matplotlib.image
 import numpy as np
@@ -15,46 +17,87 @@ import wx
 p = Properties.getInstance()
 db = dbconnect.DBConnect.getInstance()
 
-cache = {}
-cachedkeys = []
+cache = ImageCache()
 
 def FetchTile(obKey):
     '''returns a list of image channel arrays cropped around the object
     coordinates
     '''
-    imKey = obKey[:-1]
-    pos = list(db.GetObjectCoords(obKey))
-    if None in pos:
-        message = ('Failed to load coordinates for object key %s. This may '
-                   'indicate a problem with your per-object table.\n'
-                   'You can check your per-object table "%s" in TableViewer'
-                   %(', '.join(['%s:%s'%(col, val) for col, val in 
-                                zip(dbconnect.object_key_columns(), obKey)]), 
-                   p.object_table))
-        wx.MessageBox(message, 'Error')
-        logging.error(message)
-        return None
-    size = (int(p.image_tile_size), int(p.image_tile_size))
-    # Could transform object coords here
+    return FetchTiles([obKey])[0]
+
+def FetchTiles(obKeys, coords=None):
+    '''returns a list with a list of image channel arrays cropped around
+    each object's coordinates, or None for objects whose coordinates could
+    not be loaded. The objects must all be in the same image, which is read
+    once for all of them.
+    coords: the objects' coordinates if they are already known (see
+        DBConnect.GetObjectsCoords)
+    '''
+    imKey = obKeys[0][:-1]
+    if coords is None:
+        coords = db.GetObjectsCoords(obKeys)
+    for obKey, pos in zip(obKeys, coords):
+        if pos is None:
+            message = ('Failed to load coordinates for object key %s. This may '
+                       'indicate a problem with your per-object table.\n'
+                       'You can check your per-object table "%s" in TableViewer'
+                       %(', '.join(['%s:%s'%(col, val) for col, val in 
+                                    zip(dbconnect.object_key_columns(), obKey)]), 
+                       p.object_table))
+            wx.MessageBox(message, 'Error')
+            logging.error(message)
+    if all([pos is None for pos in coords]):
+        return [None] * len(coords)
+    if imKey not in cache:
+        try:
+            return ReadTiles(imKey, coords)
+        except tiffregion.Unsupported, e:
+            logging.debug('Reading image %s whole: %s'%(imKey, e))
     imgs = FetchImage(imKey)
-    if p.rescale_object_coords:
-        pos[0] *= p.image_rescale[0] / p.image_rescale_from[0]
-        pos[1] *= p.image_rescale[1] / p.image_rescale_from[1]
-    return [Crop(im, size, pos) for im in imgs]
+    return CropTiles(imgs, coords)
+
+def ReadTiles(imKey, coords):
+    '''returns the same tiles as CropTiles(ReadImage(imKey), coords), but
+    reads only the parts of the image files around the objects. Raises
+    tiffregion.Unsupported for images that must be read whole.
+    '''
+    size = (int(p.image_tile_size), int(p.image_tile_size))
+    filenames = db.GetFullChannelPathsForImage(imKey)
+    tiles = ImageReader().ReadTiles(filenames, size, [pos for pos in coords if pos is not None])
+    tiles.reverse()
+    return [None if pos is None else tiles.pop() for pos in coords]
+
+def CropTiles(imgs, coords):
+    '''returns a list with a list of the image channel arrays cropped around
+    each of the given object coordinates (None for coordinates that are None)
+    '''
+    size = (int(p.image_tile_size), int(p.image_tile_size))
+    tiles = []
+    for pos in coords:
+        if pos is None:
+            tiles.append(None)
+            continue
+        # Could transform object coords here
+        pos = list(pos)
+        if p.rescale_object_coords:
+            pos[0] *= p.image_rescale[0] / p.image_rescale_from[0]
+            pos[1] *= p.image_rescale[1] / p.image_rescale_from[1]
+        tiles.append([Crop(im, size, pos) for im in imgs])
+    return tiles
 
 def FetchImage(imKey):
-    global cachedkeys
-    if imKey in cache.keys():
-        return cache[imKey]
-    else:
-        ir = ImageReader()
-        filenames = db.GetFullChannelPathsForImage(imKey)
-        imgs = ir.ReadImages(filenames)                    
-        cache[imKey] = imgs
-        cachedkeys += [imKey]
-        while len(cachedkeys) > int(p.image_buffer_size):
-            del cache[cachedkeys.pop(0)]
-        return cache[imKey]
+    '''returns a list of image channel arrays for the image, read through
+    the image cache (see image_buffer_size and image_buffer_megabytes)
+    '''
+    cache.set_limits(int(p.image_buffer_size or 1),
+                     int(float(p.image_buffer_megabytes or 512) * 2**20))
+    return cache.get(imKey, ReadImage)
+
+def ReadImage(imKey):
+    '''returns a list of image channel arrays read from disk or url'''
+    ir = ImageReader()
+    filenames = db.GetFullChannelPathsForImage(imKey)
+    return ir.ReadImages(filenames)
 
 def ShowImage(imKey, chMap, parent=None, brightness=1.0, scale=1.0, contrast=None):
     from imageviewer import ImageViewer
@@ -1,9 +1,14 @@
+import cPickle
+import hashlib
+import logging
 import numpy
+import os
 import sys
+from multiprocessing.pool import ThreadPool
 import cpa.sqltools
 from dbconnect import *
 from properties import Properties
-from datamodel import DataModel
+from datamodel import DataModel, pack_image_keys
 
 db = DBConnect.getInstance()
 p = Properties.getInstance()
@@ -47,6 +52,71 @@ def translate(weaklearners):
         else:
             class_scores = ['+'.join(['IF(`%s` > %f, %f, %f)'%(feature, threshold, a[i], b[i]) for (feature, threshold, a, b, ignore) in weaklearners]) for i in range(nClasses)]
             return "CASE GREATEST(%s) %s END"%(",".join(class_scores), "\n".join(["WHEN %s THEN %d"%(score, idx+1) for idx, score in enumerate(class_scores)]))
+
+def use_numpy_scoring():
+    '''
+    Returns whether rules should be evaluated in CPA with numpy rather than
+    by the database (see scoring_engine in the properties file).  Numpy is
+    the default for SQLite, where the classifier() function is called from
+    Python once per row.
+    '''
+    if p.scoring_engine:
+        return p.scoring_engine.lower() == 'numpy'
+    return p.db_type.lower() == 'sqlite'
+
+def rule_columns(weaklearners):
+    '''
+    Returns the distinct columns used by the weak learners, and for each
+    weak learner the index of its column in that list.
+    '''
+    columns = []
+    indices = []
+    for wl in weaklearners:
+        if wl[0] not in columns:
+            columns.append(wl[0])
+        indices.append(columns.index(wl[0]))
+    return columns, indices
+
+def classify(weaklearners, values):
+    '''
+    Evaluates the weak learners with numpy.
+    values: an (n x k) array of the columns given by rule_columns, with NaN
+        for NULL values.
+    RETURNS: the 1-based class number of each row, as the classifier
+        expressions made by translate would compute it.
+    '''
+    columns, indices = rule_columns(weaklearners)
+    values = numpy.asarray(values, dtype='f8').reshape((-1, len(columns)))
+    nClasses = len(weaklearners[0][2])
+    scores = numpy.zeros((len(values), nClasses))
+    # Comparisons with NaN are false, so NULLs fall to b like they do in SQL
+    for (feature, threshold, a, b, ignore), column in zip(weaklearners, indices):
+        above = (values[:, column] > threshold).reshape((-1, 1))
+        scores += numpy.where(above, numpy.asarray(a, 'f8'), numpy.asarray(b, 'f8'))
+    return scores.argmax(axis=1) + 1
+
+def _classify_objects(weaklearners, where_clause, extra_columns=[]):
+    '''
+    Fetches the object keys and rule columns of the objects matching 
+    where_clause as arrays, and classifies them with numpy.
+    RETURNS: (key_columns, extra, classes), a list of the object key 
+        column arrays, a list of arrays of the extra_columns, and the 
+        1-based class of each object.
+    '''
+    columns, indices = rule_columns(weaklearners)
+    nKeyCols = len(object_key_columns())
+    result = db.execute_columns('SELECT %s, %s FROM %s WHERE %s'%(
+                                    UniqueObjectClause(p.object_table), 
+                                    ', '.join(columns + list(extra_columns)), 
+                                    p.object_table, where_clause),
+                                dtypes=['i8'] * nKeyCols + ['f8'] * (len(columns) + len(extra_columns)),
+                                silent=True)
+    values = result[nKeyCols:nKeyCols + len(columns)]
+    if len(result[0]) == 0:
+        classes = numpy.zeros(0, dtype='int')
+    else:
+        classes = classify(weaklearners, numpy.column_stack(values))
+    return result[:nKeyCols], result[nKeyCols + len(columns):], classes
     
 
 def FilterObjectsFromClassN(clNum, weaklearners, filterKeys):
@@ -66,8 +136,6 @@ def FilterObjectsFromClassN(clNum, weaklearners, filterKeys):
         reported for each class
     '''
 
-    class_query = translate(weaklearners)
-
     if filterKeys != []:
         if isinstance(filterKeys, str):
             whereclause = filterKeys + " AND"
@@ -80,9 +148,98 @@ def FilterObjectsFromClassN(clNum, weaklearners, filterKeys):
     else:
         whereclause = ""
 
+    if use_numpy_scoring():
+        keys, ignore, classes = _classify_objects(weaklearners, whereclause + ' 1 = 1')
+        keys = numpy.column_stack(keys)[classes == clNum]
+        return [tuple(key) for key in keys.tolist()]
+
+    class_query = translate(weaklearners)
     return db.execute('SELECT '+UniqueObjectClause()+' FROM %s WHERE %s %s=%d '%(p.object_table, whereclause, class_query, clNum))
 
 
+def ObjectsByClass(weaklearners, where_clause):
+    '''
+    Classifies the objects matching where_clause in a single query.
+    RETURNS: A dictionary mapping each 1-based class number to the list of
+        object keys in that class.
+    '''
+    if use_numpy_scoring():
+        keys, ignore, classes = _classify_objects(weaklearners, where_clause)
+        keys = zip(*[k.tolist() for k in keys])
+        classes = classes.tolist()
+    else:
+        rows = db.execute('SELECT %s, %s FROM %s WHERE %s'%(UniqueObjectClause(), translate(weaklearners),
+                                                            p.object_table, where_clause), silent=True)
+        keys = [tuple(row[:-1]) for row in rows]
+        classes = [int(row[-1]) for row in rows]
+    byClass = {}
+    for key, cl in zip(keys, classes):
+        byClass.setdefault(cl, []).append(key)
+    return byClass
+
+class ClassSampler(object):
+    '''
+    Serves random objects of a given class.  Rather than classifying
+    batches of random objects until enough hits are found, whole random
+    images are classified in one query until about reservoir_size objects
+    have been seen, and the hits of every class are kept.  Later fetches are
+    served from those hits, so a sampler must be thrown away when the model
+    changes.  Once every image has been classified, objects that were
+    already served are served again.
+    '''
+    def __init__(self, weaklearners, imKeys=None, reservoir_size=20000):
+        '''
+        imKeys: the images to sample from, or None for the whole experiment
+        reservoir_size: the number of objects to classify at a time
+        '''
+        self.weaklearners = weaklearners
+        self.reservoir_size = reservoir_size
+        if imKeys is None:
+            imKeys = dm.GetAllImageKeys()
+        imKeys = list(imKeys)
+        counts = dm.GetObjectCounts(imKeys)
+        order = numpy.random.permutation(len(imKeys))
+        order = order[counts[order] > 0]
+        self.imKeys = [imKeys[i] for i in order]
+        self.counts = counts[order]
+        self.next_image = 0
+        self.hits = {}      # {clNum: [obKey, ...]} not served yet
+        self.served = {}    # {clNum: [obKey, ...]}
+
+    def done(self):
+        ''' Returns whether all the images have been classified. '''
+        return self.next_image >= len(self.imKeys)
+
+    def classify_more(self):
+        ''' Classifies the objects of the next random images. '''
+        cumsums = numpy.cumsum(self.counts[self.next_image:])
+        stop = self.next_image + numpy.searchsorted(cumsums, self.reservoir_size) + 1
+        batch = self.imKeys[self.next_image:stop]
+        self.next_image = stop
+        logging.info('Classifying the objects of %d images.'%(len(batch)))
+        for clNum, obKeys in ObjectsByClass(self.weaklearners, GetWhereClauseForImages(batch)).items():
+            numpy.random.shuffle(obKeys)
+            self.hits.setdefault(clNum, []).extend(obKeys)
+
+    def fetch(self, clNum, n):
+        '''
+        clNum: 1-based index of the class to retrieve objects from
+        n: the number of objects to retrieve
+        RETURNS: A list of at most n object keys in class clNum.
+        '''
+        hits = self.hits.setdefault(clNum, [])
+        while len(hits) < n and not self.done():
+            self.classify_more()
+        if len(hits) < n:
+            served = self.served.pop(clNum, [])
+            numpy.random.shuffle(served)
+            hits.extend(served)
+        obKeys = hits[:n]
+        del hits[:n]
+        self.served.setdefault(clNum, []).extend(obKeys)
+        return obKeys
+
+
 def object_scores(weaklearners):
     stump_stmnts, score_stmnts, find_max_query, _, _ = \
                   translate(weaklearners)
@@ -99,8 +256,19 @@ def object_scores(weaklearners):
     return numpy.array(map(tuple, res), dtype)
 
 
-def create_perobject_class_table(classnames, rules):
-    ''' Saves object keys and classes to a text file '''
+def create_perobject_class_table(classnames, rules, cb=None):
+    '''
+    Saves object keys and classes to p.class_table.  The objects are
+    classified and inserted one range of images (see _where_clauses) at a
+    time, each range in its own transaction, and the finished ranges are
+    recorded in a bookkeeping table.  If a previous call with the same
+    classes and rules was interrupted, and the object table hasn't changed
+    since (see _objects_version), only the unfinished ranges are classified,
+    after deleting any of their rows that were saved without being recorded
+    (eg: on MyISAM tables, which don't roll back).  The index is built once
+    all the rows are in.
+    cb: callback function to update with the fraction complete
+    '''
     nClasses = len(classnames)
 
     if p.class_table is None:
@@ -109,29 +277,102 @@ def create_perobject_class_table(classnames, rules):
     index_cols = UniqueObjectClause()
     class_cols = UniqueObjectClause() + ', class, class_number'
     class_col_defs = object_key_defs() + ', class VARCHAR (%d)'%(max([len(c) for c in classnames])+1) + ', class_number INT'
-    
-    
-    # Drop must be explicitly asked for Classifier.ScoreAll
-    db.execute('DROP TABLE IF EXISTS %s'%(p.class_table))
-    db.execute('CREATE TABLE %s (%s)'%(p.class_table, class_col_defs))
-    db.execute('CREATE INDEX idx_%s ON %s (%s)'%(p.class_table, p.class_table, index_cols))
-        
-    case_expr = 'CASE %s'%(translate(rules)) + ''.join([" WHEN %d THEN '%s'"%(n+1, classnames[n]) for n in range(nClasses)]) + " END"
-    case_expr2 = 'CASE %s'%(translate(rules)) + ''.join([" WHEN %d THEN '%s'"%(n+1, n+1) for n in range(nClasses)]) + " END"
-    db.execute('INSERT INTO %s (%s) SELECT %s, %s, %s FROM %s'%(p.class_table, class_cols, index_cols, case_expr, case_expr2, p.object_table))
+    chunk_table = '_%s_chunks'%(p.class_table)
+    fingerprint = hashlib.md5(repr((list(classnames), _rules_repr(rules),
+                                    _objects_version(rules)))).hexdigest()
+    index = 'idx_%s'%(p.class_table)
+
+    done = set()
+    if db.table_exists(p.class_table) and db.table_exists(chunk_table):
+        res = db.execute('SELECT where_clause, fingerprint FROM %s'%(chunk_table))
+        if len(res) > 0 and all(fp == fingerprint for where_clause, fp in res):
+            done = set(where_clause for where_clause, fp in res)
+    wheres = _where_clauses(p, dm, None)
+    if done:
+        logging.info('Resuming %s, %d ranges of images were already saved.'%(p.class_table, len(done)))
+        # the interrupted run may have built the index already
+        if p.db_type.lower() == 'sqlite':
+            db.execute('DROP INDEX IF EXISTS %s'%(index))
+        elif db.execute("SHOW INDEX FROM %s WHERE Key_name = '%s'"%(p.class_table, index)):
+            db.execute('DROP INDEX %s ON %s'%(index, p.class_table))
+        pending = [where_clause for where_clause in wheres if where_clause not in done]
+        if pending:
+            db.execute('DELETE FROM %s WHERE %s'%(p.class_table, ' OR '.join(
+                ['(%s)'%(where_clause.replace(p.object_table + '.', p.class_table + '.'))
+                 for where_clause in pending])))
+        db.Commit()
+    else:
+        # Drop must be explicitly asked for Classifier.ScoreAll
+        db.execute('DROP TABLE IF EXISTS %s'%(p.class_table))
+        db.execute('DROP TABLE IF EXISTS %s'%(chunk_table))
+        db.execute('CREATE TABLE %s (%s)'%(p.class_table, class_col_defs))
+        db.execute('CREATE TABLE %s (where_clause TEXT, fingerprint VARCHAR (32))'%(chunk_table))
+        db.Commit()
+
+    if use_numpy_scoring():
+        quoted = ["'%s'"%(c.replace("'", "''")) for c in classnames]
+        def insert_range(where_clause):
+            keys, ignore, classes = _classify_objects(rules, where_clause)
+            rows = ['(%s, %s, %d)'%(','.join(str(k) for k in key), quoted[cl-1], cl)
+                    for key, cl in zip(zip(*[k.tolist() for k in keys]), classes.tolist())]
+            # SQLite accepts at most 500 rows per INSERT
+            for start in range(0, len(rows), 500):
+                db.execute('INSERT INTO %s (%s) VALUES %s'%(p.class_table, class_cols, 
+                                                            ','.join(rows[start:start+500])), 
+                           silent=True)
+    else:
+        case_expr = 'CASE %s'%(translate(rules)) + ''.join([" WHEN %d THEN '%s'"%(n+1, classnames[n]) for n in range(nClasses)]) + " END"
+        case_expr2 = 'CASE %s'%(translate(rules)) + ''.join([" WHEN %d THEN '%s'"%(n+1, n+1) for n in range(nClasses)]) + " END"
+        def insert_range(where_clause):
+            db.execute('INSERT INTO %s (%s) SELECT %s, %s, %s FROM %s WHERE %s'%(p.class_table, class_cols, index_cols, 
+                                                                                 case_expr, case_expr2, p.object_table, 
+                                                                                 where_clause))
+
+    for idx, where_clause in enumerate(wheres):
+        if where_clause not in done:
+            insert_range(where_clause)
+            db.execute("INSERT INTO %s (where_clause, fingerprint) VALUES ('%s', '%s')"%(chunk_table, where_clause, fingerprint))
+            db.Commit()
+        if cb:
+            cb(float(idx + 1) / len(wheres))
+
+    db.execute('CREATE INDEX %s ON %s (%s)'%(index, p.class_table, index_cols))
+    db.execute('DROP TABLE IF EXISTS %s'%(chunk_table))
     db.Commit()
 
 def _objectify(p, field):
     return "%s.%s"%(p.object_table, field)
 
-def _where_clauses(p, dm, filter_name):
-    imkeys = dm.GetAllImageKeys(filter_name)
-    imkeys.sort()
+def _where_clauses(p, dm, filter_name, imkeys=None):
+    '''
+    Splits the images of the filter into ranges.  If imkeys are given, the
+    ranges only cover the images from the first to the last of those keys.
+    '''
+    if imkeys is None or len(imkeys) == 0:
+        wheres = _key_ranges(p, sorted(dm.GetAllImageKeys(filter_name)))
+        return wheres or ['(1 = 1)']
+    imkeys = sorted(imkeys)
+    if p.table_id:
+        lower = "((%s > %d) OR (%s = %d AND %s >= %d))"%(_objectify(p, p.table_id), imkeys[0][0],
+                                                          _objectify(p, p.table_id), imkeys[0][0],
+                                                          _objectify(p, p.image_id), imkeys[0][1])
+        upper = "((%s < %d) OR (%s = %d AND %s <= %d))"%(_objectify(p, p.table_id), imkeys[-1][0],
+                                                          _objectify(p, p.table_id), imkeys[-1][0],
+                                                          _objectify(p, p.image_id), imkeys[-1][1])
+    else:
+        lower = "(%s >= %d)"%(_objectify(p, p.image_id), imkeys[0][0])
+        upper = "(%s <= %d)"%(_objectify(p, p.image_id), imkeys[-1][0])
+    wheres = _key_ranges(p, imkeys)
+    if len(wheres) == 0:
+        return ['%s AND %s'%(lower, upper)]
+    return ['%s AND %s'%(lower, wheres[0])] + wheres[1:]
+
+def _key_ranges(p, imkeys):
     stepsize = max(len(imkeys) / 100, 50)
     key_thresholds = imkeys[-1:1:-stepsize]
     key_thresholds.reverse()
     if len(key_thresholds) == 0:
-        return ['(1 = 1)']
+        return []
     if p.table_id:
         # split each table independently
         def splitter():
@@ -156,11 +397,181 @@ def _where_clauses(p, dm, filter_name):
                  %(_objectify(p, p.image_id), lo[0], _objectify(p, p.image_id), hi[0])
                  for lo, hi in zip(key_thresholds[:-1], key_thresholds[1:])])
     
-def PerImageCounts(weaklearners, filter_name=None, cb=None):
+def _scoring_threads(num_clauses):
+    '''
+    Returns how many image ranges to query at once (see scoring_threads in
+    the properties file).  This is capped by the pooled connections that
+    are free right now, since other threads (eg: the tile loaders) may hold
+    some of them.  With fewer than two free, the ranges are queried one at
+    a time on the caller's own connection.
+    '''
+    n_threads = min(int(p.scoring_threads or 1), num_clauses)
+    if n_threads <= 1:
+        return 1
+    return max(1, min(n_threads, db.get_pool().available()))
+
+def _map_ranges(func, wheres, cb=None):
+    '''
+    Calls func(idx, where_clause) for each of the where clauses and yields
+    the results in order.  Several clauses are run at once, each thread on
+    its own pooled connection (see _scoring_threads).  cb is called with
+    the fraction complete from the calling thread.
+    '''
+    num_clauses = len(wheres)
+    n_threads = _scoring_threads(num_clauses)
+    if n_threads == 1:
+        results = (func(idx, where_clause) for idx, where_clause in enumerate(wheres))
+        pool = None
+    else:
+        def run(args):
+            try:
+                return func(*args)
+            finally:
+                # hand the connection back so the pool can be shared
+                db.release_connection()
+        pool = ThreadPool(n_threads)
+        results = pool.imap(run, enumerate(wheres))
+    try:
+        for idx, result in enumerate(results):
+            yield result
+            if cb:
+                cb(min(1, idx/float(num_clauses)))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+def _objects_version(weaklearners):
+    '''
+    Returns a value that changes when the object table's data for scoring
+    with the weak learners changes, or None if it can't be found.  On MySQL
+    this is the table's modify date.  SQLite only has the modify date of
+    the database file, which changes whenever any table is written (eg: the
+    class table), so there it is a summary of the object table's contents:
+    its row count, largest rowid, and the sums of the columns used in
+    scoring, so that re-measured objects change it too.
+    '''
+    try:
+        if p.db_type.lower() == 'sqlite':
+            columns = rule_columns(weaklearners)[0]
+            if p.area_scoring_column:
+                columns = columns + [p.area_scoring_column]
+            sums = ''.join([', SUM(%s)'%(col) for col in columns])
+            return tuple(db.execute('SELECT COUNT(*), MAX(rowid)%s FROM %s'%
+                                    (sums, p.object_table))[0])
+        return db.get_objects_modify_date()
+    except Exception:
+        return None
+
+def _rules_repr(weaklearners):
+    ''' A string that only depends on the rules (not the margins). '''
+    return repr([(wl[0], float(wl[1]), [float(v) for v in wl[2]], [float(v) for v in wl[3]])
+                 for wl in weaklearners])
+
+# the most ScoreCache files kept in the CPA data directory
+SCORE_CACHE_FILES = 20
+
+class ScoreCache(object):
+    '''
+    The per-image class counts (and area sums) computed for one model,
+    saved in the CPA data directory.  Scoring again with the same rules
+    only has to look the counts up, and changing the filter only scores
+    the images that weren't scored before.  The cache is keyed by the
+    rules, the properties file and the version of the object table (see
+    fingerprint), so it is never used after the data has changed.
+
+    Each update is appended to the file as a pickled dict of the new rows,
+    and only the SCORE_CACHE_FILES most recently used files are kept.
+    '''
+    def __init__(self, weaklearners):
+        self.rows = {}     # {imKey: [Class1_ObjectCount, ..., Class1_Area, ...], ...}
+        self.path = None
+        fingerprint = self.fingerprint(weaklearners)
+        if fingerprint is None:
+            return
+        self.path = os.path.join(get_cpa_data_dir(), 'scores_%s.pickle'%(fingerprint))
+        if os.path.exists(self.path):
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                while True:
+                    try:
+                        self.rows.update(cPickle.load(f))
+                    except EOFError:
+                        break
+            # mark the file as recently used (see _prune)
+            os.utime(self.path, None)
+        except Exception, e:
+            logging.warn('Could not load all cached scores from %s: %s'%(self.path, e))
+            # rewrite the file without the bad record, or later updates
+            # appended after it would be lost as well
+            self._save(self.rows, 'wb')
+
+    def fingerprint(self, weaklearners):
+        ''' Returns a hash of the model and data, or None if the version of
+        the object table can't be found (see _objects_version). '''
+        filename = p.__dict__.get('_filename')
+        if not filename or not os.path.isfile(filename):
+            return None
+        version = _objects_version(weaklearners)
+        if version is None:
+            return None
+        h = hashlib.md5()
+        with open(filename, 'rb') as f:
+            h.update(f.read())
+        h.update(_rules_repr(weaklearners))
+        h.update(repr((p.area_scoring_column, version)))
+        return h.hexdigest()
+
+    def enabled(self):
+        return self.path is not None
+
+    def missing(self, imkeys):
+        ''' Returns the image keys that haven't been scored yet. '''
+        return [imkey for imkey in imkeys if tuple(imkey) not in self.rows]
+
+    def update(self, results):
+        ''' Adds PerImageCounts rows to the cache and saves them. '''
+        nKeyCols = len(image_key_columns())
+        new_rows = dict((tuple(row[:nKeyCols]), list(row[nKeyCols:])) for row in results)
+        self.rows.update(new_rows)
+        is_new = not os.path.exists(self.path)
+        self._save(new_rows, 'ab')
+        if is_new:
+            self._prune()
+
+    def _save(self, rows, mode):
+        try:
+            with open(self.path, mode) as f:
+                cPickle.dump(rows, f, cPickle.HIGHEST_PROTOCOL)
+        except (IOError, OSError), e:
+            logging.warn('Could not save cached scores to %s: %s'%(self.path, e))
+
+    def _prune(self):
+        ''' Deletes all but the SCORE_CACHE_FILES most recently used files. '''
+        dirname = os.path.dirname(self.path)
+        try:
+            files = [os.path.join(dirname, f) for f in os.listdir(dirname)
+                     if f.startswith('scores_') and f.endswith('.pickle')]
+            files.sort(key=os.path.getmtime, reverse=True)
+            for filename in files[SCORE_CACHE_FILES:]:
+                os.remove(filename)
+        except OSError, e:
+            logging.warn('Could not remove old cached scores: %s'%(e))
+
+    def get(self, imkeys):
+        ''' Returns PerImageCounts rows for the given (scored) images. '''
+        return [list(imkey) + self.rows[tuple(imkey)] for imkey in imkeys]
+
+def PerImageCounts(weaklearners, filter_name=None, cb=None, use_cache=True):
     '''
     weaklearners: Weak learners from fastgentleboostingmulticlass.train
     filter: name of filter, or None.
     cb: callback function to update with the fraction complete
+    use_cache: whether to reuse the counts of images already scored with
+        the same rules (see ScoreCache)
     RETURNS: A list of lists of imKeys and respective object counts for each class:
         Note that the imKeys are exploded so each row is of the form:
         [TableNumber, ImageNumber, Class1_ObjectCount, Class2_ObjectCount,...]
@@ -168,9 +579,26 @@ def PerImageCounts(weaklearners, filter_name=None, cb=None):
         If p.area_scoring_column is set, then area scores will be appended to
         the object scores.
     '''
+    imkeys = [imkey for imkey, count in dm.GetImageKeysAndObjectCounts(filter_name)]
+    cache = use_cache and ScoreCache(weaklearners)
+    if not cache or not cache.enabled():
+        return _per_image_counts(weaklearners, filter_name, imkeys, cb)
 
-    # I'm pretty sure this would be even faster if we were to run two
-    # or more parallel threads and split the work between them.
+    missing = cache.missing(imkeys)
+    if missing:
+        logging.info('Scoring %d of %d images, the rest are cached.'%(len(missing), len(imkeys)))
+        cache.update(_per_image_counts(weaklearners, filter_name, missing, cb))
+    return cache.get(imkeys)
+
+def _per_image_counts(weaklearners, filter_name, imkeys, cb=None):
+    '''
+    PerImageCounts for the given images (which must pass the filter),
+    without the cache.
+    '''
+    if use_numpy_scoring():
+        return _per_image_counts_numpy(weaklearners, filter_name, imkeys, cb)
+
+    # The image ranges are split between scoring_threads connections.
     def do_by_steps(class_query, tables, filter_name, result_clauses):
         filter_clause = '1 = 1'
         join_clause = ''
@@ -186,22 +614,19 @@ def PerImageCounts(weaklearners, filter_name=None, cb=None):
                     filter_clause = str(filter)
             if join_table:
                 join_clause = 'JOIN %s USING (%s)' % (join_table, ','.join(image_key_columns()))
-        if cb:
-            result =  []
-            wheres = _where_clauses(p, dm, filter_name)
-            num_clauses = len(wheres)
-            
-            for idx, where_clause in enumerate(wheres):
+        wheres = _where_clauses(p, dm, filter_name, imkeys)
+        if cb or _scoring_threads(len(wheres)) > 1:
+            def count_range(idx, where_clause):
                 if filter_clause is not None:
                     where_clause += ' AND ' + filter_clause
-                result += [db.execute('SELECT %s, %s as class, %s FROM %s '
-                                      '%s WHERE %s GROUP BY %s, class'
-                                      %(UniqueImageClause(p.object_table), 
-                                        class_query, result_clauses, tables, 
-                                        join_clause, where_clause, 
-                                        UniqueImageClause(p.object_table)),
-                                      silent=(idx > 10))]
-                cb(min(1, idx/float(num_clauses)))
+                return db.execute('SELECT %s, %s as class, %s FROM %s '
+                                  '%s WHERE %s GROUP BY %s, class'
+                                  %(UniqueImageClause(p.object_table), 
+                                    class_query, result_clauses, tables, 
+                                    join_clause, where_clause, 
+                                    UniqueImageClause(p.object_table)),
+                                  silent=(idx > 10))
+            result = list(_map_ranges(count_range, wheres, cb))
             return sum(result, [])
         else:
             return db.execute('SELECT %s, %s as class, %s FROM %s %s WHERE %s GROUP BY %s, class'%
@@ -231,14 +656,55 @@ def PerImageCounts(weaklearners, filter_name=None, cb=None):
         return counts.get(tuple(list(im_key) + [classnum]), [0, 0])[1]
 
     def get_results():
-        for imkey in dm.GetImageKeysAndObjectCounts(filter_name):
+        for imkey in imkeys:
             if p.area_scoring_column is None:
-                yield list(imkey[0]) + [get_count(imkey[0], cl) for cl in range(1, num_classes+1)]
+                yield list(imkey) + [get_count(imkey, cl) for cl in range(1, num_classes+1)]
             else:
-                yield list(imkey[0]) + [get_count(imkey[0], cl) for cl in range(1, num_classes+1)] + [get_area(imkey[0], cl) for cl in range(1, num_classes+1)]
+                yield list(imkey) + [get_count(imkey, cl) for cl in range(1, num_classes+1)] + [get_area(imkey, cl) for cl in range(1, num_classes+1)]
 
     return list(get_results())
 
+def _per_image_counts_numpy(weaklearners, filter_name, imkeys, cb=None):
+    '''
+    PerImageCounts, evaluating the rules with numpy.  The rule columns of
+    each range of images (see _where_clauses) are fetched separately, on
+    several connections at once, and the classes are summed into per-image
+    count arrays.
+    '''
+    num_classes = len(weaklearners[0][2])
+    nKeyCols = len(image_key_columns())
+    if len(imkeys) == 0:
+        return []
+    # look up the row of each object's image by its packed key
+    packed = pack_image_keys(imkeys)
+    order = numpy.argsort(packed)
+    packed = packed[order]
+    counts = numpy.zeros((len(imkeys), num_classes), dtype='i8')
+    areas = numpy.zeros((len(imkeys), num_classes))
+    if p.area_scoring_column is None:
+        extra_columns = []
+    else:
+        extra_columns = [_objectify(p, p.area_scoring_column)]
+
+    def classify_range(idx, where_clause):
+        return _classify_objects(weaklearners, where_clause, extra_columns)
+
+    wheres = _where_clauses(p, dm, filter_name, imkeys)
+    for keys, extra, classes in _map_ranges(classify_range, wheres, cb):
+        if len(classes) > 0:
+            obpacked = pack_image_keys(numpy.column_stack(keys[:nKeyCols]))
+            pos = numpy.minimum(numpy.searchsorted(packed, obpacked), len(packed) - 1)
+            # objects of images outside the filter are dropped
+            keep = (packed[pos] == obpacked)
+            rows = order[pos[keep]]
+            numpy.add.at(counts, (rows, classes[keep] - 1), 1)
+            if extra_columns:
+                numpy.add.at(areas, (rows, classes[keep] - 1), numpy.nan_to_num(extra[0][keep]))
+
+    if p.area_scoring_column is None:
+        return [list(imkey) + row for imkey, row in zip(imkeys, counts.tolist())]
+    return [list(imkey) + row + arow for imkey, row, arow in zip(imkeys, counts.tolist(), areas.tolist())]
+
 
 if __name__ == "__main__":
 #    dir = "/Users/ljosa/research/modifier/piyush"
@@ -427,11 +427,30 @@ class NormalizationUI(wx.Frame, CPATool):
         #
         # MAKE THE QUERY
         #
-        input_data = np.array(db.execute(query), dtype=object)
+        # Rows are copied into a column array per key and measurement as
+        # they are read, with NaN for NULL measurements.
+        cancelled = []
+        def pulse(nrows):
+            keep_going, skip = dlg.Pulse('Querying database for raw data (%d rows read).'%(nrows))
+            if not keep_going:
+                cancelled.append(True)
+                return False
+        columns = db.execute_columns(query, dtypes=['O'] * FIRST_MEAS_INDEX + ['f8'] * len(meas_cols),
+                                     callback=pulse)
+        if cancelled:
+            dlg.Destroy()
+            return
+        if len(columns[0]) == 0:
+            dlg.Destroy()
+            wx.MessageBox('No data was found in "%s".'%(input_table))
+            return
+        key_columns = columns[:FIRST_MEAS_INDEX]
+        meas_columns = columns[FIRST_MEAS_INDEX:]
+        del columns
                 
-        output_columns = np.ones(input_data[:,FIRST_MEAS_INDEX:].shape) * np.nan
-        output_factors = np.ones(input_data[:,FIRST_MEAS_INDEX:].shape) * np.nan
-        for colnum, col in enumerate(input_data[:,FIRST_MEAS_INDEX:].T):
+        output_columns = np.ones((len(key_columns[0]), len(meas_columns))) * np.nan
+        output_factors = np.ones((len(key_columns[0]), len(meas_columns))) * np.nan
+        for colnum, col in enumerate(meas_columns):
             keep_going, skip = dlg.Pulse("Normalizing column %d of %d"%(colnum+1, len(meas_cols))) 
             if not keep_going:
                 dlg.Destroy()
@@ -442,7 +461,7 @@ class NormalizationUI(wx.Frame, CPATool):
                 if d[norm.P_GROUPING] in (norm.G_QUADRANT, norm.G_WELL_NEIGHBORS):
                     # Reshape data if normalization step is plate sensitive.
                     assert p.plate_id and p.well_id
-                    well_keys = input_data[:, range(WELL_KEY_INDEX, FIRST_MEAS_INDEX)]
+                    well_keys = np.column_stack(key_columns[WELL_KEY_INDEX:FIRST_MEAS_INDEX])
                     wellkeys_and_vals = np.hstack((well_keys, np.array([norm_data]).T))
                     new_norm_data    = []
                     for plate, plate_grp in groupby(wellkeys_and_vals, lambda(row): row[0]):
@@ -453,7 +472,7 @@ class NormalizationUI(wx.Frame, CPATool):
                     norm_data = new_norm_data
                 elif d[norm.P_GROUPING] == norm.G_PLATE:
                     assert p.plate_id and p.well_id
-                    well_keys = input_data[:, range(WELL_KEY_INDEX, FIRST_MEAS_INDEX)]
+                    well_keys = np.column_stack(key_columns[WELL_KEY_INDEX:FIRST_MEAS_INDEX])
                     wellkeys_and_vals = np.hstack((well_keys, np.array([norm_data]).T))
                     new_norm_data    = []
                     for plate, plate_grp in groupby(wellkeys_and_vals, lambda(row): row[0]):
@@ -508,14 +527,14 @@ class NormalizationUI(wx.Frame, CPATool):
         for i, (val, factor) in enumerate(zip(output_columns, output_factors)):
             cmdi += '(' + ','.join(['"%s"']*len(norm_table_cols)) + ')'
             if wants_norm_meas and wants_norm_factor:
-                cmdi = cmdi%tuple(list(input_data[i, :FIRST_MEAS_INDEX]) + 
+                cmdi = cmdi%tuple([kc[i] for kc in key_columns] + 
                                   ['NULL' if (np.isnan(x) or np.isinf(x)) else x for x in val] + 
                                   ['NULL' if (np.isnan(x) or np.isinf(x)) else x for x in factor])
             elif wants_norm_meas:
-                cmdi = cmdi%tuple(list(input_data[i, :FIRST_MEAS_INDEX]) + 
+                cmdi = cmdi%tuple([kc[i] for kc in key_columns] + 
                                   ['NULL' if (np.isnan(x) or np.isinf(x)) else x for x in val])
             elif wants_norm_factor:
-                cmdi = cmdi%tuple(list(input_data[i, :FIRST_MEAS_INDEX]) + 
+                cmdi = cmdi%tuple([kc[i] for kc in key_columns] + 
                                   ['NULL' if (np.isnan(x) or np.isinf(x)) else x for x in factor])
             if (i+1) % BATCH_SIZE == 0 or i==len(output_columns)-1:
                 db.execute(str(cmdi))
@@ -252,13 +252,17 @@ class PlateViewer(wx.Frame, CPATool):
                 q.add_filter(p.gates[fltr].as_filter())
             else:
                 raise Exception('Could not find filter "%s" in gates or filters'%(fltr))
-        wellkeys_and_values = db.execute(str(q))
-        wellkeys_and_values = np.array(wellkeys_and_values, dtype=object)
-
-        # Replace measurement None's with nan
-        for row in wellkeys_and_values:
-            if row[-1] is None:
-                row[-1] = np.nan
+        # Numeric measurements are fetched straight into a float column
+        # (with NaN for NULL) so the extents below are vectorized.
+        columns = db.execute_columns(str(q), dtypes=['O'] * len(well_key_cols) + 
+                                     ['O' if categorical else 'f8'])
+        values = columns[-1]
+        if categorical:
+            # Replace measurement None's with nan
+            values[np.array([v is None for v in values], dtype=bool)] = np.nan
+        wellkeys_and_values = np.empty((len(values), len(columns)), dtype=object)
+        for i, col in enumerate(columns):
+            wellkeys_and_values[:, i] = col
 
         data = []
         key_lists = []
@@ -269,27 +273,28 @@ class PlateViewer(wx.Frame, CPATool):
                 plate = plateChoice.Value
                 plateMap.SetPlate(plate)
                 self.colorBar.AddNotifyWindow(plateMap)
-                keys_and_vals = [v for v in wellkeys_and_values if str(v[0])==plate]
+                in_plate = np.array([str(k)==plate for k in columns[0]], dtype=bool)
+                keys_and_vals = wellkeys_and_values[in_plate]
                 platedata, wellkeys, ignore = FormatPlateMapData(keys_and_vals, categorical)
                 data += [platedata]
                 key_lists += [wellkeys]
                 if not categorical:
-                    dmin = np.nanmin([float(kv[-1]) for kv in keys_and_vals]+[dmin])
-                    dmax = np.nanmax([float(kv[-1]) for kv in keys_and_vals]+[dmax])
+                    dmin = np.nanmin(np.hstack((values[in_plate], [dmin])))
+                    dmax = np.nanmax(np.hstack((values[in_plate], [dmax])))
         else:
             self.colorBar.AddNotifyWindow(self.plateMaps[0])
             platedata, wellkeys, ignore = FormatPlateMapData(wellkeys_and_values, categorical)
             data += [platedata]
             key_lists += [wellkeys]
             if not categorical:
-                dmin = np.nanmin([float(kv[-1]) for kv in wellkeys_and_values])
-                dmax = np.nanmax([float(kv[-1]) for kv in wellkeys_and_values])
+                dmin = np.nanmin(values)
+                dmax = np.nanmax(values)
             
         if not categorical:
             if len(wellkeys_and_values) > 0:
                 # Compute the global extents if there is any data whatsoever
-                gmin = np.nanmin([float(vals[-1]) for vals in wellkeys_and_values])
-                gmax = np.nanmax([float(vals[-1]) for vals in wellkeys_and_values])
+                gmin = np.nanmin(values)
+                gmax = np.nanmax(values)
                 if np.isinf(dmin) or np.isinf(dmax):
                     gmin = gmax = dmin = dmax = 1.
                     # Warn if there was no data for this plate (and no filter was used)
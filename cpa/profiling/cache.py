@@ -231,13 +231,14 @@ class Cache(object):
         filename = self._image_filename(plate, image_key)
         if resume and os.path.exists(filename):
             return
-        features = cpa.db.execute("""select %s from %s where %s""" % (
-                ','.join(self.colnames), cpa.properties.object_table, 
-                cpa.dbconnect.GetWhereClauseForImages([image_key])))
-        cellids  = cpa.db.execute("""select %s from %s where %s""" % (
-                cpa.properties.object_id, cpa.properties.object_table, 
-                cpa.dbconnect.GetWhereClauseForImages([image_key])))
-        np.savez(filename, features=np.array(features, dtype=float), cellids=np.squeeze(np.array(cellids)))
+        columns = cpa.db.execute_columns("""select %s, %s from %s where %s""" % (
+                cpa.properties.object_id, ','.join(self.colnames), 
+                cpa.properties.object_table, 
+                cpa.dbconnect.GetWhereClauseForImages([image_key])),
+                dtypes=['i8'] + ['f8'] * len(self.colnames))
+        cellids = columns[0]
+        features = np.column_stack(columns[1:])
+        np.savez(filename, features=features, cellids=cellids)
 
     def _create_cache_counts(self, resume):
         """
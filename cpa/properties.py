@@ -43,7 +43,9 @@ string_vars = ['db_type',
                'image_url_prepend',
                'image_tile_size', 
                'image_buffer_size',
+               'image_buffer_megabytes',
                'tile_buffer_size',
+               'tile_loader_threads',
                'area_scoring_column',
                'training_set',
                'class_table',
@@ -57,6 +59,10 @@ string_vars = ['db_type',
                'link_tables_table',
                'link_columns_table',
                'image_rescale',
+               'db_pool_size',
+               'scoring_engine',
+               'scoring_threads',
+               'svm_successive_halving',
                ]
 
 list_vars = ['image_path_cols', 'image_channel_paths', 
@@ -90,7 +96,9 @@ optional_vars = ['db_port',
                  'training_set',
                  'class_table',
                  'image_buffer_size', 
+                 'image_buffer_megabytes',
                  'tile_buffer_size',
+                 'tile_loader_threads',
                  'plate_id', 
                  'well_id', 
                  'plate_type',
@@ -112,6 +120,10 @@ optional_vars = ['db_port',
                  'image_rescale',
                  'plate_shape',
                  'image_tile_size',
+                 'db_pool_size',
+                 'scoring_engine',
+                 'scoring_threads',
+                 'svm_successive_halving',
                  ]
 
 # map deprecated fields to new fields
@@ -541,10 +553,28 @@ class Properties(Singleton):
         if not self.field_defined('image_buffer_size'):
             logging.info('PROPERTIES: Using default image_buffer_size=1')
             self.image_buffer_size = '1'
+
+        if not self.field_defined('image_buffer_megabytes'):
+            self.image_buffer_megabytes = '512'
+        else:
+            try:
+                assert float(self.image_buffer_megabytes) > 0
+            except (ValueError, AssertionError):
+                logging.warn('PROPERTIES WARNING (image_buffer_megabytes): Field value "%s" is invalid. Replacing with 512.'%(self.image_buffer_megabytes))
+                self.image_buffer_megabytes = '512'
             
         if not self.field_defined('tile_buffer_size'):
             logging.info('PROPERTIES: Using default tile_buffer_size=1')
             self.tile_buffer_size = '1'
+
+        if not self.field_defined('tile_loader_threads'):
+            self.tile_loader_threads = '4'
+        else:
+            try:
+                assert int(self.tile_loader_threads) > 0
+            except (ValueError, AssertionError):
+                logging.warn('PROPERTIES WARNING (tile_loader_threads): Field value "%s" is invalid. Replacing with 4.'%(self.tile_loader_threads))
+                self.tile_loader_threads = '4'
             
         if not self.field_defined('object_name'):
             logging.warn('PROPERTIES WARNING (object_name): No object name specified, will use default: "object_name=cell,cells"')
@@ -612,6 +642,27 @@ class Properties(Singleton):
         else:
             logging.warn('PROPERTIES WARNING (check_tables): Field value "%s" is invalid. Replacing with "yes".'%(self.check_tables))
             self.check_tables = 'yes'
+
+        if self.field_defined('scoring_engine') and self.scoring_engine.lower() not in ['sql', 'numpy']:
+            logging.warn('PROPERTIES WARNING (scoring_engine): Field value "%s" is invalid. Using the default for %s.'%(self.scoring_engine, self.db_type))
+            self.scoring_engine = None
+
+        if self.field_defined('scoring_threads'):
+            try:
+                assert int(self.scoring_threads) > 0
+            except (ValueError, AssertionError):
+                logging.warn('PROPERTIES WARNING (scoring_threads): Field value "%s" is invalid. Replacing with 1.'%(self.scoring_threads))
+                self.scoring_threads = '1'
+            
+        if self.svm_successive_halving in [True, False]:
+            pass
+        elif not self.field_defined('svm_successive_halving') or self.svm_successive_halving.lower() in ['false', 'no', 'off', 'f', 'n']:
+            self.svm_successive_halving = False
+        elif self.svm_successive_halving.lower() in ['true', 'yes', 'on', 't', 'y']:
+            self.svm_successive_halving = True
+        else:
+            logging.warn('PROPERTIES WARNING (svm_successive_halving): Field value "%s" is invalid. Replacing with "false".'%(self.svm_successive_halving))
+            self.svm_successive_halving = False
             
         if self.use_larger_image_scale in [True, False]:
             pass
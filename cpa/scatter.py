@@ -236,30 +236,7 @@ class ScatterControlPanel(wx.Panel):
         
     def update_figpanel(self, evt=None):
         self.gate_choice.set_gatable_columns([self.x_column, self.y_column])
-        keys_and_points = self._load_points()
-        col_types = self.get_selected_column_types()
-                
-        # Convert keys and points into a np array
-        # NOTE: We must set dtype "object" on creation or values like 0.34567e-9
-        #       may be truncated to 0.34567e (error) or 0.345 (no error) when
-        #       the array contains strings.
-        kps = np.array(keys_and_points, dtype='object')
-        # Strip out keys
-        if self._plotting_per_object_data():
-            key_indices = list(xrange(len(object_key_columns())))
-        else:
-            key_indices = list(xrange(len(image_key_columns())))
-        keys = kps[:,key_indices].astype(int)
-        # Strip out x coords
-        if col_types[0] in [float, int, long]:
-            xpoints = kps[:,-2].astype('float32')
-        else:
-            xpoints = kps[:,-2]
-        # Strip out y coords
-        if col_types[1] in [float, int, long]:
-            ypoints = kps[:,-1].astype('float32')
-        else:
-            ypoints = kps[:,-1]
+        keys, xpoints, ypoints = self._load_points()
 
         # plot the points
         self.figpanel.set_points(xpoints, ypoints)
@@ -273,6 +250,10 @@ class ScatterControlPanel(wx.Panel):
         self.figpanel.draw()
         
     def _load_points(self):
+        '''
+        Returns the keys of the points as an array of rows, and their x and
+        y values (as float32 for numeric columns).
+        '''
         q = sql.QueryBuilder()
         select = []
         #
@@ -290,7 +271,17 @@ class ScatterControlPanel(wx.Panel):
             q.add_filter(self.filter)
         q.add_where(sql.Expression(self.x_column, 'IS NOT NULL'))
         q.add_where(sql.Expression(self.y_column, 'IS NOT NULL'))
-        return db.execute(str(q))
+        # NOTE: Non-numeric columns are read as objects, or values like
+        #       0.34567e-9 may be truncated to 0.34567e (error) or 0.345
+        #       (no error) when the column contains strings.
+        nkeys = len(select) - 2
+        dtypes = ['i8'] * nkeys + ['f8' if t in [float, int, long] else 'O'
+                                   for t in self.get_selected_column_types()]
+        columns = db.execute_columns(str(q), dtypes=dtypes)
+        keys = np.column_stack(columns[:nkeys])
+        points = [col.astype('float32') if col.dtype.kind == 'f' else col 
+                  for col in columns[nkeys:]]
+        return keys, points[0], points[1]
     
     def get_selected_column_types(self):
         ''' Returns a tuple containing the x and y column types. '''
@@ -26,7 +26,7 @@ python scoreall.py <propertiesfile> <trainingset>
 '''
 
 def score(properties, ts, nRules, filter_name=None, group='Image',
-          show_results=False, results_table=None, overwrite=False):
+          show_results=False, results_table=None, overwrite=False, n_workers=1):
     '''
     Trains a Classifier on a training set and scores the experiment
     returns the table of scores as a numpy array.
@@ -38,6 +38,7 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
     group         -- name of a group to use from the properties file
     show_results  -- whether or not to show the results in TableViewer
     results_table -- table name to save results to or None.
+    n_workers     -- number of cores to train with (0 for all cores)
     '''
     
     p = properties
@@ -61,6 +62,7 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
     print 'show results:  ', show_results
     print 'results table: ', results_table
     print 'overwrite:     ', overwrite
+    print 'cores:         ', n_workers or 'all'
     print ''
             
     nClasses = len(ts.labels)
@@ -75,7 +77,8 @@ def score(properties, ts, nRules, filter_name=None, group='Image',
     t0 = time()
     weaklearners = fastgentleboostingmulticlass.train(ts.colnames,
                                                       nRules, ts.label_matrix, 
-                                                      ts.values, output)
+                                                      ts.values, output,
+                                                      n_workers=n_workers)
     logging.info('Training done in %f seconds'%(time()-t0))
     
     logging.info('Computing per-image class counts...')
@@ -227,6 +230,9 @@ if __name__ == "__main__":
         
     results_table = raw_input('Results table name (return for none): ')
 
+    n_workers = raw_input('# of cores to train with (return for all): ')
+    n_workers = int(n_workers or 0)
+
     logging.info('Loading properties file...')
     p = Properties.getInstance()
     p.LoadFile(props_file)
@@ -235,7 +241,7 @@ if __name__ == "__main__":
     ts.Load(ts_file)
 
     score(p, ts, nRules, filter_name, group, show_results=True,
-          results_table=results_table, overwrite=False)
+          results_table=results_table, overwrite=False, n_workers=n_workers)
     
     app.MainLoop()
     
@@ -10,11 +10,13 @@ import dbconnect
 import dimensredux as dr
 import logging
 import numpy as np
+import svmgridsearch
 import wx
-from datamodel import DataModel
+from datamodel import DataModel, pack_image_keys
 from properties import Properties
 from sys import hexversion, exc_info
 from threading import Thread
+from time import time
 from traceback import print_exception
 
 # Import support vector classifier, feature selection and Pipeline from scikits.learn
@@ -60,6 +62,21 @@ else:
 class StopCalculating(Exception):
     pass
 
+def image_blocks(counts, block_size):
+    '''
+    Splits a list of images into blocks of consecutive images with about
+    block_size objects between them (at least one image per block).
+    counts: the number of objects in each image
+    Yields (start, stop) index pairs.
+    '''
+    cumsums = np.cumsum(counts)
+    start = 0
+    while start < len(counts):
+        base = cumsums[start - 1] if start > 0 else 0
+        stop = max(np.searchsorted(cumsums, base + block_size, side='right'), start + 1)
+        yield start, stop
+        start = stop
+
 class SupportVectorMachines(object):
     '''
     Class to define a complete support vector machine classifier calculation problem. 
@@ -155,9 +172,10 @@ class SupportVectorMachines(object):
         labels = np.array([np.nonzero(target > 0) for target in labels]).squeeze()
         return labels, values
 
-    def CreatePerObjectClassTable(self, classes):
+    def CreatePerObjectClassTable(self, classes, cb=None):
         '''
     	Saves object keys and classes to a SQL table
+    	cb: callback function to update with the fraction complete
     	'''
         p = Properties.getInstance()
         if p.class_table is None:
@@ -171,11 +189,14 @@ class SupportVectorMachines(object):
         db = dbconnect.DBConnect.getInstance()
         db.execute('DROP TABLE IF EXISTS %s'%(p.class_table))
         db.execute('CREATE TABLE %s (%s)'%(p.class_table, class_col_defs))
-        db.execute('CREATE INDEX idx_%s ON %s (%s)'%(p.class_table, p.class_table, index_cols))
         for clNum, clName in enumerate(self.perClassObjects.keys()):
             for obj in self.perClassObjects[clName]:
                 query = ''.join(['INSERT INTO ',p.class_table,' (',class_cols,') VALUES (',str(obj[0]),', ',str(obj[1]),', "',clName,'", ',str(clNum+1),')'])
                 db.execute(query)
+            if cb:
+                cb(float(clNum + 1) / len(self.perClassObjects))
+        # the index is faster to build once the rows are in
+        db.execute('CREATE INDEX idx_%s ON %s (%s)'%(p.class_table, p.class_table, index_cols))
 
         if p.db_type.lower() == 'mysql':
             query = ''.join(['ALTER TABLE ',p.class_table,' ORDER BY ',p.image_id,' ASC, ',p.object_id,' ASC'])
@@ -189,21 +210,20 @@ class SupportVectorMachines(object):
     	'''
         # Retrieve instance of the database connection
         db = dbconnect.DBConnect.getInstance()
-        object_data = {}
         if isinstance(keys, str):
-            object_data[0] = db.GetCellDataForClassifier(keys)
-        elif keys != []:
-            if len(keys) == len(dbconnect.image_key_columns()):
-                # Retrieve instance of the data model and retrieve objects in the requested image
-                dm = DataModel.getInstance()
-                obKeys = dm.GetObjectsFromImage(keys[0])
-            else:
-                obKeys = keys
-            for key in obKeys:
-                object_data[key] = db.GetCellDataForClassifier(key)
-
-        sorted_keys = sorted(object_data.keys())
-        values_array = np.array([object_data[key] for key in sorted_keys])
+            sorted_keys = [0]
+            values_array = np.array([db.GetCellDataForClassifier(keys)])
+        else:
+            obKeys = []
+            if keys != []:
+                if len(keys) == len(dbconnect.image_key_columns()):
+                    # Retrieve instance of the data model and retrieve objects in the requested image
+                    dm = DataModel.getInstance()
+                    obKeys = dm.GetObjectsFromImage(keys[0])
+                else:
+                    obKeys = keys
+            sorted_keys = sorted(set(obKeys))
+            values_array = db.GetCellsDataForClassifier(sorted_keys)
         scaled_values = self.ScaleData(values_array)
         pred_labels = self.model.predict(scaled_values)
 
@@ -242,94 +262,77 @@ class SupportVectorMachines(object):
         finally:
             fh.close()
 
-    def ParameterGridSearch(self, callback = None, nValidation = 5):
+    def ParameterGridSearch(self, callback = None, nValidation = 5, n_workers = 1):
         '''
         Grid search for the best C and gamma parameters for the RBF Kernel.
         The efficiency of the parameters is evaluated using nValidation-fold
         cross-validation of the training data.
     
-        As this process is time consuming and parallelizable, a number of
-        threads equal to the number of cores in the computer is used for the
-        calculations
+        As this process is time consuming and parallelizable, the parameter
+        pairs are scored by n_workers processes (0 for all cores), see
+        svmgridsearch.  If the svm_successive_halving property is set, pairs
+        that do badly on the first folds are dropped.
         '''
-        from scikits.learn.grid_search import GridSearchCV
-        from scikits.learn.metrics import precision_score
-        from scikits.learn.cross_val import StratifiedKFold
-        # 
-        # XXX: program crashes with >1 worker when running cpa.py
-        #      No crash when running from classifier.py. Why?
-        #
-        n_workers = 1
-        #try:
-            #from multiprocessing import cpu_count
-            #n_workers = cpu_count()
-        #except:
-            #n_workers = 1
-
         # Define the parameter ranges for C and gamma and perform a grid search for the optimal setting
-        parameters = {'C': 2**np.arange(-5,11,2, dtype=float),
-                      'gamma': 2**np.arange(3,-11,-2, dtype=float)}                
-        clf = GridSearchCV(SVC(kernel='rbf'), parameters, n_jobs=n_workers, score_func=precision_score)
-        clf.fit(self.svm_train_values, self.svm_train_labels, 
-                cv=StratifiedKFold(self.svm_train_labels, nValidation))
-
-        # Pick the best parameters as the ones with the maximum cross-validation rate
-        bestParameters = max(clf.grid_scores_, key=lambda a: a[1])
-        bestC = bestParameters[0]['C']
-        bestGamma = bestParameters[0]['gamma']
-        logging.info('Optimal values: C=%s g=%s rate=%s'%
-                     (bestC, bestGamma, bestParameters[1]))
+        Cs = 2**np.arange(-5,11,2, dtype=float)
+        gammas = 2**np.arange(3,-11,-2, dtype=float)
+        t0 = time()
+        bestC, bestGamma, bestRate, results = svmgridsearch.grid_search(
+            self.svm_train_values, self.svm_train_labels, Cs, gammas, n_folds=nValidation,
+            n_workers=n_workers, halving=bool(Properties.getInstance().svm_successive_halving),
+            callback=callback)
+        logging.info('Optimal values: C=%s g=%s rate=%s (%d parameter pairs scored in %.1fs)'%
+                     (bestC, bestGamma, bestRate, len(results), time() - t0))
         return bestC, bestGamma
 
-    def PerImageCounts(self, filter_name=None, cb=None):
+    def PerImageCounts(self, filter_name=None, cb=None, block_size=20000):
+        '''
+        Classifies the objects of the images in the filter, a block of
+        images at a time, and counts the objects of each class per image.
+        The measurements of a block (about block_size objects) are fetched
+        with one query and predicted in one call.
+        RETURNS: A list of rows [image key..., class 1 count, class 2 count, ...]
+        '''
         # Clear the current perClassObjects storage
         for bin in self.classBins:
             self.perClassObjects[bin.label] = []
 
-        # Retrieve a data model instance
         dm = DataModel.getInstance()
-
-        # Retrieve image keys and initialize variables
-        imageKeys = dm.GetAllImageKeys(filter_name)
-        imageAmount = float(len(imageKeys))
-        perImageData = []
-
-        # Process all images
-        for k_index, imKey in enumerate(imageKeys):
-            try:
-                # Retrieve the keys of the objects in the current image
-                obKeys = dm.GetObjectsFromImage(imKey)
-            except:
-                raise ValueError('No such image: %s' % (imKey,))
-
-            # Calculate the amount of hits for each of the classes in the current image
-            classHits = {}
-            objectCount = [imKey[0]]
-            if obKeys:
-                classObjects = self.FilterObjectsFromClassN(keys = [imKey])
+        db = dbconnect.DBConnect.getInstance()
+        p = Properties.getInstance()
+        if db.classifierColNames is None:
+            db.GetColnamesForClassifier()
+
+        imageKeys = sorted(dm.GetAllImageKeys(filter_name))
+        if len(imageKeys) == 0:
+            return []
+        nKeyCols = len(dbconnect.image_key_columns())
+        nObKeyCols = len(dbconnect.object_key_columns())
+        packed = pack_image_keys(imageKeys)
+        counts = np.zeros((len(imageKeys), len(self.classBins)), dtype='i8')
+        select = ', '.join(['`%s`'%(col) for col in db.classifierColNames])
+        dtypes = ['i8'] * nObKeyCols + ['f8'] * len(db.classifierColNames)
+
+        for start, stop in image_blocks(dm.GetObjectCounts(imageKeys), block_size):
+            query = 'SELECT %s, %s FROM %s WHERE %s'%(dbconnect.UniqueObjectClause(), select, p.object_table,
+                                                      dbconnect.GetWhereClauseForImages(imageKeys[start:stop]))
+            columns = db.execute_columns(query, dtypes=dtypes, silent=True)
+            if len(columns[0]) > 0:
+                values = np.column_stack(columns[nObKeyCols:])
+                # NULL measurements are 0, as in GetCellsDataForClassifier
+                values[np.isnan(values)] = 0.0
+                values = self.ScaleData(values, in_place=True)
+                labels = np.asarray(self.model.predict(values)).astype(int)
+                rows = np.searchsorted(packed, pack_image_keys(np.column_stack(columns[:nKeyCols])))
+                np.add.at(counts, (rows, labels), 1)
+                # Store the objects grouped by class
+                obKeys = zip(*[col.tolist() for col in columns[:nObKeyCols]])
                 for clNum, bin in enumerate(self.classBins):
-                    # Get the objects from the image which belong to the selected class
-                    classHits[bin.label] = classObjects[float(clNum+1)]
-
-                    # Store the total object count of this class for the current image
-                    nrHits = len(classHits[bin.label])
-                    objectCount.append(nrHits)
-
-                    # Store the objects for the current class and image grouped
-                    # by class if any are found for this class in the selected image
-                    if nrHits > 0:
-                        self.perClassObjects[bin.label] += classHits[bin.label]
-            else:
-                # If there are objects in the image, add zeros for all bins
-                [objectCount.append(0) for bin in self.classBins]
-
-            # Store the results for the current image and update the callback
-            # function if available
-            perImageData.append(objectCount)
+                    self.perClassObjects[bin.label] += [obKeys[i] for i in np.flatnonzero(labels == clNum)]
             if cb:
-                cb(min(1, k_index/imageAmount))
+                cb(min(1, stop / float(len(imageKeys))))
 
-        return perImageData
+        return [list(imKey) + row for imKey, row in zip(imageKeys, counts.tolist())]
 
     def SaveModel(self, model_file_name, bin_labels):       
         import cPickle
@@ -337,16 +340,20 @@ class SupportVectorMachines(object):
         cPickle.dump((self.model, bin_labels, self.feat_min, self.feat_max), fh)
         fh.close()
 
-    def ScaleData(self, values, low_lim=0.0, up_lim=1.0):
+    def ScaleData(self, values, low_lim=0.0, up_lim=1.0, in_place=False):
         '''
-    	Linearly scale the data to improve the efficiency of the classifier
+    	Linearly scale the data to improve the efficiency of the classifier.
+    	If in_place is true, values (a float array) is scaled and returned
+    	rather than a scaled copy.
     	'''
-        row, col = np.shape(values)
-        scaled_data = np.zeros((row, col))
-        for j in xrange(col):
-            scaled_data[:,j] = self.LinearScale(values[:,j], low_lim, up_lim,
-                                                self.feat_min[j], self.feat_max[j])
-        return scaled_data
+        if not in_place:
+            values = np.array(values, dtype=float)
+        # the same steps as LinearScale, for all the columns at once
+        values -= self.feat_min
+        values *= (up_lim - low_lim)
+        values /= (self.feat_max - self.feat_min)
+        values += low_lim
+        return values
 
     def ShowModel(self):
         if self.model is not None:
@@ -354,9 +361,10 @@ class SupportVectorMachines(object):
         else:
             return ''
 
-    def Train(self, colNames, nValidation, labels, values, fout=None, callback = None):
+    def Train(self, colNames, nValidation, labels, values, fout=None, callback = None, n_workers=1):
         '''
     	Train a SVM model using optimized C and Gamma parameters and a training set.
+    	n_workers is the number of processes for the grid search (0 for all cores).
     	'''
         # First make sure the supplied problem is in SVM format
         self.TranslateTrainingSet(labels, values)
@@ -364,9 +372,9 @@ class SupportVectorMachines(object):
         # Perform a grid-search to obtain the C and gamma parameters for C-SVM
         # classification
         if nValidation > 1:
-            C, gamma = self.ParameterGridSearch(callback, nValidation)
+            C, gamma = self.ParameterGridSearch(callback, nValidation, n_workers=n_workers)
         else:
-            C, gamma = self.ParameterGridSearch(callback)
+            C, gamma = self.ParameterGridSearch(callback, n_workers=n_workers)
 
         # Train the model using the obtained C and gamma parameters to obtain the final classifier
         self.model = Pipeline([('anova', feature_selection.SelectPercentile(feature_selection.f_classif,
@@ -419,7 +427,7 @@ class SupportVectorMachines(object):
         logging.info('Performing grid search for parameters C and gamma on entire training set...')
         self.TranslateTrainingSet(self.classifier.trainingSet.label_matrix, 
                                   self.classifier.trainingSet.values)
-        C, gamma = self.ParameterGridSearch(callback=cb)
+        C, gamma = self.ParameterGridSearch(callback=cb, n_workers=self.classifier.nWorkersSpin.GetValue())
         dlg.Destroy()
         logging.info('Grid search completed. Found optimal C=%d and gamma=%f.' % (C, gamma))
 
@@ -0,0 +1,277 @@
+'''
+Cross-validated grid search for the C and gamma parameters of an RBF
+kernel SVM, used by SupportVectorMachines.ParameterGridSearch.
+
+The parameter pairs are scored by worker processes, each a new Python
+interpreter running this file (see _worker_main) rather than a fork of
+CPA, so they don't inherit its GUI, Java VM or database connections.  The
+training data is pickled to each worker once, then the parameter pairs one
+at a time.  A worker that dies or takes longer than TASK_TIMEOUT on one
+pair is dropped and that pair counts as failed.  If no workers can be
+started, or all of them are dropped, the rest of the search runs in this
+process.
+'''
+import cPickle
+import logging
+import os
+import subprocess
+import sys
+import threading
+import numpy as np
+from multiprocessing import cpu_count
+from Queue import Queue, Empty
+from time import time
+
+# seconds a worker may spend on one parameter pair before it is killed
+TASK_TIMEOUT = 1800
+
+# training data of a worker process, see _init_worker
+_values = None
+_labels = None
+
+def stratified_folds(labels, n_folds):
+    '''
+    Splits the examples into n_folds folds with about the same share of
+    each label, dealing the examples of each label out in turn.
+    Returns a list of (train, test) index arrays.
+    '''
+    labels = np.asarray(labels)
+    fold = np.zeros(len(labels), dtype=int)
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        fold[members] = np.arange(len(members)) % n_folds
+    return [(np.flatnonzero(fold != k), np.flatnonzero(fold == k)) for k in range(n_folds)]
+
+def _init_worker(values, labels):
+    global _values, _labels
+    _values, _labels = values, labels
+
+def score_parameters(task):
+    '''
+    Trains an RBF SVM with the given C and gamma on the train indices and
+    scores its precision on the test indices.
+    task: (C, gamma, train, test)
+    Returns (C, gamma, score, seconds), with a score of None if training
+    failed.
+    '''
+    C, gamma, train, test = task
+    t0 = time()
+    try:
+        from scikits.learn.svm import SVC
+        from scikits.learn.metrics import precision_score
+        clf = SVC(kernel='rbf', C=C, gamma=gamma)
+        clf.fit(_values[train], _labels[train])
+        score = precision_score(_labels[test], clf.predict(_values[test]))
+    except Exception, e:
+        logging.error('Training with C=%s gamma=%s failed: %s'%(C, gamma, e))
+        score = None
+    return C, gamma, score, time() - t0
+
+class _Worker(object):
+    '''
+    A worker process, see _worker_main.  Its results are read by a thread
+    and put on the results queue as (worker, result) pairs, with a result
+    of None when the worker exits.
+    '''
+    def __init__(self, values, labels, results):
+        self.task = None
+        self.started = None
+        self.proc = subprocess.Popen([sys.executable, _script()],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            cPickle.dump((values, labels), self.proc.stdin, cPickle.HIGHEST_PROTOCOL)
+            self.proc.stdin.flush()
+        except:
+            self.stop()
+            raise
+        reader = threading.Thread(target=self._read, args=(results,))
+        reader.daemon = True
+        reader.start()
+
+    def _read(self, results):
+        while True:
+            try:
+                result = cPickle.load(self.proc.stdout)
+            except Exception:
+                results.put((self, None))
+                return
+            results.put((self, result))
+
+    def send(self, task):
+        self.task = task
+        self.started = time()
+        cPickle.dump(task, self.proc.stdin, cPickle.HIGHEST_PROTOCOL)
+        self.proc.stdin.flush()
+
+    def stop(self):
+        try:
+            self.proc.stdin.close()
+        except IOError:
+            pass
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+def _script():
+    ''' Returns the path of this file, to be run by the workers. '''
+    filename = os.path.abspath(__file__)
+    if filename.endswith(('.pyc', '.pyo')) and os.path.exists(filename[:-1]):
+        filename = filename[:-1]
+    return filename
+
+def _start_workers(values, labels, n_workers):
+    '''
+    Starts up to n_workers worker processes.
+    Returns (workers, results queue).
+    '''
+    results = Queue()
+    workers = []
+    if getattr(sys, 'frozen', False):
+        # sys.executable is CPA itself, which can't run the worker
+        logging.info('Worker processes are not available in a frozen CPA, searching in this one.')
+        return workers, results
+    for i in xrange(n_workers):
+        try:
+            workers.append(_Worker(values, labels, results))
+        except Exception, e:
+            logging.warn('Could not start worker process %d: %s'%(i + 1, e))
+            break
+    return workers, results
+
+def _run_tasks(tasks, workers, results, callback=None, timeout=TASK_TIMEOUT):
+    '''
+    Scores the tasks with the workers, dropping those that die or time out
+    from the list.  The tasks left over when there are no workers are
+    scored in this process.
+    '''
+    scored = []
+    todo = list(reversed(tasks))
+    def finish(result):
+        scored.append(result)
+        if callback:
+            callback(len(scored))
+    def drop(worker, why):
+        workers.remove(worker)
+        worker.stop()
+        C, gamma = worker.task[:2]
+        logging.error('Worker process %s (exit code %s) while training with C=%s gamma=%s, dropping it.'%
+                      (why, worker.proc.returncode, C, gamma))
+        finish((C, gamma, None, time() - worker.started))
+
+    while workers:
+        for worker in list(workers):
+            if worker.task is None and todo:
+                try:
+                    worker.send(todo.pop())
+                except IOError:
+                    drop(worker, 'exited')
+            elif worker.task is not None and time() - worker.started > timeout:
+                drop(worker, 'timed out')
+        if not [w for w in workers if w.task is not None]:
+            break
+        try:
+            worker, result = results.get(timeout=1.0)
+        except Empty:
+            continue
+        if worker not in workers:
+            # from a worker that was already dropped
+            continue
+        if result is None:
+            drop(worker, 'exited')
+        else:
+            worker.task = None
+            finish(result)
+
+    for task in reversed(todo):
+        finish(score_parameters(task))
+    return scored
+
+def _worker_main():
+    '''
+    Runs a worker process: reads the (values, labels) pickle and then task
+    pickles from stdin, and writes the pickled result of each task to
+    stdout.
+    '''
+    stdin, stdout = sys.stdin, sys.stdout
+    if sys.platform == 'win32':
+        import msvcrt
+        msvcrt.setmode(stdin.fileno(), os.O_BINARY)
+        msvcrt.setmode(stdout.fileno(), os.O_BINARY)
+    # keep anything printed while training out of the results
+    sys.stdout = sys.stderr
+    _init_worker(*cPickle.load(stdin))
+    while True:
+        try:
+            task = cPickle.load(stdin)
+        except EOFError:
+            return
+        cPickle.dump(score_parameters(task), stdout, cPickle.HIGHEST_PROTOCOL)
+        stdout.flush()
+
+def grid_search(values, labels, Cs, gammas, n_folds=5, n_workers=1, halving=False, callback=None):
+    '''
+    Scores each pair of Cs and gammas by n_folds-fold cross-validation.
+    n_workers: the number of processes (0 or None for all cores)
+    halving: successive halving, where after each fold only the better
+        half of the pairs (by mean score so far) go on to the next fold
+    callback: function to update with the fraction complete
+    Returns (best_C, best_gamma, best_score, results), where results maps
+    each (C, gamma) to (mean score, seconds) over the folds it was scored on.
+    '''
+    values = np.asarray(values)
+    labels = np.asarray(labels)
+    folds = stratified_folds(labels, n_folds)
+    pairs = [(C, gamma) for C in Cs for gamma in gammas]
+
+    scores = dict((pair, []) for pair in pairs)
+    seconds = dict((pair, 0.0) for pair in pairs)
+    if halving:
+        total = sum([max(1, len(pairs) // 2**k) for k in range(n_folds)])
+    else:
+        total = len(pairs) * n_folds
+    done = [0]
+    def update(n):
+        if callback:
+            callback(min(1.0, (done[0] + n) / float(total)))
+
+    if not n_workers:
+        n_workers = cpu_count()
+    # for the tasks scored in this process
+    _init_worker(values, labels)
+    workers, queue = [], None
+    if n_workers > 1:
+        workers, queue = _start_workers(values, labels, n_workers)
+
+    try:
+        if halving:
+            rungs = [[fold] for fold in folds]
+        else:
+            rungs = [folds]
+        alive = pairs
+        for rung, rung_folds in enumerate(rungs):
+            if halving and rung > 0:
+                alive = sorted(alive, key=lambda pair: -np.mean(scores[pair]))[:max(1, len(alive) // 2)]
+            tasks = [(C, gamma, train, test) for C, gamma in alive for train, test in rung_folds]
+            results = _run_tasks(tasks, workers, queue, update)
+            done[0] += len(tasks)
+            for C, gamma, score, secs in results:
+                # failed fits count as the worst score
+                scores[C, gamma].append(0.0 if score is None else score)
+                seconds[C, gamma] += secs
+    finally:
+        for worker in workers:
+            worker.stop()
+
+    # only the pairs scored on every fold are eligible
+    n_scored = max([len(s) for s in scores.values()])
+    results = dict((pair, (np.mean(scores[pair]), seconds[pair]))
+                   for pair in pairs if len(scores[pair]) > 0)
+    for (C, gamma), (score, secs) in sorted(results.items()):
+        logging.info('C=%s gamma=%s: precision %.3f in %.2fs over %d folds'%(C, gamma, score, secs, len(scores[C, gamma])))
+    best = max([pair for pair in pairs if len(scores[pair]) == n_scored],
+               key=lambda pair: results[pair][0])
+    return best[0], best[1], results[best][0], results
+
+
+if __name__ == '__main__':
+    _worker_main()
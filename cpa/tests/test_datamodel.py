@@ -1,5 +1,9 @@
 from mock import patch
+import os
+import shutil
+import tempfile
 import unittest
+import numpy as np
 import cpa.datamodel
 
 class PopulatePlateMapsTestCase(unittest.TestCase):
@@ -78,3 +82,169 @@ class GetWellPositionFromName(unittest.TestCase):
 
     def test_reverse_absent(self):
         self.assertRaises(KeyError, lambda: self.dm.get_well_name_from_position((1, 0)))
+
+
+class ObjectIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dm = cpa.datamodel.DataModel.getInstance()
+        self.p = cpa.datamodel.p
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.object_table = 'Per_Object'
+        self.dm.DeleteModel()
+        self.dm._set_image_keys(np.array([[1], [2], [3]]))
+        self.dm._set_counts([2, 0, 3])
+        with patch('cpa.datamodel.db') as db:
+            # unsorted, non-contiguous ids, and an object of an unknown image
+            db.execute_columns.return_value = [np.array([3, 1, 3, 9, 1, 3]),
+                                               np.array([7, 5, 2, 1, 4, 5])]
+            self.dm._build_object_index()
+
+    def tearDown(self):
+        self.dm.DeleteModel()
+
+    def test_index(self):
+        self.assertEqual(self.dm.obIds.tolist(), [4, 5, 2, 5, 7])
+        self.assertEqual(self.dm.obOffsets.tolist(), [0, 2, 2, 5])
+
+    def test_objects_from_image(self):
+        self.assertEqual(self.dm.GetObjectsFromImage((3,)), [(3, 2), (3, 5), (3, 7)])
+        self.assertEqual(self.dm.GetObjectsFromImage((2,)), [])
+
+    def test_random_objects(self):
+        all_keys = set([(1, 4), (1, 5), (3, 2), (3, 5), (3, 7)])
+        obs = self.dm.GetRandomObjects(200)
+        self.assertEqual(len(obs), 200)
+        self.assertEqual(set(obs), all_keys)
+        self.assertTrue(self.dm.GetRandomObject() in all_keys)
+
+    def test_random_object_without_objects(self):
+        with patch('cpa.datamodel.db') as db:
+            db.execute_columns.return_value = [np.array([], dtype=int), np.array([], dtype=int)]
+            self.dm._build_object_index()
+        self.assertEqual(self.dm.GetRandomObject(), None)
+        self.assertEqual(self.dm.GetRandomObjects(5), [])
+
+    def test_random_objects_from_images(self):
+        obs = self.dm.GetRandomObjects(100, [(2,), (1,)])
+        self.assertEqual(set(obs), set([(1, 4), (1, 5)]))
+        self.assertEqual(self.dm.GetRandomObjects(10, [(2,)]), [])
+
+    def test_without_replacement(self):
+        obs = self.dm.GetRandomObjects(4, with_replacement=False)
+        self.assertEqual(len(set(obs)), 4)
+        obs = self.dm.GetRandomObjects(10, [(3,), (2,)], with_replacement=False)
+        self.assertEqual(sorted(obs), [(3, 2), (3, 5), (3, 7)])
+
+    def test_sample_sums_cached(self):
+        selected, sums = self.dm._get_sample_sums([(3,), (2,), (1,)], 'all')
+        self.assertEqual(selected.tolist(), [2, 0])
+        self.assertEqual(sums.tolist(), [3, 5])
+        self.assertTrue(self.dm._get_sample_sums([(3,), (2,), (1,)], 'all')[1] is sums)
+        self.assertFalse(self.dm._get_sample_sums([(3,), (2,), (1,)])[1] is sums)
+        obs = self.dm.GetRandomObjects(10, [(1,)], cache_key='first')
+        self.assertEqual(set(obs), set([(1, 4), (1, 5)]))
+        self.assertTrue('first' in self.dm.sampleCache)
+
+
+class GroupTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dm = cpa.datamodel.DataModel.getInstance()
+        self.dm.DeleteModel()
+        # keys are sorted on packing, counts and groups follow that order
+        self.dm._set_image_keys(np.array([[1, 2], [0, 5], [1, 1], [0, 7]]))
+        self.dm._set_counts([1, 2, 4, 3])
+        # (0,5) and (1,1) are in A01, (0,7) in A02 and (1,2) in no well
+        self.dm._set_group('Well', ['well'], [('A01',), ('A02',), ('A03',)],
+                           np.array([0, 1, 0, -1], dtype='i4'))
+
+    def tearDown(self):
+        self.dm.DeleteModel()
+
+    def test_pack_image_keys(self):
+        packed = cpa.datamodel.pack_image_keys([(0, 7), (1, 1)])
+        self.assertEqual(packed.tolist(), [7, (1 << 32) | 1])
+        self.assertEqual(cpa.datamodel.pack_image_keys([(3,), (2,)]).tolist(), [3, 2])
+
+    def test_image_keys(self):
+        self.assertEqual(self.dm.GetAllImageKeys(), [(0, 5), (0, 7), (1, 1), (1, 2)])
+        self.assertEqual(self.dm.GetObjectCountFromImage((1, 1)), 4)
+        self.assertEqual(self.dm.GetObjectCounts([(1, 2), (0, 7)]).tolist(), [3, 2])
+        self.assertRaises(KeyError, lambda: self.dm.GetObjectCountFromImage((2, 1)))
+
+    def test_images_in_group(self):
+        self.assertEqual(self.dm.GetImagesInGroup('Well', ('A01',)), [(0, 5), (1, 1)])
+        self.assertEqual(self.dm.GetImagesInGroup('Well', ('A03',)), [])
+        self.assertEqual(self.dm.GetImagesInGroup('Well', ('B01',)), [])
+        self.assertEqual(sorted(self.dm.GetImagesInGroupWithWildcards('Well', ('__ANY__',))),
+                         [(0, 5), (0, 7), (1, 1)])
+        self.assertEqual(sorted(self.dm.GetGroupKeysInGroup('Well')), [('A01',), ('A02',)])
+        self.assertEqual(self.dm.GetGroupColumnTypes('Well'), [str])
+
+    def test_sum_to_group(self):
+        sums = self.dm.SumToGroup({(1, 1): np.array([1, 2]), (0, 5): np.array([3, 4]),
+                                   (0, 7): np.array([5, 6])}, 'Well')
+        self.assertEqual(sorted(sums.keys()), [('A01',), ('A02',)])
+        self.assertEqual(sums[('A01',)].tolist(), [4, 6])
+        self.assertEqual(sums[('A02',)].tolist(), [5, 6])
+        self.assertRaises(KeyError, lambda: self.dm.SumToGroup({(1, 2): np.array([1])}, 'Well'))
+
+
+class SampleIndicesTestCase(unittest.TestCase):
+    def test_distinct(self):
+        for N in [1, 10, 100]:
+            draws = cpa.datamodel._sample_indices(1000, N, with_replacement=False)
+            self.assertEqual(len(set(draws.tolist())), N)
+            self.assertTrue(0 <= draws.min() and draws.max() < 1000)
+
+    def test_more_than_available(self):
+        draws = cpa.datamodel._sample_indices(5, 10, with_replacement=False)
+        self.assertEqual(sorted(draws.tolist()), range(5))
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dm = cpa.datamodel.DataModel.getInstance()
+        self.p = cpa.datamodel.p
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.tmpdir = tempfile.mkdtemp()
+        self.old_filename = self.p.__dict__.get('_filename')
+        self.p._filename = os.path.join(self.tmpdir, 'test.properties')
+        with open(self.p._filename, 'w') as f:
+            f.write('db_type = sqlite\n')
+        self.dm.DeleteModel()
+        self.dm._set_image_keys(np.array([[1], [2]]))
+        self.dm._set_counts([2, 0])
+        self.dm.obIds = np.array([4, 5], dtype='int32')
+        self.dm.obOffsets = np.array([0, 2, 2])
+        self.dm._set_group('Well', ['well'], [('A01',)], np.array([0, 0], dtype='i4'))
+
+    def tearDown(self):
+        self.p._filename = self.old_filename
+        self.dm.DeleteModel()
+        shutil.rmtree(self.tmpdir)
+
+    @patch('cpa.datamodel.get_cpa_data_dir')
+    @patch('cpa.datamodel.db')
+    def test_round_trip(self, db, get_cpa_data_dir):
+        get_cpa_data_dir.return_value = self.tmpdir
+        db.get_objects_modify_date.return_value = 100.0
+        self.dm._save_snapshot()
+        self.dm.DeleteModel()
+        self.assertTrue(self.dm._load_snapshot())
+        self.assertEqual(self.dm.GetImageKeysAndObjectCounts(), [((1,), 2), ((2,), 0)])
+        self.assertEqual(self.dm.obCount, 2)
+        self.assertEqual(self.dm.GetObjectsFromImage((1,)), [(1, 4), (1, 5)])
+        self.assertEqual(self.dm.GetImagesInGroup('Well', ('A01',)), [(1,), (2,)])
+        self.assertEqual(self.dm.GetGroupKeysInGroup('Well'), [('A01',)])
+
+    @patch('cpa.datamodel.get_cpa_data_dir')
+    @patch('cpa.datamodel.db')
+    def test_out_of_date(self, db, get_cpa_data_dir):
+        get_cpa_data_dir.return_value = self.tmpdir
+        db.get_objects_modify_date.return_value = 100.0
+        self.dm._save_snapshot()
+        db.get_objects_modify_date.return_value = 200.0
+        self.assertFalse(self.dm._load_snapshot())
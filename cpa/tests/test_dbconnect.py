@@ -1,23 +1,116 @@
 import threading
 from mock import patch, Mock
 import unittest
+import numpy as np
 import cpa.dbconnect
 
 
-class ExecuteTestCase(unittest.TestCase):
-
+class MockConnectionTestCase(unittest.TestCase):
+    '''
+    Gives the current thread a mock connection and cursor in the DBConnect
+    singleton, and takes them away again after the test.
+    '''
     def setUp(self):
         self.p = cpa.dbconnect.p
         self.db = cpa.dbconnect.DBConnect.getInstance()
-        cursor = Mock()
-        connID = threading.currentThread().getName()
-        self.db.connections[connID] = Mock()
-        self.db.cursors[connID] = cursor
+        self.connID = threading.currentThread().getName()
+        self.saved = (self.p.db_type, self.db.connections.get(self.connID), 
+                      self.db.cursors.get(self.connID))
+        self.cursor = Mock()
+        self.db.connections[self.connID] = Mock()
+        self.db.cursors[self.connID] = self.cursor
+
+    def tearDown(self):
+        db_type, conn, cursor = self.saved
+        self.p.db_type = db_type
+        for d, value in [(self.db.connections, conn), (self.db.cursors, cursor)]:
+            if value is None:
+                d.pop(self.connID, None)
+            else:
+                d[self.connID] = value
+
+
+class ExecuteTestCase(MockConnectionTestCase):
 
     def test_args_to_sqlite(self):
         self.p.db_type = 'SQLite'
         self.assertRaises(TypeError, lambda: self.db.execute('query', 'args'))
 
+
+class ExecuteIterTestCase(MockConnectionTestCase):
+
+    def setUp(self):
+        MockConnectionTestCase.setUp(self)
+        self.p.db_type = 'sqlite'
+        self.cursor.fetchmany.side_effect = [[(1,), (2,)], [(3,)], [], []]
+
+    def test_batches(self):
+        batches = list(self.db.execute_iter('query', batch_size=2))
+        self.assertEqual(batches, [[(1,), (2,)], [(3,)]])
+        self.cursor.execute.assert_called_once_with('query')
+
+    def test_close_reads_remaining_rows(self):
+        it = self.db.execute_iter('query', batch_size=2)
+        self.assertEqual(it.next(), [(1,), (2,)])
+        it.close()
+        self.assertEqual(self.cursor.fetchmany.call_count, 3)
+
+    def test_connection_restored(self):
+        self.tearDown()
+        self.assertFalse(isinstance(self.db.cursors.get(self.connID), Mock))
+        self.setUp()
+
+
+class ExecuteColumnsTestCase(MockConnectionTestCase):
+
+    def setUp(self):
+        MockConnectionTestCase.setUp(self)
+        self.p.db_type = 'sqlite'
+        self.cursor.description = [('a',), ('b',), ('c',)]
+
+    def test_inferred_dtypes(self):
+        self.cursor.fetchmany.side_effect = [[(1, 1.5, 'x'), (2, None, 'y')], [(None, 3.5, 'z')], []]
+        a, b, c = self.db.execute_columns('query', batch_size=2)
+        self.assertEqual(a.dtype.kind, 'f')
+        self.assertEqual(a[:2].tolist(), [1, 2])
+        self.assertTrue(np.isnan(a[2]))
+        self.assertEqual(b.dtype.kind, 'f')
+        self.assertEqual(len(b), 3)
+        self.assertTrue(np.isnan(b[1]))
+        self.assertEqual(c.tolist(), ['x', 'y', 'z'])
+
+    def test_widen_to_float(self):
+        self.cursor.fetchmany.side_effect = [[(1, 1, 'x')], [(2, 2.5, 'y')], []]
+        a, b, c = self.db.execute_columns('query', batch_size=1)
+        self.assertEqual(a.dtype.kind, 'i')
+        self.assertEqual(b.dtype.kind, 'f')
+        self.assertEqual(b.tolist(), [1., 2.5])
+
+    def test_given_dtypes(self):
+        self.cursor.fetchmany.side_effect = [[(1, 2, 'x')], []]
+        a, b, c = self.db.execute_columns('query', dtypes=['i8', 'f8', 'O'])
+        self.assertEqual(a.dtype, np.dtype('i8'))
+        self.assertEqual(b.dtype, np.dtype('f8'))
+        self.assertEqual(c.tolist(), ['x'])
+
+    def test_empty(self):
+        self.cursor.fetchmany.side_effect = [[]]
+        columns = self.db.execute_columns('query')
+        self.assertEqual([len(col) for col in columns], [0, 0, 0])
+
+    def test_callback_stops(self):
+        self.cursor.fetchmany.side_effect = [[(1, 2, 'x')], [(3, 4, 'y')], [(5, 6, 'z')], []]
+        counts = []
+        def callback(n):
+            counts.append(n)
+            return n < 2
+        a, b, c = self.db.execute_columns('query', dtypes=['i8', 'f8', 'O'], batch_size=1,
+                                          callback=callback)
+        self.assertEqual(counts, [1, 2])
+        self.assertEqual(a.tolist(), [1, 3])
+        # the rest of the result was read off the cursor
+        self.assertEqual(self.cursor.fetchmany.call_count, 4)
+
         
 class CheckColnameUserTestCase(unittest.TestCase):
     def setUp(self):
@@ -60,10 +153,10 @@ class AppendColumnTestCase(unittest.TestCase):
         self.assertRaises(ValueError, lambda: self.db.AppendColumn('FooTable', 'foo$bar', 'TEXT'))
 
 
-class UpdateWellsTestCase(unittest.TestCase):
+class UpdateWellsTestCase(MockConnectionTestCase):
     def setUp(self):
-        self.db = cpa.dbconnect.DBConnect.getInstance()
-        self.p = cpa.dbconnect.p
+        MockConnectionTestCase.setUp(self)
+        self.p.db_type = 'sqlite'
         self.p.image_table = 'Per_Image'
         self.p.object_table = 'Per_Object'
         self.p.well_id = 'Well'
@@ -92,3 +185,130 @@ class UpdateWellsTestCase(unittest.TestCase):
 
 
 
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dead = set()
+        def ping(conn):
+            if conn in self.dead:
+                raise Exception('gone away')
+        self.pool = cpa.dbconnect.ConnectionPool(Mock, ping, max_size=2, timeout=0.1)
+
+    def test_reuse(self):
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        self.assertEqual(self.pool.checkout(), conn)
+        stats = self.pool.stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 1)
+
+    def test_dead_connection_replaced(self):
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        self.dead.add(conn)
+        self.assertNotEqual(self.pool.checkout(), conn)
+        self.assertTrue(conn.close.called)
+        self.assertEqual(self.pool.stats()['failed_checks'], 1)
+
+    def test_bounded(self):
+        self.pool.checkout()
+        holder = threading.Thread(target=self.pool.checkout, name='Holder')
+        holder.start()
+        holder.join()
+        try:
+            self.pool.checkout()
+        except cpa.dbconnect.DBException, e:
+            # the error names the threads holding the connections
+            self.assertTrue('Holder, MainThread' in str(e))
+        else:
+            self.fail('checkout did not time out')
+        self.assertEqual(cpa.dbconnect.ConnectionPool(Mock, ping=None).timeout, 60)
+
+    def test_wait_for_checkin(self):
+        self.pool.timeout = None
+        conn = self.pool.checkout()
+        self.pool.checkout()
+        self.assertEqual(self.pool.available(), 0)
+        threading.Timer(0.05, self.pool.checkin, [conn]).start()
+        self.assertEqual(self.pool.checkout(), conn)
+        self.assertEqual(self.pool.stats()['waits'], 1)
+
+    def test_evict_idle(self):
+        self.pool.max_idle = -1
+        conn = self.pool.checkout()
+        self.pool.checkin(conn)
+        self.assertEqual(self.pool.stats()['idle'], 0)
+        self.assertTrue(conn.close.called)
+
+
+class GetObjectsDataTestCase(unittest.TestCase):
+    def setUp(self):
+        self.p = cpa.dbconnect.p
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.object_table = 'Per_Object'
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+
+    def test_where_clause(self):
+        self.assertEqual(cpa.dbconnect.GetWhereClauseForObjectsByImage([(2, 4), (1, 3), (1, 4)]),
+                         '((ImageNumber=1 AND ObjectNumber IN (3,4)) OR (ImageNumber=2 AND ObjectNumber IN (4)))')
+
+    def test_caller_order(self):
+        columns = [np.array([1, 1, 2]), np.array([3, 4, 4]), np.array([13., 14., 24.])]
+        with patch.object(self.db, 'execute_columns', return_value=columns) as execute_columns:
+            data = self.db._get_objects_data([(2, 4), (1, 3), (5, 5), (2, 4)], ['x'])
+        self.assertEqual(execute_columns.call_count, 1)
+        self.assertEqual(data[:2, 0].tolist(), [24., 13.])
+        self.assertTrue(np.isnan(data[2, 0]))
+        self.assertEqual(data[3, 0], 24.)
+
+    def test_null_is_zero(self):
+        columns = [np.array([1, 1]), np.array([3, 4]), np.array([np.nan, 14.]), 
+                   np.array([np.nan, np.nan])]
+        with patch.object(self.db, 'execute_columns', return_value=columns):
+            data = self.db._get_objects_data([(1, 3), (1, 4), (1, 5)], ['x', 'y'])
+        self.assertEqual(data[:2].tolist(), [[0., 0.], [14., 0.]])
+        self.assertTrue(np.isnan(data[2]).all())
+
+    def test_chunks(self):
+        columns = [np.array([], dtype=int), np.array([], dtype=int), np.array([])]
+        with patch.object(self.db, 'execute_columns', return_value=columns) as execute_columns:
+            data = self.db._get_objects_data([(1, i) for i in range(5)], ['x'], chunk_size=2)
+        self.assertEqual(execute_columns.call_count, 3)
+        self.assertEqual(data.shape, (5, 1))
+
+
+class GetObjectsCoordsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.db = cpa.dbconnect.DBConnect.getInstance()
+        self.db.coords_cache.clear()
+        self.p = cpa.dbconnect.p
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.object_table = 'Per_Object'
+        self.p.cell_x_loc = 'x'
+        self.p.cell_y_loc = 'y'
+
+    def test_one_query(self):
+        rows = [(1, 3, 1.5, 2.5), (2, 4, 3.5, None)]
+        with patch.object(self.db, 'execute', return_value=rows) as execute:
+            coords = self.db.GetObjectsCoords([(2, 4), (1, 3), (1, 5)])
+        self.assertEqual(execute.call_count, 1)
+        self.assertEqual(coords, [None, (1.5, 2.5), None])
+
+    def test_image_cache(self):
+        rows = [(2, 20., 21.), (1, 10., 11.)]
+        with patch.object(self.db, 'execute', return_value=rows) as execute:
+            self.assertEqual(self.db.GetAllObjectCoordsFromImage((7,)), [(10., 11.), (20., 21.)])
+            self.assertEqual(self.db.GetObjectsCoords([(7, 2), (7, 1)]), [(20., 21.), (10., 11.)])
+        self.assertEqual(execute.call_count, 1)
+
+    def test_image_cache_size(self):
+        with patch.object(self.db, 'execute', return_value=[]):
+            for i in range(cpa.dbconnect.COORDS_CACHE_SIZE + 1):
+                self.db.GetObjectCoordsByImage((i,))
+        self.assertEqual(len(self.db.coords_cache), cpa.dbconnect.COORDS_CACHE_SIZE)
+        self.assertFalse((0,) in self.db.coords_cache)
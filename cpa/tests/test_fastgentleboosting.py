@@ -0,0 +1,83 @@
+import unittest
+import numpy as np
+from cpa.fastgentleboostingworkermulticlass import fit_weak_learner, presort_append, presort_subset, presort_values, train_weak_learner, train_weak_learners
+import cpa.fastgentleboostingmulticlass
+
+class WeakLearnerTestCase(unittest.TestCase):
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.values = np.round(rs.randn(40, 7) * 3)    # plenty of ties
+        self.labels = -np.ones((40, 3), int)
+        self.labels[np.arange(40), rs.randint(0, 3, 40)] = 1
+        self.weights = rs.rand(40, 3).astype(np.float32)
+
+    def test_presort(self):
+        order, s_values, run_end = presort_values(np.array([3., 1., 3., 2.]))
+        self.assertEqual(order[:, 0].tolist(), [1, 3, 0, 2])
+        self.assertEqual(s_values[:, 0].tolist(), [1., 2., 3., 3.])
+        self.assertEqual(run_end[:, 0].tolist(), [0, 1, 3, 3])
+
+    def test_threshold_at_top_of_ties(self):
+        values = np.array([0., 1., 1., 1., 2.])
+        labels = np.array([[1, -1], [1, -1], [1, -1], [1, -1], [-1, 1]])
+        thresh, err, a, b = train_weak_learner(labels, np.ones((5, 2)), values)
+        self.assertEqual(thresh, 1.)
+        self.assertEqual(err, 0.)
+        self.assertEqual(a.tolist(), [-1., 1.])
+        self.assertEqual(b.tolist(), [1., -1.])
+
+    def test_blocks_match_single_columns(self):
+        best = None
+        for column in range(self.values.shape[1]):
+            thresh, err, a, b = train_weak_learner(self.labels, self.weights, self.values[:, column])
+            if best is None or err < best[2]:
+                best = (column, thresh, err, a, b)
+        presorted = presort_values(self.values)
+        for block_size in [1, 3, 7, None]:
+            column, thresh, err, a, b = train_weak_learners(self.labels, self.weights, presorted, block_size)
+            self.assertEqual((column, thresh, err), best[:3])
+            np.testing.assert_array_equal(a, best[3])
+            np.testing.assert_array_equal(b, best[4])
+
+    def test_workers_match_serial(self):
+        presorted = presort_values(self.values)
+        serial = train_weak_learners(self.labels, self.weights, presorted, block_size=2)
+        for n_workers in [2, 3]:
+            parallel = train_weak_learners(self.labels, self.weights, presorted,
+                                           block_size=2, n_workers=n_workers)
+            self.assertEqual(parallel[:3], serial[:3])
+            np.testing.assert_array_equal(parallel[3], serial[3])
+            np.testing.assert_array_equal(parallel[4], serial[4])
+
+    def test_train(self):
+        colnames = ['f%d' % i for i in range(self.values.shape[1])]
+        learners = cpa.fastgentleboostingmulticlass.train(colnames, 5, self.labels, self.values)
+        self.assertTrue(0 < len(learners) <= 5)
+        for colname, thresh, a, b, margin in learners:
+            self.assertTrue(colname in colnames)
+            self.assertEqual(a.shape, (3,))
+        parallel = cpa.fastgentleboostingmulticlass.train(colnames, 5, self.labels, self.values, n_workers=2)
+        self.assertEqual([l[:2] for l in parallel], [l[:2] for l in learners])
+
+    def test_presort_subset(self):
+        presorted = presort_values(self.values)
+        rows = np.array([0, 3, 4, 10, 11, 12, 25, 39])
+        expected = presort_values(self.values[rows])
+        for sub, exp in zip(presort_subset(presorted, rows), expected):
+            np.testing.assert_array_equal(sub, exp)
+        mask = np.zeros(40, bool)
+        mask[rows] = True
+        np.testing.assert_array_equal(presort_subset(presorted, mask)[0], expected[0])
+
+    def test_presort_append(self):
+        presorted = presort_values(self.values[:25])
+        appended = presort_append(presorted, self.values[25:])
+        for sub, exp in zip(appended, presort_values(self.values)):
+            np.testing.assert_array_equal(sub, exp)
+
+    def test_fit_weak_learner(self):
+        column, thresh, err, a, b = train_weak_learners(self.labels, self.weights, presort_values(self.values))
+        fit = fit_weak_learner(self.labels, self.weights, self.values[:, column], thresh)
+        np.testing.assert_allclose(fit[0], err, rtol=1e-5)
+        np.testing.assert_allclose(fit[1], a, rtol=1e-5)
+        np.testing.assert_allclose(fit[2], b, rtol=1e-5)
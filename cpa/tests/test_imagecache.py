@@ -0,0 +1,82 @@
+import threading
+import time
+import unittest
+import numpy as np
+from cpa.imagecache import ImageCache
+
+def image(nbytes):
+    return [np.zeros(nbytes, dtype=np.uint8)]
+
+class ImageCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.reads = []
+
+    def load(self, key):
+        self.reads.append(key)
+        return image(key)
+
+    def test_hits(self):
+        cache = ImageCache(max_items=3)
+        cache.get(10, self.load)
+        cache.get(20, self.load)
+        cache.get(10, self.load)
+        self.assertEqual(self.reads, [10, 20])
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['bytes']), (1, 2, 30))
+
+    def test_lru_by_count(self):
+        cache = ImageCache(max_items=2)
+        for key in [10, 20, 10, 30]:
+            cache.get(key, self.load)
+        # 20 was the least recently used
+        self.assertTrue(10 in cache and 30 in cache)
+        self.assertFalse(20 in cache)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_lru_by_bytes(self):
+        cache = ImageCache(max_bytes=100)
+        for key in [40, 50, 40, 30]:
+            cache.get(key, self.load)
+        self.assertEqual(sorted(cache.entries.keys()), [30, 40])
+        self.assertEqual(cache.nbytes, 70)
+        # a single image over the budget is still kept
+        cache.get(200, self.load)
+        self.assertEqual(cache.entries.keys(), [200])
+        cache.set_limits(max_bytes=100)
+        self.assertEqual(len(cache), 1)
+
+    def test_set_limits(self):
+        cache = ImageCache()
+        for key in [1, 2, 3, 4]:
+            cache.get(key, self.load)
+        cache.set_limits(max_items=2)
+        self.assertEqual(cache.entries.keys(), [3, 4])
+
+    def test_single_read(self):
+        cache = ImageCache()
+        started = threading.Event()
+        def slow_load(key):
+            started.set()
+            time.sleep(0.1)
+            return self.load(key)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get(5, slow_load)))
+                   for i in range(4)]
+        threads[0].start()
+        started.wait()
+        for t in threads[1:]:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(self.reads, [5])
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all([r is results[0] for r in results]))
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_failed_read(self):
+        cache = ImageCache()
+        def bad_load(key):
+            raise IOError('unreadable')
+        self.assertRaises(IOError, cache.get, 1, bad_load)
+        self.assertEqual(cache.reads, {})
+        self.assertEqual(cache.get(1, self.load)[0].nbytes, 1)
@@ -0,0 +1,39 @@
+import unittest
+from mock import patch
+import numpy as np
+import cpa.imagetools
+from cpa.properties import Properties
+
+p = Properties.getInstance()
+
+class FetchTilesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.saved = dict((field, p.__dict__.get(field)) for field in
+                          ['image_tile_size', 'image_rescale', 'image_rescale_from', 'rescale_object_coords'])
+        p.image_tile_size = '4'
+        p.image_rescale = None
+        p.__dict__.pop('image_rescale_from', None)
+        p.rescale_object_coords = True
+        self.image = np.arange(20 * 20, dtype=float).reshape((20, 20))
+
+    def tearDown(self):
+        for field, value in self.saved.items():
+            if value is None:
+                p.__dict__.pop(field, None)
+            else:
+                p.__dict__[field] = value
+
+    def fetch_image(self, imKey):
+        # reading the image is what sets the scales (see check_image_shape_compatibility)
+        p.image_rescale = [20., 20.]
+        p.image_rescale_from = [10., 10.]
+        return [self.image]
+
+    def test_rescale_object_coords(self):
+        with patch.object(cpa.imagetools.db, 'GetFullChannelPathsForImage', return_value=['1.tif']):
+            with patch('cpa.imagetools.FetchImage', self.fetch_image):
+                tiles = cpa.imagetools.FetchTiles([(1, 1), (1, 2)], [(5, 4), (2, 3)])
+        # coordinates in the smaller channel are doubled to crop this one
+        # (Crop marks the first and last pixels, so compare the rows between)
+        np.testing.assert_array_equal(tiles[0][0][1:-1], self.image[7:9, 8:12])
+        np.testing.assert_array_equal(tiles[1][0][1:-1], self.image[5:7, 2:6])
@@ -1,6 +1,11 @@
 import mock
+import os
+import shutil
+import tempfile
 from nose.tools import eq_
 from unittest import TestCase
+import numpy
+import cpa.dbconnect
 import cpa.multiclasssql
 
 class WhereClausesTestCase(TestCase):
@@ -23,3 +28,334 @@ class WhereClausesTestCase(TestCase):
         eq_(result, ['(Per_Object.ImageNumber <= 5)'])
 
 
+
+class ScoringThreadsTestCase(TestCase):
+    def setUp(self):
+        self.p = cpa.multiclasssql.p
+        self.p.scoring_threads = '6'
+
+    def tearDown(self):
+        self.p.scoring_threads = None
+
+    def test_capped_by_free_connections(self):
+        with mock.patch('cpa.multiclasssql.db') as db:
+            db.get_pool.return_value.available.return_value = 3
+            eq_(cpa.multiclasssql._scoring_threads(10), 3)
+            db.get_pool.return_value.available.return_value = 1
+            eq_(cpa.multiclasssql._scoring_threads(10), 1)
+            db.get_pool.return_value.available.return_value = 0
+            eq_(cpa.multiclasssql._scoring_threads(10), 1)
+
+
+class ClassifyTestCase(TestCase):
+    def setUp(self):
+        # two rules on the same column, three classes
+        self.weaklearners = [('x', 0.5, [1., -1., 0.], [-1., 1., 0.], 0),
+                             ('y', 2.0, [0., 0., 3.], [0., 0., -3.], 0),
+                             ('x', 1.5, [0., 0., 1.], [0., 1., 0.], 0)]
+
+    def test_rule_columns(self):
+        eq_(cpa.multiclasssql.rule_columns(self.weaklearners), (['x', 'y'], [0, 1, 0]))
+
+    def test_matches_sqlite_classifier(self):
+        rs = numpy.random.RandomState(0)
+        values = rs.randn(200, 2) * 2
+        values[::7, 0] = numpy.nan
+        classifier = cpa.dbconnect.SqliteClassifier()
+        classifier.setup_classifier(numpy.array([wl[1] for wl in self.weaklearners]),
+                                    numpy.array([wl[2] for wl in self.weaklearners]),
+                                    numpy.array([wl[3] for wl in self.weaklearners]))
+        expected = [classifier.classify(*[None if numpy.isnan(v) else v for v in (x, y, x)])
+                    for x, y in values]
+        eq_(cpa.multiclasssql.classify(self.weaklearners, values).tolist(), expected)
+
+
+class NumpyScoringTestCase(TestCase):
+    def setUp(self):
+        self.p = cpa.multiclasssql.p
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.object_table = 'Per_Object'
+        self.p.area_scoring_column = None
+        self.p.scoring_engine = 'numpy'
+        self.weaklearners = [('x', 0.5, [1., -1.], [-1., 1.], 0)]
+        self.dm = mock.Mock()
+        self.dm.GetAllImageKeys.return_value = [(3,), (1,), (2,)]
+        self.dm.GetImageKeysAndObjectCounts.return_value = [((3,), 1), ((1,), 3), ((2,), 0)]
+        # objects of images 1 and 3, plus one of image 5 which isn't in the filter
+        self.columns = [numpy.array([1, 1, 3, 1, 5]), numpy.array([1, 2, 1, 3, 1]),
+                        numpy.array([1., 0., 2., numpy.nan, 1.])]
+
+    def tearDown(self):
+        self.p.scoring_engine = None
+
+    def test_per_image_counts(self):
+        with mock.patch('cpa.multiclasssql.db') as db:
+            with mock.patch('cpa.multiclasssql.dm', self.dm):
+                db.execute_columns.return_value = self.columns
+                counts = cpa.multiclasssql.PerImageCounts(self.weaklearners)
+        eq_(counts, [[3, 1, 0], [1, 1, 2], [2, 0, 0]])
+
+    def test_filter_objects_from_class(self):
+        with mock.patch('cpa.multiclasssql.db') as db:
+            db.execute_columns.return_value = self.columns
+            eq_(cpa.multiclasssql.FilterObjectsFromClassN(2, self.weaklearners, [(1,), (3,)]),
+                [(1, 2), (1, 3)])
+
+    def test_parallel_per_image_counts(self):
+        self.p.scoring_threads = '3'
+        self.dm.GetImageKeysAndObjectCounts.return_value = [((i,), 0) for i in range(1, 201)]
+        empty = [numpy.zeros(0, 'i8'), numpy.zeros(0, 'i8'), numpy.zeros(0)]
+        progress = []
+        released = []
+        try:
+            with mock.patch('cpa.multiclasssql.db') as db:
+                with mock.patch('cpa.multiclasssql.dm', self.dm):
+                    db.get_pool.return_value.available.return_value = 9
+                    # Mock's call counts aren't thread-safe
+                    db.release_connection.side_effect = lambda: released.append(1)
+                    # only the first range has objects
+                    db.execute_columns.side_effect = lambda query, **kwargs: (
+                        self.columns if '<= 50)' in query and ' > ' not in query else empty)
+                    counts = cpa.multiclasssql.PerImageCounts(self.weaklearners, cb=progress.append)
+        finally:
+            self.p.scoring_threads = None
+        eq_(counts[:4], [[1, 1, 2], [2, 0, 0], [3, 1, 0], [4, 0, 0]])
+        eq_(len(counts), 200)
+        eq_(len(progress), 4)
+        eq_(len(released), 4)
+
+
+class ScoreCacheTestCase(TestCase):
+    def setUp(self):
+        self.p = cpa.multiclasssql.p
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.object_table = 'Per_Object'
+        self.p.area_scoring_column = None
+        self.p.scoring_engine = 'numpy'
+        self.old_db_type = self.p.db_type
+        self.p.db_type = 'sqlite'
+        self.tmpdir = tempfile.mkdtemp()
+        self.old_filename = self.p.__dict__.get('_filename')
+        self.p._filename = os.path.join(self.tmpdir, 'test.properties')
+        with open(self.p._filename, 'w') as f:
+            f.write('db_type = sqlite\n')
+        self.weaklearners = [('x', 0.5, [1., -1.], [-1., 1.], 0)]
+        self.dm = mock.Mock()
+        self.dm.GetImageKeysAndObjectCounts.return_value = [((1,), 2)]
+        self.columns = [numpy.array([1, 1]), numpy.array([1, 2]), numpy.array([1., 0.])]
+
+    def tearDown(self):
+        self.p._filename = self.old_filename
+        self.p.db_type = self.old_db_type
+        self.p.scoring_engine = None
+        shutil.rmtree(self.tmpdir)
+
+    def score(self, db, weaklearners):
+        with mock.patch('cpa.multiclasssql.dm', self.dm):
+            with mock.patch('cpa.multiclasssql.get_cpa_data_dir', return_value=self.tmpdir):
+                return cpa.multiclasssql.PerImageCounts(weaklearners)
+
+    def test_reuse(self):
+        with mock.patch('cpa.multiclasssql.db') as db:
+            # the object table's row count
+            db.execute.return_value = [(2,)]
+            db.execute_columns.return_value = self.columns
+            eq_(self.score(db, self.weaklearners), [[1, 1, 1]])
+            eq_(db.execute_columns.call_count, 1)
+            # same rules: nothing is scored again
+            eq_(self.score(db, self.weaklearners), [[1, 1, 1]])
+            eq_(db.execute_columns.call_count, 1)
+            # a new image in the filter: only that image is scored
+            self.dm.GetImageKeysAndObjectCounts.return_value = [((1,), 2), ((7,), 1)]
+            db.execute_columns.return_value = [numpy.array([7]), numpy.array([1]), numpy.array([2.])]
+            eq_(self.score(db, self.weaklearners), [[1, 1, 1], [7, 1, 0]])
+            eq_(db.execute_columns.call_count, 2)
+            self.assertTrue('>= 7' in db.execute_columns.call_args[0][0])
+            # changed data or rules are scored from scratch
+            db.execute.return_value = [(3,)]
+            self.score(db, self.weaklearners)
+            eq_(db.execute_columns.call_count, 3)
+            self.score(db, [('x', 0.7, [1., -1.], [-1., 1.], 0)])
+            eq_(db.execute_columns.call_count, 4)
+
+    def test_remeasured(self):
+        with mock.patch('cpa.multiclasssql.db') as db:
+            db.execute_columns.return_value = self.columns
+            # the row count, largest rowid and sum of x
+            db.execute.return_value = [(2, 2, 1.)]
+            self.score(db, self.weaklearners)
+            eq_(db.execute.call_args[0][0], 'SELECT COUNT(*), MAX(rowid), SUM(x) FROM Per_Object')
+            # the same rows with new values are scored again
+            db.execute.return_value = [(2, 2, 0.5)]
+            self.score(db, self.weaklearners)
+            eq_(db.execute_columns.call_count, 2)
+
+    def test_appended_and_pruned(self):
+        with mock.patch('cpa.multiclasssql.db') as db:
+            db.execute.return_value = [(2,)]
+            with mock.patch('cpa.multiclasssql.get_cpa_data_dir', return_value=self.tmpdir):
+                cache = cpa.multiclasssql.ScoreCache(self.weaklearners)
+                cache.update([[i, 1, 1] for i in range(100)])
+                size = os.path.getsize(cache.path)
+                cache.update([[200, 0, 2]])
+                # the second update only wrote the new row
+                self.assertTrue(os.path.getsize(cache.path) < size * 1.1)
+                eq_(cpa.multiclasssql.ScoreCache(self.weaklearners).get([(200,), (1,)]), 
+                    [[200, 0, 2], [1, 1, 1]])
+                with mock.patch('cpa.multiclasssql.SCORE_CACHE_FILES', 2):
+                    for threshold in [0.1, 0.2]:
+                        os.utime(cache.path, (0, 0))
+                        cpa.multiclasssql.ScoreCache([('x', threshold, [1., -1.], [-1., 1.], 0)]).update([[1, 0, 0]])
+        files = [f for f in os.listdir(self.tmpdir) if f.startswith('scores_')]
+        eq_(len(files), 2)
+        self.assertFalse(os.path.basename(cache.path) in files)
+
+
+class ClassSamplerTestCase(TestCase):
+    def setUp(self):
+        self.p = cpa.multiclasssql.p
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.object_table = 'Per_Object'
+        self.p.scoring_engine = 'numpy'
+        self.weaklearners = [('x', 0.5, [1., -1.], [-1., 1.], 0)]
+        self.dm = mock.Mock()
+        self.dm.GetAllImageKeys.return_value = [(1,), (2,), (3,)]
+        self.dm.GetObjectCounts.return_value = numpy.array([2, 0, 2])
+        # one object of class 1 in each of images 1 and 3
+        objects = {1: ([1, 1], [1, 2], [1., 0.]), 3: ([3, 3], [1, 2], [0., 1.])}
+        def execute_columns(query, **kwargs):
+            imnums = [imnum for imnum in objects if 'IN (%d)'%(imnum) in query]
+            return [numpy.array(sum([objects[i][col] for i in imnums], []))
+                    for col in range(3)]
+        self.execute_columns = execute_columns
+
+    def tearDown(self):
+        self.p.scoring_engine = None
+
+    def test_fetch(self):
+        with mock.patch('cpa.multiclasssql.db') as db:
+            with mock.patch('cpa.multiclasssql.dm', self.dm):
+                db.execute_columns.side_effect = self.execute_columns
+                sampler = cpa.multiclasssql.ClassSampler(self.weaklearners, reservoir_size=1)
+                # image 2 has no objects and is never queried
+                eq_(len(sampler.imKeys), 2)
+                eq_(len(sampler.fetch(1, 1)), 1)
+                eq_(db.execute_columns.call_count, 1)
+                # the hits of the other class were kept
+                eq_(len(sampler.fetch(2, 1)), 1)
+                eq_(db.execute_columns.call_count, 1)
+                eq_(sorted(sampler.fetch(1, 1) + sampler.served[1][:1]), [(1, 1), (3, 2)])
+                eq_(db.execute_columns.call_count, 2)
+                self.assertTrue(sampler.done())
+                # everything has been served, so objects are served again
+                eq_(sorted(sampler.fetch(1, 5)), [(1, 1), (3, 2)])
+                eq_(db.execute_columns.call_count, 2)
+
+
+class CreateClassTableTestCase(TestCase):
+    def setUp(self):
+        self.p = cpa.multiclasssql.p
+        self.p.table_id = None
+        self.p.image_id = 'ImageNumber'
+        self.p.object_id = 'ObjectNumber'
+        self.p.object_table = 'Per_Object'
+        self.p.class_table = 'Per_Class'
+        self.p.scoring_engine = 'numpy'
+        self.p.area_scoring_column = None
+        self.old_db_type = self.p.db_type
+        self.p.db_type = 'sqlite'
+        self.weaklearners = [('x', 0.5, [1., -1.], [-1., 1.], 0)]
+        self.dm = mock.Mock()
+        self.dm.GetAllImageKeys.return_value = [(i,) for i in range(1, 201)]
+        self.columns = [numpy.array([1, 1]), numpy.array([1, 2]), numpy.array([1., 0.])]
+
+    def tearDown(self):
+        self.p.class_table = None
+        self.p.scoring_engine = None
+        self.p.db_type = self.old_db_type
+
+    def execute(self, chunks=[], version=(400, 400, 10.)):
+        ''' Returns a db.execute that finds the given saved chunks and object table version. '''
+        def execute(query, **kwargs):
+            if query.startswith('SELECT where_clause'):
+                return chunks
+            if query.startswith('SELECT COUNT(*)'):
+                return [version]
+            return []
+        return execute
+
+    def create(self, db):
+        progress = []
+        with mock.patch('cpa.multiclasssql.dm', self.dm):
+            db.execute_columns.return_value = self.columns
+            cpa.multiclasssql.create_perobject_class_table(['pos', 'neg'], self.weaklearners,
+                                                           cb=progress.append)
+        return progress, [call[0][0] for call in db.execute.call_args_list]
+
+    def test_create(self):
+        with mock.patch('cpa.multiclasssql.db') as db:
+            db.table_exists.return_value = False
+            progress, queries = self.create(db)
+        eq_(progress, [0.25, 0.5, 0.75, 1.0])
+        eq_(db.execute_columns.call_count, 4)
+        eq_(db.Commit.call_count, 6)
+        inserts = [q for q in queries if q.startswith('INSERT INTO Per_Class ')]
+        eq_(inserts[0], "INSERT INTO Per_Class (ImageNumber,ObjectNumber, class, class_number) "
+                        "VALUES (1,1, 'pos', 1),(1,2, 'neg', 2)")
+        # the index is built after the rows are in
+        index = [i for i, q in enumerate(queries) if q.startswith('CREATE INDEX')]
+        eq_(index, [len(queries) - 2])
+        eq_(queries[-1], 'DROP TABLE IF EXISTS _Per_Class_chunks')
+
+    def test_resume(self):
+        wheres = cpa.multiclasssql._where_clauses(self.p, self.dm, None)
+        with mock.patch('cpa.multiclasssql.db') as db:
+            db.table_exists.return_value = False
+            db.execute.side_effect = self.execute()
+            queries = self.create(db)[1]
+        # the first three ranges were saved by an interrupted run
+        chunks = [q.split("'")[1:4:2] for q in queries if q.startswith('INSERT INTO _Per_Class_chunks')]
+        eq_([where for where, fingerprint in chunks], wheres)
+        with mock.patch('cpa.multiclasssql.db') as db:
+            db.table_exists.return_value = True
+            db.execute.side_effect = self.execute(chunks[:3])
+            progress, queries = self.create(db)
+        eq_(progress, [0.25, 0.5, 0.75, 1.0])
+        eq_(db.execute_columns.call_count, 1)
+        self.assertTrue(wheres[3] in db.execute_columns.call_args[0][0])
+        self.assertFalse([q for q in queries if q.startswith('CREATE TABLE')])
+        # an index built before the interruption is dropped and built again
+        self.assertTrue('DROP INDEX IF EXISTS idx_Per_Class' in queries)
+        eq_(len([q for q in queries if q.startswith('CREATE INDEX')]), 1)
+        # rows of the unfinished range that were saved without being recorded are deleted
+        deletes = [q for q in queries if q.startswith('DELETE FROM Per_Class')]
+        eq_(deletes, ['DELETE FROM Per_Class WHERE (%s)'%(wheres[3].replace('Per_Object.', 'Per_Class.'))])
+
+    def test_objects_changed(self):
+        with mock.patch('cpa.multiclasssql.db') as db:
+            db.table_exists.return_value = False
+            db.execute.side_effect = self.execute()
+            queries = self.create(db)[1]
+        chunks = [q.split("'")[1:4:2] for q in queries if q.startswith('INSERT INTO _Per_Class_chunks')]
+        # the object table was rewritten since the ranges were saved
+        with mock.patch('cpa.multiclasssql.db') as db:
+            db.table_exists.return_value = True
+            db.execute.side_effect = self.execute(chunks[:3], version=(400, 400, 11.))
+            queries = self.create(db)[1]
+        eq_(db.execute_columns.call_count, 4)
+        self.assertTrue('DROP TABLE IF EXISTS Per_Class' in queries)
+
+    def test_other_rules(self):
+        with mock.patch('cpa.multiclasssql.db') as db:
+            db.table_exists.return_value = True
+            db.execute.side_effect = lambda query, **kwargs: (
+                [('(1 = 1)', 'x' * 32)] if query.startswith('SELECT where_clause') else [])
+            queries = self.create(db)[1]
+        eq_(db.execute_columns.call_count, 4)
+        self.assertTrue('DROP TABLE IF EXISTS Per_Class' in queries)
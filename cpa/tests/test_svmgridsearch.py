@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+import numpy as np
+import cpa.svmgridsearch
+
+def fake_score(task):
+    # the larger C, the better; gamma doesn't matter
+    C, gamma, train, test = task
+    return C, gamma, C / 100.0, 0.01
+
+class StratifiedFoldsTestCase(unittest.TestCase):
+    def test_folds(self):
+        labels = np.array([0, 0, 0, 0, 1, 1, 1, 1, 1, 1])
+        folds = cpa.svmgridsearch.stratified_folds(labels, 2)
+        self.assertEqual(len(folds), 2)
+        for train, test in folds:
+            self.assertEqual(sorted(train.tolist() + test.tolist()), range(10))
+            self.assertEqual(np.bincount(labels[test]).tolist(), [2, 3])
+
+class GridSearchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.values = np.arange(20.).reshape((10, 2))
+        self.labels = np.array([0, 1] * 5)
+
+    @patch('cpa.svmgridsearch.score_parameters', fake_score)
+    def test_grid_search(self):
+        progress = []
+        C, gamma, score, results = cpa.svmgridsearch.grid_search(
+            self.values, self.labels, [1., 4., 2.], [0.5, 0.25], n_folds=2, callback=progress.append)
+        self.assertEqual((C, gamma, score), (4., 0.5, 0.04))
+        self.assertEqual(len(results), 6)
+        self.assertEqual(results[2., 0.25], (0.02, 0.02))
+        self.assertEqual(progress[-1], 1.0)
+
+    def test_halving(self):
+        scored = []
+        def score(task):
+            scored.append(task[:2])
+            return fake_score(task)
+        with patch('cpa.svmgridsearch.score_parameters', score):
+            C, gamma, score, results = cpa.svmgridsearch.grid_search(
+                self.values, self.labels, [1., 4., 2., 3.], [0.5], n_folds=3, halving=True)
+        self.assertEqual((C, gamma), (4., 0.5))
+        # 4 pairs on the first fold, the best 2 on the second, then 1
+        self.assertEqual(len(scored), 4 + 2 + 1)
+        self.assertEqual(scored[4:], [(4., 0.5), (3., 0.5), (4., 0.5)])
+        self.assertEqual(results[1., 0.5], (0.01, 0.01))
+
+class WorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.values = np.arange(20.).reshape((10, 2))
+        self.labels = np.array([0, 1] * 5)
+        self.tasks = [(C, 0.5, np.arange(5), np.arange(5, 10)) for C in [1., 2., 3., 4.]]
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_workers(self):
+        workers, queue = cpa.svmgridsearch._start_workers(self.values, self.labels, 2)
+        try:
+            self.assertEqual(len(workers), 2)
+            results = cpa.svmgridsearch._run_tasks(self.tasks, workers, queue)
+        finally:
+            for worker in workers:
+                worker.stop()
+        self.assertEqual(sorted([r[0] for r in results]), [1., 2., 3., 4.])
+        self.assertEqual(len(workers), 2)
+
+    def run_with_script(self, script, timeout):
+        ''' Runs the tasks with 2 workers that run script after reading their first task. '''
+        filename = os.path.join(self.dir, 'worker.py')
+        with open(filename, 'w') as f:
+            f.write('import cPickle, sys, time\n'
+                    'cPickle.load(sys.stdin)\n'
+                    'cPickle.load(sys.stdin)\n' + script)
+        with patch('cpa.svmgridsearch._script', lambda: filename):
+            workers, queue = cpa.svmgridsearch._start_workers(self.values, self.labels, 2)
+        procs = [w.proc for w in workers]
+        progress = []
+        with patch('cpa.svmgridsearch.score_parameters', fake_score):
+            results = cpa.svmgridsearch._run_tasks(self.tasks, workers, queue, progress.append, timeout)
+        # the tasks sent to the 2 workers fail, the rest are scored here
+        self.assertEqual(workers, [])
+        self.assertEqual([proc.poll() is not None for proc in procs], [True, True])
+        self.assertEqual(sorted([r[0] for r in results]), [1., 2., 3., 4.])
+        self.assertEqual(sorted([r[2] for r in results]), [None, None, 0.03, 0.04])
+        self.assertEqual(progress, [1, 2, 3, 4])
+
+    def test_worker_exits(self):
+        self.run_with_script('sys.exit(3)\n', 60)
+
+    def test_worker_times_out(self):
+        self.run_with_script('time.sleep(60)\n', 0.5)
@@ -0,0 +1,180 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+from mock import patch
+import numpy as np
+import cpa.tiffregion
+from cpa.tiffregion import TiffRegionReader, Unsupported
+
+def write_tiff(filename, image, rows_per_strip=None, tile=None, deflate=False, pages=1, extra_tags=[]):
+    '''
+    Writes a little-endian grayscale TIFF of a 2-d uint16 or float32 image,
+    in strips of rows_per_strip rows or in (tile x tile) tiles.
+    extra_tags: more (code, type, values) tags, of SHORT or LONG type
+    '''
+    height, width = image.shape
+    if tile:
+        padded = np.zeros((-(-height // tile) * tile, -(-width // tile) * tile), image.dtype)
+        padded[:height, :width] = image
+        chunks = [padded[r:r + tile, c:c + tile]
+                  for r in range(0, padded.shape[0], tile)
+                  for c in range(0, padded.shape[1], tile)]
+    else:
+        rows_per_strip = rows_per_strip or height
+        chunks = [image[r:r + rows_per_strip] for r in range(0, height, rows_per_strip)]
+    data = [np.ascontiguousarray(chunk).astype('<' + image.dtype.str[1:]).tostring() for chunk in chunks]
+    if deflate:
+        data = [zlib.compress(d) for d in data]
+
+    out = ['II*\x00', None]
+    pos = 8
+    offsets = []
+    for d in data:
+        offsets.append(pos)
+        out.append(d)
+        pos += len(d)
+    sample_format = 3 if image.dtype.kind == 'f' else 1
+    tags = [(256, 4, [width]), (257, 4, [height]), (258, 3, [image.dtype.itemsize * 8]),
+            (259, 3, [8 if deflate else 1]), (262, 3, [1]), (277, 3, [1]),
+            (339, 3, [sample_format])] + list(extra_tags)
+    if tile:
+        tags += [(322, 4, [tile]), (323, 4, [tile]), (324, 4, offsets),
+                 (325, 4, [len(d) for d in data])]
+    else:
+        tags += [(273, 4, offsets), (278, 4, [rows_per_strip]),
+                 (279, 4, [len(d) for d in data])]
+    ifd_offsets = []
+    for page in range(pages):
+        # values that don't fit in the entry come after the ifd
+        ifd_offsets.append(pos)
+        extra_pos = pos + 2 + 12 * len(tags) + 4
+        entries, extra = [], []
+        for code, dtype, values in sorted(tags):
+            fmt = {3: 'H', 4: 'I'}[dtype]
+            packed = struct.pack('<%d%s'%(len(values), fmt), *values)
+            if len(packed) <= 4:
+                entries.append(struct.pack('<HHI', code, dtype, len(values)) + packed.ljust(4, '\x00'))
+            else:
+                entries.append(struct.pack('<HHII', code, dtype, len(values), extra_pos))
+                extra.append(packed)
+                extra_pos += len(packed)
+        next_ifd = extra_pos if page < pages - 1 else 0
+        ifd = struct.pack('<H', len(tags)) + ''.join(entries) + struct.pack('<I', next_ifd) + ''.join(extra)
+        out.append(ifd)
+        pos += len(ifd)
+    out[1] = struct.pack('<I', ifd_offsets[0])
+    with open(filename, 'wb') as f:
+        f.write(''.join(out))
+
+def crop(image, (w, h), (x, y)):
+    ''' imagetools.Crop without the per-image scaling pixels '''
+    pad = 200
+    padded = np.zeros((image.shape[0] + 2 * pad, image.shape[1] + 2 * pad), image.dtype)
+    padded[pad:-pad, pad:-pad] = image
+    x, y = int(x + 0.5) + pad, int(y + 0.5) + pad
+    return padded[y - h/2:y - h/2 + h, x - w/2:x - w/2 + w]
+
+class TiffRegionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'image.tif')
+        self.image = (np.arange(30 * 40) * 7 % 65536).astype('uint16').reshape((30, 40))
+        cpa.tiffregion._extremes_cache.clear()
+        cpa.tiffregion._extremes_files.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check_crops(self, reader):
+        for pos in [(20, 15), (0, 0), (39.6, 29), (3, 27), (100, 100)]:
+            tile = reader.read_crop((8, 6), pos)
+            self.assertEqual(tile.shape, (6, 8, 1))
+            np.testing.assert_array_equal(tile[:, :, 0], crop(self.image, (8, 6), pos))
+        lo, hi = reader.extremes()
+        self.assertEqual((lo[0], hi[0]), (self.image.min(), self.image.max()))
+
+    def test_memmapped(self):
+        write_tiff(self.filename, self.image, rows_per_strip=4)
+        reader = TiffRegionReader(self.filename)
+        self.assertTrue(reader.mm is not None)
+        self.check_crops(reader)
+        reader.close()
+
+    def test_compressed_strips(self):
+        write_tiff(self.filename, self.image, rows_per_strip=4, deflate=True)
+        reader = TiffRegionReader(self.filename)
+        self.assertTrue(reader.mm is None)
+        self.check_crops(reader)
+        reader.close()
+
+    def test_tiles(self):
+        write_tiff(self.filename, self.image, tile=16, deflate=True)
+        reader = TiffRegionReader(self.filename)
+        self.assertTrue(reader.tiled)
+        self.check_crops(reader)
+        reader.close()
+
+    def test_float(self):
+        self.image = np.linspace(0, 1, 30 * 40).astype('float32').reshape((30, 40))
+        write_tiff(self.filename, self.image, rows_per_strip=7, deflate=True)
+        reader = TiffRegionReader(self.filename)
+        self.check_crops(reader)
+        reader.close()
+
+    def test_unsupported(self):
+        write_tiff(self.filename, self.image, pages=2)
+        self.assertRaises(Unsupported, TiffRegionReader, self.filename)
+        with open(self.filename, 'wb') as f:
+            f.write('\x89PNG\r\n')
+        self.assertRaises(Unsupported, TiffRegionReader, self.filename)
+
+    def test_tagged_extremes(self):
+        write_tiff(self.filename, self.image, rows_per_strip=4, deflate=True,
+                   extra_tags=[(340, 3, [10]), (341, 3, [60000])])
+        reader = TiffRegionReader(self.filename)
+        with patch.object(reader, '_chunk', side_effect=AssertionError('decoded')):
+            lo, hi = reader.extremes()
+        self.assertEqual((lo.tolist(), hi.tolist()), ([10], [60000]))
+        reader.close()
+
+    def test_extremes_file(self):
+        extremes_file = os.path.join(self.dir, 'extremes')
+        write_tiff(self.filename, self.image, rows_per_strip=4, deflate=True)
+        reader = TiffRegionReader(self.filename)
+        expected = reader.extremes(extremes_file)
+        reader.close()
+        # a new session reads them from the file
+        cpa.tiffregion._extremes_cache.clear()
+        cpa.tiffregion._extremes_files.clear()
+        reader = TiffRegionReader(self.filename)
+        with patch.object(reader, '_chunk', side_effect=AssertionError('decoded')):
+            lo, hi = reader.extremes(extremes_file)
+        self.assertEqual((lo.tolist(), hi.tolist()), (expected[0].tolist(), expected[1].tolist()))
+        reader.close()
+        # records of other images are appended
+        other = os.path.join(self.dir, 'other.tif')
+        write_tiff(other, self.image * 2, rows_per_strip=4)
+        reader = TiffRegionReader(other)
+        reader.extremes(extremes_file)
+        reader.close()
+        cpa.tiffregion._extremes_cache.clear()
+        cpa.tiffregion._read_extremes_file(extremes_file)
+        self.assertEqual(len(cpa.tiffregion._extremes_cache), 2)
+
+    def test_corrupt(self):
+        write_tiff(self.filename, self.image, rows_per_strip=4, deflate=True)
+        with open(self.filename, 'r+b') as f:
+            f.seek(10)
+            f.write('garbage')
+        reader = TiffRegionReader(self.filename)
+        self.assertRaises(Unsupported, reader.read_crop, (8, 6), (2, 2))
+        self.assertRaises(Unsupported, reader.extremes)
+        reader.close()
+        # a truncated file
+        write_tiff(self.filename, self.image, rows_per_strip=4)
+        with open(self.filename, 'r+b') as f:
+            f.truncate(100)
+        self.assertRaises(Unsupported, TiffRegionReader, self.filename)
@@ -0,0 +1,62 @@
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+import numpy as np
+import cpa.tilestore
+from cpa.tilestore import TileStore
+
+def tile(value, channels=2, size=4):
+    return [np.zeros((size, size), dtype='float32') + value for c in range(channels)]
+
+class TileStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store = TileStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_round_trip(self):
+        self.store.put_image((1,), [5, 2], [tile(0.5), tile(0.25)])
+        self.assertTrue(self.store.has_image((1,)))
+        self.assertFalse(self.store.has_image((2,)))
+        tiles = self.store.get_tiles([(1, 2), (1, 3), (1, 5)])
+        self.assertEqual(tiles[1], None)
+        self.assertEqual(len(tiles[0]), 2)
+        self.assertAlmostEqual(tiles[0][1][0, 0], 0.25, 4)
+        self.assertAlmostEqual(tiles[2][0][3, 3], 0.5, 4)
+        self.assertEqual(np.load(os.path.join(self.path, '1.tiles.npy')).dtype, np.uint16)
+
+    def test_out_of_range(self):
+        self.store.put_image((1, 2), [1], [tile(3.5)])
+        self.assertEqual(np.load(os.path.join(self.path, '1_2.tiles.npy')).dtype, np.float16)
+        self.assertEqual(self.store.get_tiles([(1, 2, 1)])[0][0][0, 0], 3.5)
+
+    def test_not_stored(self):
+        self.assertEqual(self.store.get_tiles([(1, 1), (1, 2)]), [None, None])
+        # images stored later are found
+        self.store.put_image((1,), [1], [tile(0.)])
+        self.assertEqual(self.store.get_tiles([(1, 2)]), [None])
+        self.assertNotEqual(self.store.get_tiles([(1, 1)]), [None])
+
+class PrerenderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'tiles')
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.path))
+
+    def test_serial(self):
+        def render(imKey):
+            if imKey == (2,):
+                raise IOError('unreadable')
+            return 3
+        progress = []
+        with patch('cpa.tilestore.store_path', return_value=self.path):
+            with patch('cpa.tilestore.render_image', render):
+                n = cpa.tilestore.prerender([(1,), (2,), (3,)], n_workers=1, callback=progress.append)
+        self.assertEqual(n, 6)
+        self.assertEqual(progress[-1], 1.0)
+        self.assertTrue(os.path.isdir(self.path))
@@ -1377,6 +1377,10 @@ TIFF_TAGS = {
     316: ('host_computer', None, 2, None, None),
     317: ('predictor', 1, 3, 1, TIFF_PREDICTORS),
     320: ('color_map', None, 3, None, None),
+    322: ('tile_width', None, 4, 1, None),
+    323: ('tile_length', None, 4, 1, None),
+    324: ('tile_offsets', None, 4, None, None),
+    325: ('tile_byte_counts', None, 4, None, None),
     338: ('extra_samples', None, 3, None, TIFF_EXTRA_SAMPLES),
     339: ('sample_format', 1, 3, 1, TIFF_SAMPLE_FORMATS),
     33432: ('copyright', None, 2, None, None),
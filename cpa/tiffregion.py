@@ -0,0 +1,264 @@
+'''
+Reads rectangular regions of TIFF images, decoding only the strips or tiles
+that cover the region, so that small tiles can be cropped from large images
+without reading them whole.
+
+The file structure is parsed with tifffile.  Uncompressed images stored in
+one contiguous block are memory-mapped.  Only single-page, 8/16/32/64 bit,
+chunky (contig) images without a color map are supported; anything else,
+including strips or tiles that can't be decoded, raises Unsupported so the
+caller can read the image some other way.
+'''
+import cPickle
+import logging
+import math
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+import numpy as np
+import tifffile
+
+class Unsupported(Exception):
+    ''' Raised for files that can't be read by region. '''
+    pass
+
+# (filename, modify time, size) -> per-sample (min, max) of the image, see extremes
+_extremes_cache = OrderedDict()
+_extremes_lock = threading.Lock()
+EXTREMES_CACHE_SIZE = 20000
+# extremes files that have been read into _extremes_cache
+_extremes_files = set()
+
+# errors from decoding corrupt strips or tiles
+DECODE_ERRORS = (ValueError, IndexError, zlib.error, struct.error)
+
+def _as_tuple(value):
+    try:
+        return tuple(value)
+    except TypeError:
+        return (value, )
+
+class TiffRegionReader(object):
+    '''
+    Reads regions of the first page of a TIFF file.
+    shape: (height, width) of the image
+    samples: number of samples (channels) per pixel
+    dtype: numpy dtype of the samples in the file
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            self.tif = tifffile.TIFFfile(filename)
+        except (KeyError, ) + DECODE_ERRORS, e:
+            raise Unsupported('%s: %s'%(filename, e))
+        try:
+            self._check()
+        except:
+            self.tif.close()
+            raise
+
+    def _check(self):
+        if len(self.tif.pages) != 1:
+            raise Unsupported('%s has %d pages'%(self.filename, len(self.tif.pages)))
+        page = self.page = self.tif.pages[0]
+        if page.is_stk or page.is_palette or 'extra_samples' in page.tags:
+            raise Unsupported('%s is not a plain image'%(self.filename))
+        if page.planar_configuration != 'contig' and page.samples_per_pixel != 1:
+            raise Unsupported('%s stores its channels separately'%(self.filename))
+        if page.bits_per_sample not in (8, 16, 32, 64):
+            raise Unsupported('%s has %d bit samples'%(self.filename, page.bits_per_sample))
+        if page.orientation != 'top_left' or page.fill_order != 'msb2lsb':
+            raise Unsupported('%s has an unsupported pixel layout'%(self.filename))
+        if page.compression not in tifffile.TIFF_DECOMPESSORS:
+            raise Unsupported('%s has unsupported compression %s'%(self.filename, page.compression))
+        self.shape = (page.image_length, page.image_width)
+        self.samples = page.samples_per_pixel
+        self.dtype = np.dtype(self.tif.byte_order + page.dtype)
+        self.tiled = 'tile_offsets' in page.tags
+        if self.tiled:
+            self.offsets = _as_tuple(page.tile_offsets)
+            self.byte_counts = _as_tuple(page.tile_byte_counts)
+        else:
+            self.offsets = _as_tuple(page.strip_offsets)
+            self.byte_counts = _as_tuple(page.strip_byte_counts)
+            self.rows_per_strip = min(page.rows_per_strip, page.image_length)
+        self.mm = self._memmap()
+
+    def close(self):
+        self.mm = None
+        self.tif.close()
+
+    def _memmap(self):
+        ''' Returns the image memory-mapped, or None if it isn't stored contiguously. '''
+        if self.tiled or self.page.compression or self.page.predictor:
+            return None
+        for i in xrange(len(self.offsets) - 1):
+            if self.offsets[i] + self.byte_counts[i] != self.offsets[i + 1]:
+                return None
+        try:
+            return np.memmap(self.filename, dtype=self.dtype, mode='r', offset=self.offsets[0],
+                             shape=self.shape + (self.samples, ))
+        except (ValueError, EnvironmentError), e:
+            # eg: the file is shorter than its tags say
+            raise Unsupported('%s: %s'%(self.filename, e))
+
+    def _chunk(self, index, shape):
+        '''
+        Reads and decodes a strip or tile into an array of the given shape.
+        Raises Unsupported if it can't be decoded.
+        '''
+        fd = self.tif._fd
+        try:
+            fd.seek(self.offsets[index], 0)
+            data = tifffile.TIFF_DECOMPESSORS[self.page.compression](fd.read(self.byte_counts[index]))
+            chunk = np.frombuffer(data, self.dtype, int(np.product(shape)))
+            chunk = chunk.reshape(shape)
+        except DECODE_ERRORS, e:
+            raise Unsupported('%s: could not decode %s %d: %s'%
+                              (self.filename, 'tile' if self.tiled else 'strip', index, e))
+        if self.page.predictor == 'horizontal':
+            chunk = np.cumsum(chunk, axis=1, dtype=self.dtype)
+        return chunk
+
+    def read(self, y0, y1, x0, x1):
+        '''
+        Returns the pixels in rows y0 to y1 and columns x0 to x1 (exclusive,
+        within the image) as an array of (rows, columns, samples) in native
+        byte order.
+        '''
+        if self.mm is not None:
+            return np.array(self.mm[y0:y1, x0:x1], dtype=self.dtype.newbyteorder('='))
+        region = np.empty((y1 - y0, x1 - x0, self.samples), self.dtype.newbyteorder('='))
+        height, width = self.shape
+        if self.tiled:
+            tw, tl = self.page.tile_width, self.page.tile_length
+            across = int(math.ceil(width / float(tw)))
+            for row in xrange(y0 // tl, (y1 - 1) // tl + 1):
+                for col in xrange(x0 // tw, (x1 - 1) // tw + 1):
+                    chunk = self._chunk(row * across + col, (tl, tw, self.samples))
+                    self._paste(region, chunk, row * tl, col * tw, y0, y1, x0, x1)
+        else:
+            rps = self.rows_per_strip
+            for strip in xrange(y0 // rps, (y1 - 1) // rps + 1):
+                rows = min(rps, height - strip * rps)
+                chunk = self._chunk(strip, (rows, width, self.samples))
+                self._paste(region, chunk, strip * rps, 0, y0, y1, x0, x1)
+        return region
+
+    def _paste(self, region, chunk, top, left, y0, y1, x0, x1):
+        ''' Copies the part of a chunk at (top, left) that falls in the region. '''
+        lo_y, hi_y = max(y0, top), min(y1, top + chunk.shape[0])
+        lo_x, hi_x = max(x0, left), min(x1, left + chunk.shape[1])
+        region[lo_y - y0:hi_y - y0, lo_x - x0:hi_x - x0] = \
+            chunk[lo_y - top:hi_y - top, lo_x - left:hi_x - left]
+
+    def read_crop(self, (w, h), (x, y)):
+        '''
+        Like imagetools.Crop: returns the (h, w, samples) region centered on
+        (x, y), with the area outside of the image filled with zeros.
+        '''
+        x = int(x + 0.5)
+        y = int(y + 0.5)
+        height, width = self.shape
+        lox = max(x - w/2, 0)
+        loy = max(y - h/2, 0)
+        hix = min(x - w/2 + w, width)
+        hiy = min(y - h/2 + h, height)
+        dest_lox = lox - (x - w/2)
+        dest_loy = loy - (y - h/2)
+        crop = np.zeros((h, w, self.samples), dtype=self.dtype.newbyteorder('='))
+        if hix > lox and hiy > loy:
+            crop[dest_loy:dest_loy + hiy - loy, dest_lox:dest_lox + hix - lox] = \
+                self.read(loy, hiy, lox, hix)
+        return crop
+
+    def _tagged_extremes(self):
+        '''
+        Returns the per-sample (min, max) from the SMinSampleValue and
+        SMaxSampleValue tags, or None if the file doesn't have them.
+        '''
+        tags = self.page.tags
+        if '340' not in tags or '341' not in tags:
+            return None
+        dtype = self.dtype.newbyteorder('=')
+        return tuple([np.resize(np.array(tags[code].value, dtype=dtype), self.samples)
+                      for code in ['340', '341']])
+
+    def extremes(self, filename=None):
+        '''
+        Returns the minimum and maximum of each sample over the whole image,
+        as two arrays.  They come from the SMinSampleValue/SMaxSampleValue
+        tags if the file has them.  Otherwise finding them reads the whole
+        image once (strip by strip, or memory-mapped), after which they are
+        cached by file name, in memory and in the given extremes file (see
+        _read_extremes_file) so that later sessions don't read it again.
+        '''
+        result = self._tagged_extremes()
+        if result is not None:
+            return result
+        stat = os.stat(self.filename)
+        key = (os.path.abspath(self.filename), stat.st_mtime, stat.st_size)
+        with _extremes_lock:
+            if filename is not None and filename not in _extremes_files:
+                _extremes_files.add(filename)
+                _read_extremes_file(filename)
+            if key in _extremes_cache:
+                return _extremes_cache[key]
+        if self.mm is not None:
+            flat = self.mm.reshape((-1, self.samples))
+            result = (flat.min(axis=0), flat.max(axis=0))
+        else:
+            height, width = self.shape
+            if self.tiled:
+                # tiles are padded at the right and bottom edges, so read
+                # the image through them
+                block = self.read(0, height, 0, width).reshape((-1, self.samples))
+                lo, hi = [block.min(axis=0)], [block.max(axis=0)]
+            else:
+                lo, hi = [], []
+                for strip in xrange(len(self.offsets)):
+                    rows = min(self.rows_per_strip, height - strip * self.rows_per_strip)
+                    chunk = self._chunk(strip, (rows, width, self.samples)).reshape((-1, self.samples))
+                    lo.append(chunk.min(axis=0))
+                    hi.append(chunk.max(axis=0))
+            result = (np.min(lo, axis=0), np.max(hi, axis=0))
+        with _extremes_lock:
+            _remember_extremes(key, result)
+            if filename is not None:
+                _append_extremes_file(filename, key, result)
+        return result
+
+def _remember_extremes(key, result):
+    _extremes_cache[key] = result
+    while len(_extremes_cache) > EXTREMES_CACHE_SIZE:
+        _extremes_cache.popitem(last=False)
+
+def _read_extremes_file(filename):
+    '''
+    Adds the extremes in an extremes file to the cache.  The file is a
+    series of pickled (key, (min, max)) records, appended by one or more
+    processes.  Reading stops at the first record that can't be read.
+    '''
+    try:
+        with open(filename, 'rb') as f:
+            while True:
+                key, result = cPickle.load(f)
+                _remember_extremes(key, result)
+    except EOFError:
+        pass
+    except (IOError, cPickle.UnpicklingError, ValueError, TypeError), e:
+        if os.path.exists(filename):
+            logging.warn('Could not read all of the image extremes in %s: %s'%(filename, e))
+
+def _append_extremes_file(filename, key, result):
+    '''
+    Appends a record to an extremes file, in a single write so that the
+    records of processes sharing the file don't interleave.
+    '''
+    try:
+        with open(filename, 'ab') as f:
+            f.write(cPickle.dumps((key, result), cPickle.HIGHEST_PROTOCOL))
+    except (IOError, OSError), e:
+        logging.warn('Could not save the image extremes to %s: %s'%(filename, e))
@@ -5,6 +5,7 @@ from singleton import Singleton
 from heapq import heappush, heappop
 from weakref import WeakValueDictionary
 import imagetools
+import tilestore
 import logging
 import numpy
 import threading
@@ -27,6 +28,10 @@ class TileCollection(Singleton):
     def __init__(self):
         self.tileData  = WeakValueDictionary()
         self.loadq     = []
+        # image key -> set of its object keys in loadq
+        self.queued    = {}
+        # object key -> coordinates looked up ahead for queued objects
+        self.coords    = {}
         self.cv        = threading.Condition()
         self.load_lock = threading.Lock()
         self.group_priority = 0
@@ -34,7 +39,10 @@ class TileCollection(Singleton):
         self.imagePlaceholder = List([numpy.zeros((int(p.image_tile_size),
                                                    int(p.image_tile_size)))+0.1
                                       for i in range(sum(map(int,p.channels_per_image)))])
-        self.loader = TileLoader(self, None)
+        # tiles rendered ahead of time, see tilestore.py
+        self.tile_store = tilestore.open_store()
+        self.loaders = [TileLoader(self, None)
+                        for i in range(int(p.tile_loader_threads or 1))]
 
     def GetTileData(self, obKey, notify_window, priority=1):
         return self.GetTiles([obKey], notify_window, priority)[0]
@@ -49,7 +57,8 @@ class TileCollection(Singleton):
         Returns: a list of lists of tile data (in numpy arrays) in the order
             of the obKeys that were passed in.
         '''
-        self.loader.notify_window = notify_window
+        for loader in self.loaders:
+            loader.notify_window = notify_window
         self.group_priority -= 1
         tiles = []
         temp = {} # for weakrefs
@@ -57,13 +66,39 @@ class TileCollection(Singleton):
             for order, obKey in enumerate(obKeys):
                 if not obKey in self.tileData:
                     heappush(self.loadq, ((priority, self.group_priority, order), obKey))
+                    self.queued.setdefault(obKey[:-1], set()).add(obKey)
                     self.group_priority += 1
                     temp[order] = List(self.imagePlaceholder)
                     self.tileData[obKey] = temp[order]
             tiles = [self.tileData[obKey] for obKey in obKeys]
-            self.cv.notify()
+            self.cv.notify_all()
         return tiles    
 
+    def TakeCoords(self, obKeys, dropped=()):
+        '''
+        Returns the coordinates of objects that were just taken from the load
+        queue (see DBConnect.GetObjectsCoords).  If any aren't known yet, the
+        coordinates of every queued object are looked up along with them in
+        one query, so that the other loaders find theirs here.
+        dropped: other taken objects whose coordinates are no longer needed
+        '''
+        with self.cv:
+            for obKey in dropped:
+                self.coords.pop(obKey, None)
+            if [k for k in obKeys if k not in self.coords]:
+                pending = list(obKeys) + [k for keys in self.queued.values()
+                                          for k in keys if k not in self.coords]
+                # keep the query a reasonable size
+                pending = pending[:max(len(obKeys), 1000)]
+            else:
+                pending = []
+        if pending:
+            found = db.GetObjectsCoords(pending)
+            with self.cv:
+                self.coords.update(zip(pending, found))
+        with self.cv:
+            return [self.coords.pop(obKey, None) for obKey in obKeys]
+
     
 # Event generated by the TileLoader thread.
 EVT_TILE_UPDATED_ID = wx.NewId()
@@ -89,13 +124,14 @@ class TileUpdatedEvent(wx.PyEvent):
 
 class TileLoader(threading.Thread):
     '''
-    This thread is owned by the TileCollection singleton and is kept
-    running for the duration of the app execution.  Whenever
-    TileCollection has obKeys in its load queue (loadq), this thread
-    will remove them from the queue and fetch the tile data for
-    them. The tile data is then written back into TileCollection's
-    tileData dict over the existing placeholder. Finally an event is
-    posted to the svn to tell it to refresh the tiles.
+    These threads are owned by the TileCollection singleton (there are
+    tile_loader_threads of them) and are kept running for the duration of
+    the app execution.  Whenever TileCollection has obKeys in its load
+    queue (loadq), a thread will remove the first one from the queue along
+    with all other queued obKeys from the same image, and fetch the tile
+    data for them from the tile store, or else by reading the image once. The tile data is then written
+    back into TileCollection's tileData dict over the existing placeholder.
+    Finally an event is posted to the svn to tell it to refresh the tiles.
     '''
     def __init__(self, tc, notify_window):
         threading.Thread.__init__(self)
@@ -106,47 +142,66 @@ class TileLoader(threading.Thread):
         self.start()
     
     def run(self):
-        while 1:            
-            self.tile_collection.cv.acquire()
-            # If there are no objects in the queue then wait
-            while not self.tile_collection.loadq:
-                self.tile_collection.cv.wait()
-                
-            if self._want_abort:
-                self.tile_collection.cv.release()
-                logging.info('%s aborted'%self.getName())
-                return
-
-            obKey = heappop(self.tile_collection.loadq)[1]
-            self.tile_collection.cv.release()
-
-            # wait until loading has completed before continuing
-            with self.tile_collection.load_lock:
-                # Make sure tile hasn't been deleted outside this thread
-                if not self.tile_collection.tileData.get(obKey, None):
-                    continue
-
-                # Get the tile
-                new_data = imagetools.FetchTile(obKey)
-                if new_data is None:
-                    #if fetching fails, leave the tile blank
+        tc = self.tile_collection
+        while 1:
+            with tc.cv:
+                # If there are no objects in the queue then wait
+                while not tc.loadq and not self._want_abort:
+                    tc.cv.wait()
+
+                if self._want_abort:
+                    logging.info('%s aborted'%self.getName())
+                    return
+
+                obKey = heappop(tc.loadq)[1]
+                # Take the other queued objects from the same image too.
+                # Their own entries are skipped when they reach the top.
+                obKeys = tc.queued.get(obKey[:-1], set())
+                if obKey not in obKeys:
                     continue
-                
-                tile_data = self.tile_collection.tileData.get(obKey, None)
-                
-                # Make sure tile hasn't been deleted outside this thread
-                if tile_data is not None:
-                    # copy each channel
-                    for i in range(len(tile_data)):
-                        tile_data[i] = new_data[i]
-                    wx.PostEvent(self.notify_window, TileUpdatedEvent(obKey))
+                del tc.queued[obKey[:-1]]
+                obKeys = sorted(obKeys)
+
+            # wait while tile loading is paused (see load_lock)
+            with tc.load_lock:
+                # Make sure tiles haven't been deleted outside this thread
+                live = [k for k in obKeys if tc.tileData.get(k, None)]
+
+            # Get the tiles, from the tile store if they are there
+            tiles = {}
+            try:
+                if live and tc.tile_store is not None:
+                    tiles = dict([(k, data) for k, data in zip(live, tc.tile_store.get_tiles(live))
+                                  if data is not None])
+                missing = [k for k in live if k not in tiles]
+                coords = tc.TakeCoords(missing, [k for k in obKeys if k not in missing])
+                if missing:
+                    tiles.update(zip(missing, imagetools.FetchTiles(missing, coords)))
+            except Exception, e:
+                #if fetching fails, leave the tiles blank
+                logging.error('%s failed to load the tiles of image %s: %s'%(self.getName(), obKeys[0][:-1], e))
+            # Give the pooled connection back between batches rather than
+            # holding it while waiting for more tiles
+            db.release_connection()
+
+            with tc.load_lock:
+                for obKey in live:
+                    data = tiles.get(obKey, None)
+                    if data is None:
+                        #if fetching fails, leave the tile blank
+                        continue
+                    tile_data = tc.tileData.get(obKey, None)
+                    # Make sure tile hasn't been deleted outside this thread
+                    if tile_data is not None:
+                        # copy each channel
+                        for i in range(len(tile_data)):
+                            tile_data[i] = data[i]
+                        wx.PostEvent(self.notify_window, TileUpdatedEvent(obKey))
 
     def abort(self):
         self._want_abort = True
-        self.tile_collection.cv.acquire()
-        heappush(self.tile_collection.loadq, ((0, 0, 0), '<ABORT>'))
-        self.tile_collection.cv.notify()
-        self.tile_collection.cv.release()        
+        with self.tile_collection.cv:
+            self.tile_collection.cv.notify_all()
 
 
 
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+'''
+An on-disk store of object tiles, so that Classifier doesn't have to read
+whole images again to show the tiles of their objects.
+
+The store is kept next to the properties file, in a directory starting with
+the properties file name and ".tiles".  It has a subdirectory for each
+combination of the settings that change how tiles are cropped (see
+settings_key).  Each image has a pair of files there: the sorted ids of its
+objects, and their tiles as an array of objects x channels x size x size,
+stored as uint16 or, if the pixels aren't all within [0, 1], as float16.
+The tile files are memory-mapped when read.
+
+The store is filled for a whole experiment, or the images of a filter, by
+running this module as a script in a pool of worker processes:
+    python tilestore.py [options] PROPERTIES-FILE
+Images that are already stored are skipped, so delete the directory to
+render the tiles again after the object table has changed.
+'''
+import hashlib
+import itertools
+import logging
+import os
+import threading
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from optparse import OptionParser
+import numpy as np
+from properties import Properties
+from dbconnect import DBConnect
+
+p = Properties.getInstance()
+db = DBConnect.getInstance()
+
+def settings_key():
+    ''' Returns a hash of the properties that change how tiles are cropped. '''
+    settings = [p.image_tile_size, p.rescale_object_coords, p.image_rescale,
+                p.image_path_cols, p.image_file_cols, p.channels_per_image]
+    return hashlib.md5(repr(settings)).hexdigest()
+
+def store_path():
+    '''
+    Returns the store directory for the current properties, or None if no
+    properties file is loaded.
+    '''
+    filename = p.__dict__.get('_filename')
+    if not filename:
+        return None
+    return os.path.join(filename + '.tiles', settings_key())
+
+def open_store():
+    ''' Returns the TileStore for the current properties, or None if it hasn't been filled. '''
+    path = store_path()
+    if path is None or not os.path.isdir(path):
+        return None
+    return TileStore(path)
+
+def _to_stored(tiles):
+    if tiles.size == 0 or (tiles.min() >= 0 and tiles.max() <= 1):
+        return np.round(tiles * 65535).astype('uint16')
+    return tiles.astype('float16')
+
+def _from_stored(tile):
+    if tile.dtype == np.uint16:
+        return list(tile.astype('float32') / 65535)
+    return list(tile.astype('float32'))
+
+class TileStore(object):
+    '''
+    Reads and writes the tiles of a store directory.
+    cache_size: the number of images whose files are kept open
+    '''
+    def __init__(self, path, cache_size=16):
+        self.path = path
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        # image key -> (ids, tiles), least recently used first
+        self.images = OrderedDict()
+
+    def _filenames(self, imKey):
+        prefix = os.path.join(self.path, '_'.join([str(int(k)) for k in imKey]))
+        return prefix + '.ids.npy', prefix + '.tiles.npy'
+
+    def has_image(self, imKey):
+        return os.path.exists(self._filenames(imKey)[0])
+
+    def _load(self, imKey):
+        ''' Returns (ids, tiles) for an image, or None if it isn't stored. '''
+        imKey = tuple(imKey)
+        with self.lock:
+            if imKey in self.images:
+                entry = self.images.pop(imKey)
+                self.images[imKey] = entry
+                return entry
+        ids_file, tiles_file = self._filenames(imKey)
+        # Images that aren't stored yet aren't remembered, since a
+        # pre-render job may be storing them right now.
+        if not os.path.exists(ids_file):
+            return None
+        try:
+            entry = (np.load(ids_file), np.load(tiles_file, mmap_mode='r'))
+        except (IOError, OSError, ValueError), e:
+            logging.warn('Could not read the stored tiles of image %s: %s'%(imKey, e))
+            return None
+        with self.lock:
+            self.images[imKey] = entry
+            while len(self.images) > self.cache_size:
+                self.images.popitem(last=False)
+        return entry
+
+    def get_tiles(self, obKeys):
+        '''
+        Returns a list with the stored tile (a list of channel arrays) of
+        each of the given objects, which must all be in the same image, or
+        None for objects without a stored tile.
+        '''
+        entry = self._load(obKeys[0][:-1])
+        if entry is None:
+            return [None] * len(obKeys)
+        ids, tiles = entry
+        result = []
+        for obKey in obKeys:
+            i = np.searchsorted(ids, obKey[-1])
+            if i < len(ids) and ids[i] == obKey[-1]:
+                result.append(_from_stored(tiles[i]))
+            else:
+                result.append(None)
+        return result
+
+    def put_image(self, imKey, ids, tiles):
+        '''
+        Stores the tiles of the objects in an image.
+        ids: the object ids
+        tiles: the tile (a list of channel arrays) of each object
+        '''
+        order = np.argsort(ids)
+        ids = np.asarray(ids, dtype='int64')[order]
+        tiles = _to_stored(np.array([tiles[i] for i in order], dtype='float32'))
+        # The files are written under temporary names and then renamed, so
+        # readers never see a partial file.  The ids file comes last since
+        # it marks the image as stored.
+        ids_file, tiles_file = self._filenames(imKey)
+        for filename, data in [(tiles_file, tiles), (ids_file, ids)]:
+            temp = '%s.%d.tmp'%(filename, os.getpid())
+            with open(temp, 'wb') as f:
+                np.save(f, data)
+            if os.path.exists(filename):
+                os.remove(filename)
+            os.rename(temp, filename)
+
+
+def render_image(imKey):
+    '''
+    Crops and stores the tiles of every object in an image, unless the image
+    is already stored.  Returns the number of tiles stored.
+    '''
+    import imagetools
+    store = TileStore(store_path())
+    if store.has_image(imKey):
+        return 0
+    coords = db.GetObjectCoordsByImage(imKey)
+    ids = sorted([obId for obId, xy in coords.items() if None not in xy])
+    imgs = imagetools.ReadImage(imKey)
+    store.put_image(imKey, ids, imagetools.CropTiles(imgs, [coords[obId] for obId in ids]))
+    return len(ids)
+
+def _render_task(imKey):
+    try:
+        return imKey, render_image(imKey), None
+    except Exception, e:
+        return imKey, 0, str(e)
+
+def _start_vm():
+    import javabridge
+    import bioformats
+    javabridge.start_vm(class_path=bioformats.JARS, run_headless=True)
+
+def _init_worker(props_file):
+    # The connections of a forked worker belong to the parent process
+    db.forget_connections()
+    if not p.is_initialized():
+        p.LoadFile(props_file)
+    _start_vm()
+
+def prerender(imKeys, n_workers=None, callback=None):
+    '''
+    Fills the tile store with the tiles of every object in the given images.
+    The Java VM must be running in this process if n_workers is 1.
+    n_workers: the number of worker processes (0 or None for one per core)
+    callback: function to update with the fraction complete
+    Returns the number of tiles stored.
+    '''
+    path = store_path()
+    if path is None:
+        raise ValueError('The tile store is kept next to the properties file, '
+                         'so a properties file must be loaded.')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    imKeys = [tuple(imKey) for imKey in imKeys]
+
+    if not n_workers:
+        n_workers = cpu_count()
+    pool = None
+    if n_workers > 1:
+        try:
+            pool = Pool(n_workers, _init_worker, (p._filename,))
+        except Exception, e:
+            logging.warn('Could not start %d worker processes, rendering in this one: %s'%(n_workers, e))
+    if pool is None:
+        results = itertools.imap(_render_task, imKeys)
+    else:
+        results = pool.imap_unordered(_render_task, imKeys)
+
+    n_tiles = 0
+    try:
+        for i, (imKey, n, error) in enumerate(results):
+            if error is not None:
+                logging.error('Could not render the tiles of image %s: %s'%(imKey, error))
+            n_tiles += n
+            if callback:
+                callback((i + 1) / float(len(imKeys)))
+    finally:
+        if pool is not None:
+            # the workers' Java VMs keep them from exiting on their own
+            pool.terminate()
+            pool.join()
+    return n_tiles
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = OptionParser('usage: %prog [options] PROPERTIES-FILE')
+    parser.add_option('-f', '--filter', dest='filter_name',
+                      help='only render the images of this filter')
+    parser.add_option('-w', '--workers', dest='n_workers', type='int', default=0,
+                      help='number of worker processes (default: one per core)')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected a properties file')
+
+    p.LoadFile(args[0])
+    if options.n_workers == 1:
+        _start_vm()
+    if options.filter_name:
+        imKeys = db.GetFilteredImages(options.filter_name)
+    else:
+        imKeys = db.GetAllImageKeys()
+    logging.info('Rendering the tiles of %d images to %s'%(len(imKeys), store_path()))
+
+    last_percent = [-1]
+    def progress(frac):
+        if int(frac * 100) != last_percent[0]:
+            last_percent[0] = int(frac * 100)
+            logging.info('%d%% complete'%(last_percent[0]))
+    n_tiles = prerender(imKeys, options.n_workers, progress)
+    logging.info('Stored %d tiles'%(n_tiles))
+
+    if options.n_workers == 1:
+        import javabridge
+        javabridge.kill_vm()
@@ -1,13 +1,20 @@
 from sys import stderr
 import logging
 import numpy
+import os
 import cPickle
 import base64
 import zlib
 import wx
 import collections
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 from dbconnect import *
+from fastgentleboostingworkermulticlass import presort_append, presort_subset, presort_values
 from singleton import Singleton
 
 db = DBConnect.getInstance()
@@ -32,6 +39,8 @@ class TrainingSet:
         self.label_matrix = []          # array of classifier labels for each sample
         self.values = []                # array of measurements (data from db) for each sample
         self.entries = []               # list of (label, obKey) pairs
+        self.presorted = None           # presort_values(values), see get_presorted
+        self.changes = None             # (# added, # removed) by Update, see there
 
         # check cache freshness
         self.cache.clear_if_objects_modified()
@@ -49,29 +58,73 @@ class TrainingSet:
         self.labels = numpy.array(labels)
         self.classifier_labels = 2 * numpy.eye(len(labels), dtype=numpy.int) - 1
         
-        num_to_fetch = sum([len(k) for k in keyLists])
-        num_fetched = [0] # use a list to get static scoping
-
-        # Populate the label_matrix, entries, and values
+        # Populate the label_matrix and entries
         for label, cl_label, keyList in zip(labels, self.classifier_labels, keyLists):
             self.label_matrix += ([cl_label] * len(keyList))
             self.entries += zip([label] * len(keyList), keyList)
 
-            if labels_only:
-                self.values += []
-            else:
-                def get_data(k):
-                    d = self.cache.get_object_data(k)
-                    if callback is not None:
-                        callback(num_fetched[0] / float(num_to_fetch))
-                    num_fetched[0] = num_fetched[0] + 1
-                    return d
-                self.values += [get_data(k) for k in keyList]
+        # Fetch the values for all objects at once
+        if not labels_only:
+            self.values = self.cache.get_objects_data(self.get_object_keys(), callback)
 
         self.label_matrix = numpy.array(self.label_matrix)
         self.values = numpy.array(self.values, np.float64)
 
 
+    def Update(self, labels, keyLists, callback=None):
+        '''
+        Like Create, but keeps the measurements (and the presorting, see
+        get_presorted) of the examples that are already in the training set,
+        so only the new examples are fetched.  Examples are kept in order,
+        and new ones are appended.
+        self.changes counts the examples (added, removed) by Update since it
+        was last set to (0, 0), and is None once the training set has been
+        created again.
+        '''
+        if (not hasattr(self, 'entries') or list(labels) != list(self.labels) or 
+            len(self.values) != len(self.entries) or 
+            not db.verify_objects_modify_date_earlier(self.cache.last_update)):
+            self.Create(labels, keyLists, callback=callback)
+            return
+        entries = []
+        for label, keyList in zip(labels, keyLists):
+            entries += zip([label] * len(keyList), keyList)
+        wanted = set(entries)
+        present = set(self.entries)
+        kept = [i for i, entry in enumerate(self.entries) if entry in wanted]
+        added = [entry for entry in entries if entry not in present]
+        removed = len(self.entries) - len(kept)
+
+        if removed:
+            self.entries = [self.entries[i] for i in kept]
+            self.label_matrix = self.label_matrix[kept]
+            self.values = self.values[kept]
+            if self.presorted is not None:
+                self.presorted = presort_subset(self.presorted, kept)
+        if added:
+            cl_labels = dict(zip(labels, self.classifier_labels))
+            new_values = self.cache.get_objects_data([obKey for label, obKey in added], callback)
+            self.entries += added
+            self.label_matrix = numpy.vstack([self.label_matrix.reshape((-1, len(labels))),
+                                              [cl_labels[label] for label, obKey in added]])
+            self.values = numpy.vstack([self.values.reshape((-1, new_values.shape[1])), new_values])
+            if self.presorted is not None:
+                if len(kept) == 0:
+                    self.presorted = None
+                else:
+                    self.presorted = presort_append(self.presorted, new_values)
+        if added or removed:
+            self.saved = False
+        if self.changes is not None:
+            self.changes = (self.changes[0] + len(added), self.changes[1] + removed)
+
+    def get_presorted(self):
+        ''' Returns presort_values(self.values), computed once and then kept
+        up to date by Update. '''
+        if self.presorted is None:
+            self.presorted = presort_values(self.values)
+        return self.presorted
+
     def Load(self, filename, labels_only=False):
         self.Clear()
         f = open(filename, 'U')
@@ -169,7 +222,6 @@ class TrainingSet:
             for label, obKey in self.entries:
                 line = '%s %s %s\n'%(label, ' '.join([str(int(k)) for k in obKey]), ' '.join([str(int(k)) for k in db.GetObjectCoords(obKey)]))
                 f.write(line)
-            f.write('# ' + self.cache.save_to_string([k[1] for k in self.entries]) + '\n')
         except:
             logging.error("Error saving training set %s" % (filename))
             f.close()
@@ -182,19 +234,208 @@ class TrainingSet:
     def get_object_keys(self):
         return [e[1] for e in self.entries]
 
+class _FileLock(object):
+    '''
+    Holds an exclusive lock on a file for the duration of a with statement,
+    so that CPA processes sharing files take turns writing them.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+
+    def __enter__(self):
+        self.f = open(self.filename, 'a+b')
+        try:
+            self.f.seek(0)
+            if fcntl is not None:
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+            else:
+                msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+        except:
+            self.f.close()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        try:
+            if fcntl is not None:
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+            else:
+                self.f.seek(0)
+                msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self.f.close()
+
 class CellCache(Singleton):
-    ''' caching front end for holding cell data '''
+    '''
+    Caching front end for holding the classifier measurements of cells.
+
+    The measurements are kept on disk next to the properties file, in three
+    files starting with the properties file name and ".cellcache": a header
+    with the column names, the modify date of the object table and a token
+    that changes whenever the files are emptied, the matrix of measurements
+    (memory-mapped when read), and the object key of each row.  Rows are
+    only ever appended.  The files are emptied when the object table or the
+    classifier columns change.  CPA processes sharing the files take turns
+    with a lock on a fourth file, and each picks up the rows the others
+    appended before appending its own.  Without a properties file the
+    cache is only kept in memory.
+    '''
     def __init__(self):
-        self.data        = {}
-        self.colnames    = db.GetColumnNames(p.object_table)
-        if db.GetColnamesForClassifier() is not None:
-            self.col_indices = [self.colnames.index(v) for v in db.GetColnamesForClassifier()]
-        else:
-            self.col_indices = []
+        self.colnames    = db.GetColnamesForClassifier() or []
+        self.nkeycols    = len(object_key_columns())
         self.last_update = db.get_objects_modify_date()
+        filename = p.__dict__.get('_filename')
+        self.prefix = (filename + '.cellcache') if filename else None
+        self.token = None
+        self._set_rows(numpy.zeros((0, len(self.colnames))), numpy.zeros((0, self.nkeycols), 'int64'))
+        if self.prefix is not None:
+            try:
+                with self._lock():
+                    self._load()
+            except (IOError, OSError), e:
+                self._give_up(e)
+
+    def _filenames(self):
+        return [self.prefix + ext for ext in ['.header', '.values', '.keys']]
+
+    def _lock(self):
+        return _FileLock(self.prefix + '.lock')
+
+    def _give_up(self, e):
+        logging.warn('Could not write the cell cache %s, keeping it in memory: %s'%(self.prefix, e))
+        self.prefix = None
+
+    def _read_header(self):
+        ''' Returns the (date, colnames, token) in the header file. '''
+        with open(self._filenames()[0], 'rb') as f:
+            date, colnames, token = cPickle.load(f)
+        return date, colnames, token
+
+    def _rows_on_disk(self):
+        '''
+        Returns the number of complete rows in the files.  A partly written
+        last row (if CPA was stopped while appending) doesn't count.
+        '''
+        header, values_file, keys_file = self._filenames()
+        return min(os.path.getsize(values_file) // (8 * max(len(self.colnames), 1)),
+                   os.path.getsize(keys_file) // (8 * self.nkeycols))
+
+    def _map_values(self, nrows):
+        ''' Memory-maps the first nrows rows of the values file. '''
+        if nrows == 0:
+            return numpy.zeros((0, len(self.colnames)))
+        return numpy.memmap(self._filenames()[1], dtype='float64', mode='r', shape=(nrows, len(self.colnames)))
+
+    def _load(self):
+        '''
+        Reads the cache files, or starts new ones if they are out of date.
+        Call with the lock held.
+        '''
+        header, values_file, keys_file = self._filenames()
+        try:
+            date, colnames, token = self._read_header()
+            if colnames != self.colnames or not db.verify_objects_modify_date_earlier(date):
+                logging.info('Cell cache %s is out of date, starting a new one.'%(self.prefix))
+                self._reset_files()
+                return
+            nrows = self._rows_on_disk()
+            keys = numpy.fromfile(keys_file, dtype='int64', count=nrows * self.nkeycols)
+            self._set_rows(self._map_values(nrows), keys.reshape((nrows, self.nkeycols)))
+            self.token = token
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError, ValueError, TypeError):
+            self._reset_files()
+
+    def _sync(self):
+        '''
+        Picks up the rows that other processes appended to the files since
+        they were read, or reads them again if they were emptied.
+        Call with the lock held.
+        '''
+        try:
+            token = self._read_header()[2]
+            nrows = self._rows_on_disk()
+        except (IOError, OSError, EOFError, cPickle.UnpicklingError, ValueError, TypeError):
+            token = nrows = None
+        if token != self.token or nrows < len(self.values):
+            self._load()
+        elif nrows > len(self.values):
+            first = len(self.values)
+            with open(self._filenames()[2], 'rb') as f:
+                f.seek(first * 8 * self.nkeycols)
+                keys = numpy.fromfile(f, dtype='int64', count=(nrows - first) * self.nkeycols)
+            self.index.update((key, first + i) for i, key in
+                              enumerate(map(tuple, keys.reshape((-1, self.nkeycols)).tolist())))
+            self.values = self._map_values(nrows)
+
+    def _replace(self, filename, data):
+        '''
+        Replaces a file with data by renaming a new file over it, so that
+        the old file stays intact for other processes that have it mapped.
+        '''
+        temp = '%s.%d'%(filename, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(data)
+        if os.name == 'nt' and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(temp, filename)
+
+    def _reset(self):
+        ''' Empties the cache, and its files. '''
+        self._set_rows(numpy.zeros((0, len(self.colnames))), numpy.zeros((0, self.nkeycols), 'int64'))
+        if self.prefix is None:
+            return
+        try:
+            with self._lock():
+                self._reset_files()
+        except (IOError, OSError), e:
+            self._give_up(e)
+
+    def _reset_files(self):
+        ''' Empties the cache and its files.  Call with the lock held. '''
+        self._set_rows(numpy.zeros((0, len(self.colnames))), numpy.zeros((0, self.nkeycols), 'int64'))
+        header, values_file, keys_file = self._filenames()
+        self.token = os.urandom(16).encode('hex')
+        self._replace(values_file, '')
+        self._replace(keys_file, '')
+        self._replace(header, cPickle.dumps((self.last_update, self.colnames, self.token)))
+
+    def _set_rows(self, values, keys):
+        self.values = values
+        self.index = dict((key, i) for i, key in enumerate(map(tuple, keys.tolist())))
+
+    def _append(self, keys, values):
+        ''' Adds rows to the cache (and its files). '''
+        keys = numpy.asarray(keys, dtype='int64').reshape((-1, self.nkeycols))
+        values = numpy.asarray(values, dtype='float64').reshape((-1, len(self.colnames)))
+        if self.prefix is not None:
+            header, values_file, keys_file = self._filenames()
+            try:
+                with self._lock():
+                    self._sync()
+                    # skip the rows that another process just appended
+                    new = numpy.array([tuple(k) not in self.index for k in keys.tolist()], dtype=bool)
+                    keys, values = keys[new], values[new]
+                    first = len(self.values)
+                    # write after the last complete row, over any partly written one
+                    for filename, rows in [(values_file, values), (keys_file, keys)]:
+                        with open(filename, 'r+b') as f:
+                            f.seek(first * rows.shape[1] * 8)
+                            f.truncate()
+                            rows.tofile(f)
+                    self.values = self._map_values(first + len(keys))
+                self.index.update((key, first + i) for i, key in enumerate(map(tuple, keys.tolist())))
+                return
+            except (IOError, OSError), e:
+                self._give_up(e)
+        first = len(self.values)
+        self.values = numpy.vstack([self.values, values])
+        self.index.update((key, first + i) for i, key in enumerate(map(tuple, keys.tolist())))
 
     def load_from_string(self, str):
-        'load data from a string, verifying that the table has not changed since it was created (encoded in string)'
+        '''
+        Adds the cell data saved in older training set files, verifying that
+        the table has not changed since it was created (encoded in string).
+        '''
         try:
             date, colnames, oldcache = cPickle.loads(zlib.decompress(base64.b64decode(str)))
         except:
@@ -206,28 +447,43 @@ class CellCache(Singleton):
             if oldcache.values()[0].dtype.kind == 'S':
                 return
         # verify the database hasn't been changed
-        if db.verify_objects_modify_date_earlier(date):
-            self.data.update(oldcache)
-            self.colnames = colnames
-
-    def save_to_string(self, keys):
-        'convert the cache data to a string, but only for certain keys'
-        temp = {}
-        for k in keys:
-            if k in self.data:
-                temp[k] = self.data[k]
-        output = (db.get_objects_modify_date(), self.colnames, temp)
-        return base64.b64encode(zlib.compress(cPickle.dumps(output)))
+        if not db.verify_objects_modify_date_earlier(date):
+            return
+        try:
+            col_indices = [colnames.index(col) for col in self.colnames]
+        except ValueError:
+            return
+        new_keys = [key for key in oldcache if tuple(key) not in self.index]
+        if new_keys:
+            self._append(new_keys, [oldcache[key][col_indices] for key in new_keys])
 
     def get_object_data(self, key):
-        if key not in self.data:
-            self.data[key] = db.GetCellData(key)
-        return self.data[key][self.col_indices]
+        return self.get_objects_data([key])[0]
+
+    def get_objects_data(self, keys, callback=None):
+        '''
+        Returns a len(keys) x len(colnames) array of data for the given
+        objects, fetching all uncached objects from the db in bulk.
+        Rows of objects that are not in the db are NaN.
+        '''
+        keys = [tuple(k) for k in keys]
+        missing = [k for k in set(keys) if k not in self.index]
+        if missing:
+            rows = db.GetCellsDataForClassifier(missing, callback)
+            found = ~ numpy.all(numpy.isnan(rows), axis=1)
+            if found.any():
+                self._append([k for k, f in zip(missing, found) if f], rows[found])
+        values = numpy.empty((len(keys), len(self.colnames)))
+        values.fill(numpy.nan)
+        rows = numpy.array([self.index.get(k, -1) for k in keys], dtype=int)
+        cached = (rows >= 0)
+        values[cached] = self.values[rows[cached]]
+        return values
 
     def clear_if_objects_modified(self):
         if not db.verify_objects_modify_date_earlier(self.last_update):
-            self.data = {}
             self.last_update = db.get_objects_modify_date()
+            self._reset()
         
 
 if __name__ == "__main__":